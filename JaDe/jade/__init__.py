@@ -0,0 +1,10 @@
+# the API is imported on first use, so that importing a submodule (eg for
+# its constants) does not load spaCy
+__all__ = ['annotate_many', 'annotate_text', 'LineAnnotation']
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,84 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file is JaDe's library interface: poems are annotated in
+   memory and the results returned as LineAnnotation objects.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from functools import lru_cache
+from .processing import annotate_poems, load_pipeline, LineAnnotation, BATCH_SIZE
+
+DEFAULT_MODEL = 'en_core_web_sm'
+
+
+@lru_cache(maxsize=None)
+def get_pipeline(model=DEFAULT_MODEL, classifier='all'):
+    """
+        Load a pipeline once per model and classifier, see
+        processing.load_pipeline.
+    """
+    return load_pipeline(model, classifier)
+
+
+def annotate_many(texts, nlp=None, model=DEFAULT_MODEL, classifier='all', batch_size=BATCH_SIZE,
+                  parse_mode='pair', cache=None):
+    """
+        Annotate poems held in memory. Line pairs of all the poems are parsed
+        by batches, see processing.annotate_poems.
+
+        Parameters
+        ----------
+            texts: iterable
+                the poems, as strings
+            nlp:
+                spacy nlp pipeline. If None, the pipeline the classifier
+                needs is loaded from model, once.
+            model: str
+                language model to be loaded if nlp is None
+            classifier: str
+                classifier whose output is to be kept
+            batch_size: int
+                number of texts parsed at once by spaCy
+            parse_mode: str
+                one of processing.PARSE_MODES
+            cache: ParseCache
+                persistent cache of spaCy analyses, if any
+
+        Yields
+        ------
+            lines: list
+                one LineAnnotation per line of each poem, in the order the
+                poems were given
+    """
+    if nlp is None:
+        nlp = get_pipeline(model, classifier)
+
+    for _, lines in annotate_poems(enumerate(texts), nlp, classifier, batch_size, parse_mode, cache=cache):
+        yield lines
+
+
+def annotate_text(text, nlp=None, model=DEFAULT_MODEL, classifier='all', parse_mode='pair', cache=None):
+    """
+        Annotate a single poem held in memory, see annotate_many.
+
+        Returns
+        -------
+            lines: list
+                one LineAnnotation per line of the poem
+    """
+    for lines in annotate_many([text], nlp, model, classifier, parse_mode=parse_mode, cache=cache):
+        return lines
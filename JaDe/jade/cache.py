@@ -0,0 +1,202 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the persistent cache of spaCy analyses, so that
+   the same texts are not parsed again from one run to the next.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import time
+import zlib
+from collections import OrderedDict
+from itertools import islice
+
+# attributes the classifiers rely on
+CACHED_ATTRS = ['ORTH', 'TAG', 'POS', 'DEP', 'HEAD']
+CACHE_SIZE = 100000
+NUMBER_OF_SHARDS = 16
+
+
+class ParseCache:
+    """
+        Size-bounded, persistent cache of spaCy analyses.
+
+        Docs are keyed by the text parsed (ie the lowercased line pair, or the
+        lowercased poem or stanza in single-parse modes) within a namespace
+        made of the model name, version and enabled components, so that a
+        cache can be shared by several models. On disk, each namespace is
+        stored as shard files, each holding a DocBin along with the key and
+        last access time of its entries. When the cache is full, least
+        recently used entries are evicted.
+
+        Parameters
+        ----------
+            path: str
+                cache directory
+            nlp:
+                spacy nlp pipeline whose analyses are cached
+            max_entries: int
+                maximum number of Docs kept
+    """
+
+    def __init__(self, path, nlp, max_entries=CACHE_SIZE):
+        meta = nlp.meta
+        namespace = '|'.join([meta.get('lang', ''), meta.get('name', ''), meta.get('version', ''),
+                              ','.join(nlp.pipe_names)])
+        self.path = os.path.join(path, hashlib.sha1(namespace.encode('utf-8')).hexdigest()[:16])
+        self.vocab = nlp.vocab
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.last_access = {}
+        self.dirty_shards = set()
+        self.hits = 0
+        self.misses = 0
+        self._load(namespace)
+
+    def _shard(self, text):
+        return zlib.crc32(text.encode('utf-8')) % NUMBER_OF_SHARDS
+
+    def _load(self, namespace):
+        import srsly
+        from spacy.tokens import DocBin
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, 'namespace.txt'), 'w', encoding='utf-8') as file:
+                file.write(namespace)
+            return
+
+        loaded = []
+        for shard in range(NUMBER_OF_SHARDS):
+            shard_path = os.path.join(self.path, 'shard_%02d.msgpack' % shard)
+            if not os.path.exists(shard_path):
+                continue
+            try:
+                with open(shard_path, 'rb') as file:
+                    content = srsly.msgpack_loads(file.read())
+                keys = content['keys']
+                docs = list(DocBin().from_bytes(content['docs']).get_docs(self.vocab))
+            except (OSError, ValueError, KeyError, TypeError):
+                # a corrupted shard only costs its entries
+                continue
+            if len(keys) != len(docs):
+                continue
+            loaded.extend((last_access, text, doc) for (text, last_access), doc in zip(keys, docs))
+
+        for last_access, text, doc in sorted(loaded, key=lambda entry: entry[0])[-self.max_entries:]:
+            self.entries[text] = doc
+            self.last_access[text] = last_access
+
+    def get(self, text):
+        """
+            Return the cached Doc for text, or None.
+        """
+        doc = self.entries.get(text)
+        if doc is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(text)
+        self.last_access[text] = time.time()
+        self.dirty_shards.add(self._shard(text))
+
+        return doc
+
+    def put(self, text, doc):
+        """
+            Add a Doc to the cache, evicting the least recently used ones.
+        """
+        self.entries[text] = doc
+        self.entries.move_to_end(text)
+        self.last_access[text] = time.time()
+        self.dirty_shards.add(self._shard(text))
+
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            del self.last_access[evicted]
+            self.dirty_shards.add(self._shard(evicted))
+
+    def pipe(self, texts, nlp, batch_size):
+        """
+            Drop-in replacement for nlp.pipe(texts, as_tuples=True): only the
+            texts missing from the cache are parsed, by batches.
+
+            Parameters
+            ----------
+                texts: iterable
+                    (text, context) tuples
+                nlp:
+                    spacy nlp pipeline
+                batch_size: int
+                    number of texts looked up and parsed at once
+
+            Yields
+            ------
+                doc: Doc
+                    the parsed text
+                context:
+                    the context the text was given with
+        """
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, batch_size))
+            if len(batch) == 0:
+                break
+
+            docs = [self.get(text) for text, _ in batch]
+            missing = list(OrderedDict.fromkeys(text for (text, _), doc in zip(batch, docs) if doc is None))
+            parsed = dict(zip(missing, nlp.pipe(missing, batch_size=batch_size)))
+            for text, doc in parsed.items():
+                self.put(text, doc)
+
+            for (text, context), doc in zip(batch, docs):
+                yield (doc if doc is not None else parsed[text]), context
+
+    def save(self):
+        """
+            Write the shards that changed since the cache was loaded.
+        """
+        import srsly
+        from spacy.tokens import DocBin
+
+        shards = {shard: [] for shard in self.dirty_shards}
+        for text in self.entries:
+            shard = self._shard(text)
+            if shard in shards:
+                shards[shard].append(text)
+
+        for shard, texts in shards.items():
+            doc_bin = DocBin(attrs=CACHED_ATTRS, store_user_data=False)
+            for text in texts:
+                doc_bin.add(self.entries[text])
+            keys = [(text, self.last_access[text]) for text in texts]
+
+            # keys and Docs share a file, so that a shard is replaced at once
+            shard_path = os.path.join(self.path, 'shard_%02d.msgpack' % shard)
+            with open(shard_path + '.tmp', 'wb') as file:
+                file.write(srsly.msgpack_dumps({'keys': keys, 'docs': doc_bin.to_bytes()}))
+            os.replace(shard_path + '.tmp', shard_path)
+
+        self.dirty_shards = set()
+
+    def report(self):
+        """
+            Summarise cache use.
+        """
+        return 'Parse cache: %d hits, %d misses, %d entries' % (self.hits, self.misses, len(self.entries))
@@ -0,0 +1,384 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the corpora that are not loose text files: zip
+   and tar archives, JSONL dumps with one poem per record and anthologies of
+   delimited poems, whose poems are read in place through an offset index.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import fnmatch
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import tarfile
+import zipfile
+from .manifest import get_file_state
+
+CORPUS_FORMATS = ['zip', 'tar', 'jsonl', 'anthology']
+TAR_EXTENSIONS = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+# line starting a poem of an anthology, followed by the poem identifier if any
+ANTHOLOGY_DELIMITER = r'^={3,}[ \t]*(.*?)[ \t]*\r?$'
+# index of the poems of a corpus, kept in the output directory
+INDEX_NAME = '.jade_corpus_index.json'
+INDEX_VERSION = 1
+
+# corpora opened by the running process, see _get_reader
+_readers = {}
+
+
+def get_corpus_format(path):
+    """
+        Guess the format of a corpus from its extension, anything that is
+        neither an archive nor a JSONL dump being read as an anthology.
+    """
+    name = path.lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    if any(name.endswith(extension) for extension in TAR_EXTENSIONS):
+        return 'tar'
+    if name.endswith('.jsonl'):
+        return 'jsonl'
+
+    return 'anthology'
+
+
+def _unique(key, keys):
+    """
+        Make a poem identifier unique within its corpus.
+    """
+    unique_key = key
+    n = 1
+    while unique_key in keys:
+        n += 1
+        unique_key = key + '#' + str(n)
+    keys.add(unique_key)
+
+    return unique_key
+
+
+def index_zip(path):
+    """
+        List the text files of a zip archive, as (identifier, kind, locator,
+        size) tuples, identifiers being the names of the members.
+    """
+    with zipfile.ZipFile(path) as archive:
+        return [(info.filename, 'zip', info.filename, info.file_size) for info in archive.infolist()
+                if not info.is_dir() and fnmatch.fnmatch(info.filename, '*.txt')]
+
+
+def index_tar(path):
+    """
+        List the text files of a tar archive, identifiers being the names of
+        the members. Members of uncompressed archives are given by their byte
+        range in the archive, so that they can be read from a memory map;
+        those of compressed archives by their range in the decompressed stream,
+        to be read in the order of the archive, see is_sequential.
+    """
+    with tarfile.open(path) as archive:
+        kind = 'range' if isinstance(archive.fileobj, io.BufferedReader) else 'tar'
+        return [(info.name, kind, [info.offset_data, info.offset_data + info.size], info.size)
+                for info in archive if info.isfile() and fnmatch.fnmatch(info.name, '*.txt')]
+
+
+def index_jsonl(path, id_field='id', text_field='text'):
+    """
+        List the records of a JSONL dump by byte range. Records without
+        identifier are identified by their line number, starting from 1.
+    """
+    poems = []
+    keys = set()
+    with open(path, 'rb') as file:
+        start = 0
+        for n, line in enumerate(file, 1):
+            end = start + len(line)
+            if len(line.strip()) > 0:
+                record = json.loads(line.decode('utf-8'))
+                key = str(record[id_field]) if record.get(id_field) is not None else str(n)
+                poems.append((_unique(key, keys), 'jsonl', [start, end, text_field], end - start))
+            start = end
+
+    return poems
+
+
+def index_anthology(path, delimiter=ANTHOLOGY_DELIMITER):
+    """
+        List the poems of an anthology by byte range, scanning a memory map of
+        the file for delimiter lines.
+
+        Each poem starts with a line matching the delimiter, whose first group,
+        if any, is the identifier of the poem; unnamed poems are identified by
+        their position, starting from 1. Whatever precedes the first delimiter
+        (eg a licence header) is left out, unless there is no delimiter at all,
+        in which case the whole file is one poem.
+    """
+    if os.path.getsize(path) == 0:
+        return []
+
+    pattern = re.compile(delimiter.encode('utf-8'), flags=re.MULTILINE)
+    poems = []
+    keys = set()
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        matches = list(pattern.finditer(data))
+        if len(matches) == 0:
+            return [(os.path.basename(path), 'range', [0, len(data)], len(data))]
+
+        for n, match in enumerate(matches):
+            start = data.find(b'\n', match.end())
+            start = len(data) if start == -1 else start + 1
+            end = matches[n + 1].start() if n + 1 < len(matches) else len(data)
+            title = match.group(1).decode('utf-8').strip() if pattern.groups > 0 and match.group(1) else ''
+            poems.append((_unique(title or str(n + 1), keys), 'range', [start, max(start, end)],
+                          max(start, end) - start))
+
+    return poems
+
+
+def index_corpus(path, corpus_format=None, outdir=None, delimiter=ANTHOLOGY_DELIMITER, id_field='id',
+                 text_field='text'):
+    """
+        List the poems of a corpus. The index is built once and kept in the
+        output directory, being rebuilt only if the corpus or the options it
+        was built with changed.
+
+        Parameters
+        ----------
+            path: str
+                path to the corpus
+            corpus_format: str
+                one of CORPUS_FORMATS, guessed from the extension if None
+            outdir: str
+                output directory in which the index is kept, if any
+            delimiter: str
+                regular expression matching the lines that start the poems of
+                an anthology, see index_anthology
+            id_field: str
+                field holding the identifier of the poems of a JSONL dump
+            text_field: str
+                field holding the text of the poems of a JSONL dump
+
+        Returns
+        -------
+            poems: list
+                (identifier, source) tuples in the order of the corpus,
+                sources being read with read_source
+    """
+    corpus_format = corpus_format or get_corpus_format(path)
+    if corpus_format not in CORPUS_FORMATS:
+        raise ValueError('Unknown corpus format: ' + str(corpus_format))
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    options = {'format': corpus_format, 'delimiter': delimiter, 'id_field': id_field, 'text_field': text_field}
+    header = {'version': INDEX_VERSION, 'corpus': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+              'options': options}
+
+    index_path = os.path.join(outdir, INDEX_NAME) if outdir is not None else None
+    index = None
+    if index_path is not None and os.path.exists(index_path):
+        try:
+            with open(index_path, 'r', encoding='utf-8') as file:
+                index = json.load(file)
+        except ValueError:
+            index = None
+        if index is not None and any(index.get(name) != value for name, value in header.items()):
+            index = None
+
+    if index is None:
+        if corpus_format == 'zip':
+            poems = index_zip(path)
+        elif corpus_format == 'tar':
+            poems = index_tar(path)
+        elif corpus_format == 'jsonl':
+            poems = index_jsonl(path, id_field, text_field)
+        else:
+            poems = index_anthology(path, delimiter)
+        index = dict(header, poems=poems)
+
+        if index_path is not None:
+            with open(index_path + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(index, file)
+            os.replace(index_path + '.tmp', index_path)
+
+    return [(key, (path, kind, locator if isinstance(locator, str) else tuple(locator), size))
+            for key, kind, locator, size in index['poems']]
+
+
+def _get_reader(path, kind):
+    """
+        Open a corpus, once per process: a memory map for byte ranges, the
+        archive otherwise. Forked workers do not share the archives of their
+        parent, whose file positions would be moved under its feet, but do
+        share its memory maps.
+    """
+    reader_key = (path, kind if kind in ['zip', 'tar'] else 'range')
+    reader = _readers.get(reader_key)
+    if reader is not None and (reader[0] == os.getpid() or reader_key[1] == 'range'):
+        return reader[1]
+
+    if kind == 'zip':
+        reader = zipfile.ZipFile(path)
+    elif kind == 'tar':
+        reader = tarfile.open(path)
+    else:
+        with open(path, 'rb') as file:
+            reader = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    _readers[reader_key] = (os.getpid(), reader)
+
+    return reader
+
+
+def read_source_bytes(source):
+    """
+        Read the raw content of a poem, given by its path or by its source in
+        a corpus, see index_corpus.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            return file.read()
+
+    path, kind, locator, _ = source
+    reader = _get_reader(path, kind)
+    if kind == 'zip':
+        return reader.read(locator)
+    if kind == 'tar':
+        reader.fileobj.seek(locator[0])
+        return reader.fileobj.read(locator[1] - locator[0])
+    if kind == 'jsonl':
+        return json.loads(reader[locator[0]:locator[1]].decode('utf-8'))[locator[2]].encode('utf-8')
+
+    return reader[locator[0]:locator[1]]
+
+
+def read_source(source):
+    """
+        Read a poem, given by its path or by its source in a corpus, line
+        breaks being translated as they are when a text file is opened.
+    """
+    if isinstance(source, str):
+        with open(source, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    text = read_source_bytes(source).decode('utf-8')
+    if source[1] == 'jsonl':
+        return text
+
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def get_source_size(source):
+    """
+        Return the size of a poem in bytes, as stored in the corpus.
+    """
+    if isinstance(source, str):
+        return os.path.getsize(source)
+
+    return source[3]
+
+
+def is_sequential(source):
+    """
+        Tell whether a poem lies in a compressed tar archive, whose members
+        can only be read efficiently in the order of the archive: seeking
+        backward in a decompressed stream decompresses it again from the
+        start.
+    """
+    return not isinstance(source, str) and source[1] == 'tar'
+
+
+def get_source_state(source, record=None):
+    """
+        Describe a poem for the manifest, see manifest.get_file_state. The
+        digest recorded in the manifest is reused as long as the corpus itself
+        was not modified.
+    """
+    if isinstance(source, str):
+        return get_file_state(source, record)
+
+    state = {'size': source[3], 'mtime': os.stat(source[0]).st_mtime_ns}
+    if record is not None and record.get('size') == state['size'] and record.get('mtime') == state['mtime']:
+        state['hash'] = record['hash']
+    else:
+        state['hash'] = hashlib.sha256(read_source_bytes(source)).hexdigest()
+
+    return state
+
+
+def get_poem_outfile(key, outdir, used=None):
+    """
+        Build the path to where an annotated poem of a corpus is saved, from
+        its identifier.
+
+        Identifiers are made safe for file names, so that different poems may
+        end up with the same name, eg `a/b.txt` and `a_b.txt`. Names already
+        given to the poems of the corpus are tracked in used, lowercased as
+        file systems may ignore case, the name of a poem being followed by a
+        number if it is taken already.
+    """
+    name = re.sub(r'[^\w\-]+', '_', re.sub(r'\.txt$', '', key)).strip('_') or '_'
+
+    if used is not None:
+        unique_name = name
+        n = 1
+        while unique_name.lower() in used:
+            n += 1
+            unique_name = name + '-' + str(n)
+        used.add(unique_name.lower())
+        name = unique_name
+
+    return os.path.join(outdir, name + '.txt')
+
+
+def get_poem_outfiles(keys, outdir, manifest=None):
+    """
+        Build the paths to where the annotated poems of a corpus are saved.
+        Poems recorded in the manifest keep the file they were annotated to,
+        unless another poem of the corpus kept it first, so that poems added
+        to the corpus cannot take the name of a poem annotated already. The
+        other poems are named in the order of the corpus, see
+        get_poem_outfile.
+
+        Parameters
+        ----------
+            keys: list
+                identifiers of the poems, in the order of the corpus
+            outdir: str
+                path to the output directory
+            manifest: dict
+                manifest of the output directory, see manifest.load_manifest
+
+        Returns
+        -------
+            outfiles: dict
+                {key: path to where the annotated poem is saved}
+    """
+    used = set()
+    outfiles = {}
+    for key in keys:
+        record = (manifest or {}).get(key)
+        name = os.path.basename(record.get('outfile') or '') if record is not None else ''
+        if name.endswith('.txt') and name[:-4] and name[:-4].lower() not in used:
+            used.add(name[:-4].lower())
+            outfiles[key] = os.path.join(outdir, name)
+
+    for key in keys:
+        if key not in outfiles:
+            outfiles[key] = get_poem_outfile(key, outdir, used)
+
+    return outfiles
@@ -0,0 +1,264 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles detection without classification: the end-stop
+   test of processing.is_enjambment applied to whole files at once with NumPy,
+   without any model, along with run-on rates per poem and per stanza.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import re
+import time
+import numpy as np
+from .corpus import read_source_bytes
+from .processing import remove_annotations
+
+# records of a directory or corpus, one per poem, kept in the output directory
+DETECTION_NAME = 'detection.jsonl'
+# number of bytes of poems tested at once
+DETECTION_BATCH_SIZE = 1 << 23
+# characters ending end-stopped lines, see processing.is_enjambment
+END_STOPS = '.,!?;-:()'
+EM_DASH = '—'.encode('utf-8')
+
+# one-byte characters str.strip removes, line breaks included
+_SPACES = np.zeros(256, dtype=bool)
+_SPACES[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+_END_STOPS = np.zeros(256, dtype=bool)
+_END_STOPS[list(END_STOPS.encode('ascii'))] = True
+# length of UTF-8 characters given their first byte
+_LENGTHS = np.ones(256, dtype=np.int64)
+_LENGTHS[0xc0:0xe0] = 2
+_LENGTHS[0xe0:0xf0] = 3
+_LENGTHS[0xf0:] = 4
+_ANNOTATED = re.compile(rb'^\d{1,}\. ', flags=re.MULTILINE)
+
+
+def read_poem_bytes(source):
+    """
+        Read a poem as bytes, given by its path or its source in a corpus,
+        line breaks being translated and manual annotations removed as they
+        are before annotation (see corpus.read_source and
+        processing.prepare_poem).
+    """
+    data = read_source_bytes(source)
+    if (isinstance(source, str) or source[1] != 'jsonl') and b'\r' in data:
+        data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if _ANNOTATED.search(data):
+        data = remove_annotations(data.decode('utf-8')).encode('utf-8')
+
+    return data
+
+
+def _is_space(padded, positions):
+    """
+        Tell whether the characters starting at the given positions are 
+        removed by str.strip, see detect_lines.
+    """
+    first, second, third = padded[positions], padded[positions + 1], padded[positions + 2]
+
+    return _SPACES[first] | ((first == 0xc2) & ((second == 0x85) | (second == 0xa0))) \
+        | ((first == 0xe1) & (second == 0x9a) & (third == 0x80)) \
+        | ((first == 0xe2) & (second == 0x80) & ((third <= 0x8a) | (third == 0xa8) | (third == 0xa9) 
+                                                 | (third == 0xaf))) \
+        | ((first == 0xe2) & (second == 0x81) & (third == 0x9f)) \
+        | ((first == 0xe3) & (second == 0x80) & (third == 0x80))
+
+
+def detect_lines(poems):
+    """
+        Tell run-on from end-stopped lines, for every line of several poems at
+        once. Lines are never decoded: the test of processing.is_enjambment
+        (a stripped line of more than one character, not ending with an end
+        stop) is run on the UTF-8 bytes of the poems, joined into a single
+        array.
+
+        Parameters
+        ----------
+            poems: list
+                poems as UTF-8 bytes, see read_poem_bytes
+
+        Returns
+        -------
+            run_on: np.ndarray
+                whether each line of the poems is run-on, in order
+            blank: np.ndarray
+                whether each line is blank once stripped
+            bounds: np.ndarray
+                index of the first line of each poem, followed by the number
+                of lines
+    """
+    joined = b'\n'.join(poems)
+    # padded so that the three bytes of a character can be read from any position
+    padded = np.frombuffer(joined + b'\0\0\0', dtype=np.uint8)
+    breaks = np.flatnonzero(padded[:len(joined)] == 10)
+    starts = np.r_[0, breaks + 1]
+    ends = np.r_[breaks, len(joined)]
+
+    # lines are stripped by moving their bounds over spaces, few lines having
+    # more than a couple of them
+    first = starts.copy()
+    active = np.flatnonzero(first < ends)
+    while len(active) > 0:
+        spaces = _is_space(padded, first[active])
+        active = active[spaces]
+        first[active] += _LENGTHS[padded[first[active]]]
+        active = active[first[active] < ends[active]]
+
+    last = ends - 1
+    active = np.flatnonzero(last >= first)
+    while len(active) > 0:
+        # back to the first byte of the last character
+        for _ in range(3):
+            continued = active[(padded[last[active]] & 0xc0) == 0x80]
+            last[continued] -= 1
+        spaces = _is_space(padded, last[active])
+        active = active[spaces]
+        last[active] -= 1
+        active = active[last[active] >= first[active]]
+
+    blank = first >= ends
+    end_stopped = _END_STOPS[padded[last]] | ((padded[last] == EM_DASH[0]) & (padded[last + 1] == EM_DASH[1])
+                                              & (padded[last + 2] == EM_DASH[2]))
+    run_on = ~blank & (last > first) & ~end_stopped
+
+    bounds = np.r_[0, np.cumsum([poem.count(b'\n') + 1 for poem in poems])]
+
+    return run_on, blank, bounds
+
+
+def detect_poems(poems):
+    """
+        Count the run-on lines of several poems, by poem and by stanza, see
+        detect_lines. Stanzas are runs of non-blank lines.
+
+        Parameters
+        ----------
+            poems: list
+                (key, poem as UTF-8 bytes) tuples
+
+        Yields
+        ------
+            record: dict
+                for each poem: its key, its number of (non-blank) lines and
+                run-on lines and its run-on rate, the same by stanza, and
+                flags, one per line, `1` for run-on lines and `0` for
+                end-stopped ones, stanzas being separated by spaces
+    """
+    if len(poems) == 0:
+        return
+
+    run_on, blank, bounds = detect_lines([poem for _, poem in poems])
+    lines = ~blank
+    poem_starts = np.zeros(len(run_on), dtype=bool)
+    poem_starts[bounds[:-1]] = True
+    stanza_starts = lines & (np.r_[True, blank[:-1]] | poem_starts)
+
+    stanzas = np.cumsum(stanza_starts)[lines] - 1
+    stanza_lines = np.bincount(stanzas, minlength=int(stanza_starts.sum()))
+    stanza_run_on = np.bincount(stanzas, weights=run_on[lines], minlength=len(stanza_lines)).astype(np.int64)
+    stanza_rates = np.round(stanza_run_on / np.maximum(stanza_lines, 1), 4)
+    stanza_bounds = np.r_[0, np.cumsum(stanza_starts)][bounds]
+    line_bounds = np.r_[0, np.cumsum(lines)][bounds]
+    run_on_bounds = np.r_[0, np.cumsum(run_on)][bounds]
+
+    # flags of the lines, a space being inserted before each stanza but the first of its poem
+    separators = stanza_starts[lines]
+    separators[line_bounds[:-1][line_bounds[1:] > line_bounds[:-1]]] = False
+    positions = np.arange(len(stanzas)) + np.cumsum(separators)
+    flags = np.full(positions[-1] + 1 if len(positions) else 0, ord(' '), dtype=np.uint8)
+    flags[positions] = np.where(run_on[lines], ord('1'), ord('0'))
+    flags = flags.tobytes().decode('ascii')
+    flag_bounds = np.r_[0, positions + 1][line_bounds]
+
+    for n, (key, _) in enumerate(poems):
+        number_of_lines = int(line_bounds[n + 1] - line_bounds[n])
+        number_of_run_on = int(run_on_bounds[n + 1] - run_on_bounds[n])
+        first_stanza, last_stanza = stanza_bounds[n], stanza_bounds[n + 1]
+        yield {'poem': key, 'lines': number_of_lines, 'run_on': number_of_run_on,
+               'rate': round(number_of_run_on / number_of_lines, 4) if number_of_lines else 0.0,
+               'stanza_lines': stanza_lines[first_stanza:last_stanza].tolist(),
+               'stanza_run_on': stanza_run_on[first_stanza:last_stanza].tolist(),
+               'stanza_rates': stanza_rates[first_stanza:last_stanza].tolist(),
+               'flags': flags[flag_bounds[n]:flag_bounds[n + 1]]}
+
+
+def detect_collection(sources, out, on_error=None, batch_size=DETECTION_BATCH_SIZE, profiler=None):
+    """
+        Detect the run-on lines of a stream of poems, writing one JSON record
+        per poem as soon as its batch is tested, see detect_poems. Poems are
+        read and tested by batches of about batch_size bytes, so that memory
+        does not depend on the number of poems.
+
+        Parameters
+        ----------
+            sources: iterable
+                (key, path to the poem or its source in a corpus) tuples
+            out:
+                text file the records are written to
+            on_error: callable
+                if given, called with the key of the poem and the exception
+                when a poem cannot be read, the poem being skipped.
+                Otherwise, the exception is raised.
+            batch_size: int
+                number of bytes of poems tested at once
+            profiler: Profiler
+                if given, detection is timed and poems, lines and run-on
+                lines are counted
+
+        Returns
+        -------
+            totals: dict
+                numbers of poems, lines and run-on lines
+    """
+    totals = {'poems': 0, 'lines': 0, 'run_on': 0}
+    batch = []
+    size = 0
+
+    def flush():
+        start = time.perf_counter()
+        records = list(detect_poems(batch))
+        if profiler is not None:
+            profiler.add('detect_lines', time.perf_counter() - start)
+        for record in records:
+            out.write(json.dumps(record) + '\n')
+            totals['poems'] += 1
+            totals['lines'] += record['lines']
+            totals['run_on'] += record['run_on']
+        batch.clear()
+
+    for key, source in sources:
+        try:
+            poem = read_poem_bytes(source)
+        except (OSError, UnicodeDecodeError, ValueError, KeyError) as err:
+            if on_error is None:
+                raise
+            on_error(key, err)
+            continue
+        batch.append((key, poem))
+        size += len(poem)
+        if size >= batch_size:
+            flush()
+            size = 0
+    flush()
+
+    if profiler is not None:
+        profiler.count('poems', totals['poems'])
+        profiler.count('lines', totals['lines'])
+        profiler.count('run-on lines', totals['run_on'])
+
+    return totals
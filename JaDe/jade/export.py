@@ -0,0 +1,282 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the structured export of annotations, as JSONL
+   records or NumPy columns, so that they can be loaded without parsing the
+   annotated poems again.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import time
+from .labels import get_code, get_labels, EMPTY
+from .manifest import load_manifest
+
+EXPORT_FORMATS = ['jsonl', 'npz']
+# maximum number of lines per shard, poems being never split across shards
+SHARD_SIZE = 100000
+SHARD_PREFIX = 'annotations-'
+# classifiers annotations may come from, coded by position (0: no annotation)
+SOURCES = ['', 'dictionary', 'regex', 'dependencies']
+COLUMNS = ['poem', 'line', 'run_on', 'stanza_end', 'label', 'source']
+
+
+def get_line_records(key, lines, classifier='all'):
+    """
+        Describe each non-blank line of a poem as it is annotated for the given
+        classifier.
+
+        Parameters
+        ----------
+            key: str
+                identifier of the poem
+            lines: list
+                LineAnnotation of every line of the poem
+            classifier: str
+                classifier whose output is kept
+
+        Returns
+        -------
+            records: list
+                one dict per line, with the poem, the line number, whether the
+                line is run-on and ends a stanza, its label (`[]` if none) and
+                the classifier the label comes from (None if none)
+    """
+    records = []
+    for line in lines:
+        if line.number is None:
+            continue
+        records.append({'poem': key, 'line': line.number, 'run_on': line.run_on, 'stanza_end': line.stanza_end,
+                        'label': line.get_label(classifier), 'source': line.get_source(classifier)})
+
+    return records
+
+
+class AnnotationExporter:
+    """
+        Write the annotations of a directory run into a few shard files,
+        rather than one file per poem.
+
+        Shards are named after the run, so that those of previous runs are
+        kept for the poems that were not annotated again: the manifest records
+        which shard holds the current annotation of each poem, see
+        load_annotations. A shard is written under a temporary name and only
+        renamed once complete.
+
+        Attributes
+        ----------
+            outdir: str
+                path to the output directory
+            export_format: str
+                one of EXPORT_FORMATS
+            classifier: str
+                classifier whose output is kept
+            shard_size: int
+                number of lines above which a new shard is started
+    """
+    def __init__(self, outdir, export_format, classifier='all', shard_size=SHARD_SIZE):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError('Unknown export format: ' + str(export_format))
+        self.outdir = outdir
+        self.export_format = export_format
+        self.classifier = classifier
+        self.shard_size = shard_size
+        self.run = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+        self.shards = 0
+        self.path = None
+        self.file = None
+        self.columns = None
+        self.poems = []
+        self.size = 0
+
+    def _open(self):
+        self.path = os.path.join(self.outdir, '%s%s-%05d.%s' % (SHARD_PREFIX, self.run, self.shards,
+                                                                  self.export_format))
+        self.shards += 1
+        self.size = 0
+        if self.export_format == 'jsonl':
+            self.file = open(self.path + '.tmp', 'w', encoding='utf-8')
+        else:
+            self.columns = {column: [] for column in COLUMNS}
+            self.poems = []
+
+    def _close(self):
+        if self.export_format == 'jsonl':
+            self.file.close()
+            self.file = None
+        else:
+            import numpy as np
+
+            with open(self.path + '.tmp', 'wb') as file:
+                np.savez_compressed(file, poems=np.array(self.poems, dtype=str), 
+                                    labels=np.array(get_labels(), dtype=str), sources=np.array(SOURCES, dtype=str),
+                                    poem=np.array(self.columns['poem'], dtype=np.int32),
+                                    line=np.array(self.columns['line'], dtype=np.int32),
+                                    run_on=np.array(self.columns['run_on'], dtype=bool),
+                                    stanza_end=np.array(self.columns['stanza_end'], dtype=bool),
+                                    label=np.array(self.columns['label'], dtype=np.int32),
+                                    source=np.array(self.columns['source'], dtype=np.int8))
+            self.columns = None
+        os.replace(self.path + '.tmp', self.path)
+        self.path = None
+
+    def add(self, key, lines):
+        """
+            Export the annotation of a poem.
+
+            Parameters
+            ----------
+                key: str
+                    identifier of the poem, ie its key in the manifest
+                lines: list
+                    LineAnnotation of every line of the poem
+
+            Returns
+            -------
+                shard: str
+                    path to the shard the poem is exported to
+        """
+        if self.path is None:
+            self._open()
+
+        records = get_line_records(key, lines, self.classifier)
+        if self.export_format == 'jsonl':
+            self.file.write(''.join(json.dumps(record) + '\n' for record in records))
+        else:
+            self.poems.append(key)
+            for record in records:
+                self.columns['poem'].append(len(self.poems) - 1)
+                self.columns['line'].append(record['line'])
+                self.columns['run_on'].append(record['run_on'])
+                self.columns['stanza_end'].append(record['stanza_end'])
+                self.columns['label'].append(get_code(record['label']))
+                self.columns['source'].append(SOURCES.index(record['source'] or ''))
+        self.size += len(records)
+
+        shard = self.path
+        if self.size >= self.shard_size:
+            self._close()
+
+        return shard
+
+    def close(self):
+        """
+            Write the last shard.
+        """
+        if self.path is not None:
+            self._close()
+
+
+def remove_stale_shards(outdir, manifest):
+    """
+        Delete the shards no poem of the manifest refers to any more, along 
+        with those left incomplete by an interrupted run. To be called once 
+        every exporter of the directory is closed.
+    """
+    current = set(os.path.basename(record['shard']) for record in manifest.values() if record.get('shard'))
+    for file in os.listdir(outdir):
+        if file.startswith(SHARD_PREFIX) and file not in current:
+            os.remove(os.path.join(outdir, file))
+
+
+def read_shard(path):
+    """
+        Read a shard as columns, labels being coded as in the running process.
+
+        Returns
+        -------
+            poems: list
+                identifiers of the poems of the shard
+            columns: dict
+                {column: array}, see COLUMNS. Poems are given by their index
+                in poems.
+    """
+    import numpy as np
+
+    if path.endswith('.npz'):
+        with np.load(path) as shard:
+            codes = np.array([get_code(label) for label in shard['labels']] or [0], dtype=np.int32)
+            sources = np.array([SOURCES.index(source) for source in shard['sources']], dtype=np.int8)
+            columns = {column: shard[column] for column in COLUMNS}
+            columns['label'] = codes[columns['label']]
+            columns['source'] = sources[columns['source']]
+            return [str(poem) for poem in shard['poems']], columns
+
+    poems = {}
+    columns = {column: [] for column in COLUMNS}
+    with open(path, 'r', encoding='utf-8') as file:
+        for row in file:
+            record = json.loads(row)
+            columns['poem'].append(poems.setdefault(record['poem'], len(poems)))
+            columns['line'].append(record['line'])
+            columns['run_on'].append(record['run_on'])
+            columns['stanza_end'].append(record['stanza_end'])
+            columns['label'].append(get_code(record['label']))
+            columns['source'].append(SOURCES.index(record['source'] or ''))
+
+    return list(poems), {'poem': np.array(columns['poem'], dtype=np.int32),
+                         'line': np.array(columns['line'], dtype=np.int32),
+                         'run_on': np.array(columns['run_on'], dtype=bool),
+                         'stanza_end': np.array(columns['stanza_end'], dtype=bool),
+                         'label': np.array(columns['label'], dtype=np.int32),
+                         'source': np.array(columns['source'], dtype=np.int8)}
+
+
+def load_annotations(outdir):
+    """
+        Load the exported annotations of an output directory, as columns.
+        Only the current annotation of each poem, as recorded by the manifest,
+        is kept.
+
+        Parameters
+        ----------
+            outdir: str
+                path to the output directory of a run with --export
+
+        Returns
+        -------
+            poems: list
+                identifiers of the poems, ie their keys in the manifest
+            columns: dict
+                {column: array}, one row per non-blank line. `poem` is the
+                index of the poem in poems, `label` a code of labels.get_labels
+                and `source` an index in SOURCES.
+    """
+    import numpy as np
+
+    manifest = load_manifest(outdir)
+    shards = {}
+    for key, record in manifest.items():
+        if record.get('status') == 'done' and record.get('shard'):
+            shards.setdefault(record['shard'], set()).add(key)
+
+    poems = []
+    parts = []
+    for shard in sorted(shards):
+        shard_poems, columns = read_shard(os.path.join(outdir, os.path.basename(shard)))
+        kept = np.array([poem in shards[shard] for poem in shard_poems] or [False], dtype=bool)
+        rows = kept[columns['poem']]
+        index = np.cumsum(kept, dtype=np.int32) - 1 + len(poems)
+        columns = {column: values[rows] for column, values in columns.items()}
+        columns['poem'] = index[columns['poem']]
+        poems.extend(poem for poem, keep in zip(shard_poems, kept) if keep)
+        parts.append(columns)
+
+    if len(parts) == 0:
+        return poems, {column: np.zeros(0, dtype=np.int32) for column in COLUMNS}
+
+    return poems, {column: np.concatenate([part[column] for part in parts]) for column in COLUMNS}
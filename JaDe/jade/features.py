@@ -0,0 +1,227 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the features of line pairs: what the classifiers
+   read from the parse, extracted once so that variants of the rules can be
+   run against them without parsing again.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+from .labels import EMPTY
+from .manifest import get_model_version, hash_file
+from .processing import get_dependency_arrays, get_pair_views, get_parse_units, handle_multiclassification, \
+    prepare_poem, BATCH_SIZE
+from .utils import detect_phrasal_verb, get_dep_type, get_pos_type, PHRASAL_VERBS, POS_MATCHERS
+
+FEATURES_NAME = '.pair_features.json'
+# to be increased whenever a change in get_pair_features changes the features
+FEATURES_VERSION = '1'
+# classifiers in the order annotate_line gives them priority, and the
+# separator of the types they annotate lines with
+CLASSIFIER_ORDER = ['dictionary', 'regex', 'dependencies']
+SEPARATORS = {'dictionary': ', ', 'regex': ',', 'dependencies': ', '}
+
+
+def get_pair_features(line_pair, tagged_sentence):
+    """
+        Gather what the classifiers read from a line pair: the output of the
+        dictionary classifier, which does not depend on the parse, and the
+        token attributes the regex and dependency classifiers rely on.
+
+        Parameters
+        ----------
+            line_pair: str
+                line pair, the line break being replaced by a tab
+            tagged_sentence: Span
+                the lowercased line pair, as parsed by spaCy
+
+        Returns
+        -------
+            features: dict
+                {'phrasal': types, 'dependencies': arrays}, arrays being those
+                of processing.get_dependency_arrays, POS and tags included
+    """
+    return {'phrasal': detect_phrasal_verb(line_pair), 'dependencies': list(get_dependency_arrays(tagged_sentence))}
+
+
+def extract_features(poems, nlp, batch_size=BATCH_SIZE, parse_mode='pair', cache=None):
+    """
+        Parse the line pairs of poems, once, and extract their features.
+
+        Parameters
+        ----------
+            poems: iterable
+                (key, poem) tuples
+            nlp:
+                spacy nlp pipeline, with the parser
+            batch_size: int
+                number of texts parsed at once by spaCy
+            parse_mode: str
+                one of processing.PARSE_MODES
+            cache: ParseCache
+                if given, texts already parsed are retrieved from the cache
+
+        Returns
+        -------
+            features: dict
+                {key: list of features}, one dict per run-on line, holding
+                the number of the line as in LineAnnotation along with the
+                features of its line pair, see get_pair_features
+    """
+    entries = []
+    texts = []
+    for key, poem in poems:
+        poem_lines, pairs = prepare_poem(poem)
+        units = get_parse_units(poem_lines, pairs, parse_mode)
+        texts.extend((text, len(entries)) for text, _ in units)
+        entries.append((key, poem_lines, pairs, units))
+
+    docs = [[] for _ in entries]
+    parsed = cache.pipe(texts, nlp, batch_size) if cache is not None \
+        else nlp.pipe(texts, as_tuples=True, batch_size=batch_size)
+    for doc, n in parsed:
+        docs[n].append(doc)
+
+    features = {}
+    for (key, poem_lines, pairs, units), poem_docs in zip(entries, docs):
+        views = get_pair_views(units, poem_docs, len(pairs))
+        # lines are numbered as in LineAnnotation, blank lines aside
+        numbers = []
+        number = 0
+        for line in poem_lines:
+            number += len(line.strip()) > 0
+            numbers.append(number)
+        features[key] = [dict(get_pair_features(line_pair, view), line=numbers[i])
+                         for (i, line_pair, _), view in zip(pairs, views)]
+
+    return features
+
+
+def save_features(path, features, hashes, settings):
+    """
+        Write the features of a set of poems.
+
+        Parameters
+        ----------
+            path: str
+                path to the store
+            features: dict
+                as returned by extract_features
+            hashes: dict
+                {key: hash of the poem}, see store.hash_text
+            settings: dict
+                what the features depend on, see get_feature_settings
+    """
+    store = {'version': FEATURES_VERSION, 'settings': settings,
+             'poems': {key: {'hash': hashes[key], 'pairs': pairs} for key, pairs in features.items()}}
+
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(store, file)
+    os.replace(path + '.tmp', path)
+
+
+def load_features(path, hashes, settings):
+    """
+        Read the features of a set of poems, provided that they were extracted
+        from the same poems with the same settings. Unlike the store of raw
+        outputs, features do not depend on the rules.
+
+        Returns
+        -------
+            features: dict
+                as returned by extract_features, None if the store is missing
+                or out of date
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            store = json.load(file)
+    except ValueError:
+        return None
+
+    if store.get('version') != FEATURES_VERSION or store.get('settings') != settings:
+        return None
+
+    poems = store.get('poems', {})
+    if set(poems) != set(hashes) or any(poems[key]['hash'] != poem_hash for key, poem_hash in hashes.items()):
+        return None
+
+    return {key: poem['pairs'] for key, poem in poems.items()}
+
+
+def get_feature_settings(model, parse_mode='pair'):
+    """
+        Gather what the features depend on: the model and its version, the
+        parse mode and the phrasal verbs lexicon. The version is read without
+        loading the model, so that up-to-date features spare loading it.
+    """
+    return {'model': model, 'model_version': get_model_version(model), 'parse_mode': parse_mode,
+            'lexicon': hash_file(PHRASAL_VERBS)}
+
+
+def classify_features(features, compiled_rules=POS_MATCHERS, window=1, disabled=(), multiclassification=True,
+                      order=CLASSIFIER_ORDER):
+    """
+        Annotate a run-on line from the features of its line pair, as the
+        `all` classifier would, the rules being possibly altered. With the
+        default arguments, the annotation is that of processing.annotate_line.
+
+        Parameters
+        ----------
+            features: dict
+                features of the line pair, see get_pair_features
+            compiled_rules: tuple
+                rules of the regex classifier, see utils.compile_pos_rules
+            window: int
+                number of words on each side of the break the dependency
+                rules look at, see utils.get_dep_type
+            disabled: iterable
+                types the dependency classifier does not give
+            multiclassification: bool
+                whether handle_multiclassification arbitrates between several
+                dependency types
+            order: list
+                classifiers whose types are retained, by priority
+
+        Returns
+        -------
+            annotation: str
+                label of the line, EMPTY if no type was found
+    """
+    deps, pos, tags, heads, words, enjambment_index = features['dependencies']
+    types = {}
+
+    for name in order:
+        if name == 'dictionary':
+            types[name] = features['phrasal']
+        elif name == 'regex':
+            types[name] = get_pos_type(list(zip(words, pos, tags)), compiled_rules=compiled_rules)
+        else:
+            dep_types = [dep_type for dep_type in dict.fromkeys(get_dep_type(deps, pos, tags, heads, words,
+                                                                             enjambment_index, window))
+                         if dep_type not in disabled]
+            if multiclassification and len(dep_types) > 1:
+                dep_types = handle_multiclassification(dep_types)
+            types[name] = dep_types
+
+        if len(types[name]) > 0:
+            return '[' + SEPARATORS[name].join(types[name]) + ']'
+
+    return EMPTY
@@ -0,0 +1,158 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the compiled store of manual annotations, so that
+   the test data is parsed once rather than at every evaluation.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import re
+from .labels import encode, get_code, get_labels, CLASSIFIER_TYPES, EMPTY
+from .manifest import get_file_state
+
+GOLD_STORE_NAME = '.gold_store.json'
+# to be increased whenever a change in get_gold_labels changes the labels
+GOLD_VERSION = '1'
+GOLD_CLASSIFIERS = ['all', 'dependencies', 'regex', 'dictionary']
+
+
+def get_gold_labels(poem, classifier):
+    """
+        Retrieve the manual annotation of a poem of the test data.
+
+        Parameters
+        ----------
+            poem: str
+                the annotated poem
+            classifier: str
+                classifier evaluated, whose types only are kept
+
+        Returns
+        -------
+            labels: list
+                (line number, label) tuples, in the order of the annotation
+    """
+    labels = []
+
+    all_annotations = re.findall(r'^(\d{2,}) \d{2,}(.*)', poem, flags=re.MULTILINE)
+    for line_number, annotated_line in all_annotations:
+        wanted = annotated_line.split(' ')[1]
+
+        if classifier == 'all':
+            if not 'lex' in wanted and len(wanted) > 2:
+                labels.append((int(line_number), wanted))
+            else:
+                labels.append((int(line_number), EMPTY))
+
+        elif wanted in CLASSIFIER_TYPES[classifier]:
+            labels.append((int(line_number), wanted))
+
+        else:
+            labels.append((int(line_number), EMPTY))
+
+    return labels
+
+
+def compile_gold_poem(path):
+    """
+        Parse the manual annotation of a poem for every classifier.
+
+        Returns
+        -------
+            line_numbers: array
+                number of each annotated line
+            codes: dict
+                {classifier: array of label codes}, aligned with line_numbers
+    """
+    import numpy as np
+
+    with open(path, 'r', encoding='utf-8') as poem_file:
+        poem = poem_file.read()
+
+    codes = {}
+    for classifier in GOLD_CLASSIFIERS:
+        labels = get_gold_labels(poem, classifier)
+        line_numbers = np.array([line_number for line_number, _ in labels], dtype=np.int32)
+        codes[classifier] = encode([label for _, label in labels])
+
+    return line_numbers, codes
+
+
+def load_gold(files, store_path):
+    """
+        Load the manual annotations of the test data from the compiled store,
+        only compiling the poems that are new or whose file changed since
+        they were stored. The store is then updated.
+
+        Codes are saved along with the labels they stood for, and translated
+        into the codes of the running process when loaded.
+
+        Parameters
+        ----------
+            files: dict
+                {key: path to the annotated poem}
+            store_path: str
+                path to the compiled store
+
+        Returns
+        -------
+            gold: dict
+                {key: (line numbers, {classifier: label codes})}
+    """
+    import numpy as np
+
+    store = {}
+    if os.path.exists(store_path):
+        try:
+            with open(store_path, 'r', encoding='utf-8') as file:
+                store = json.load(file)
+        except ValueError:
+            store = {}
+    if store.get('version') != GOLD_VERSION:
+        store = {}
+
+    stored_codes = np.array([get_code(label) for label in store.get('labels', [])] or [0], dtype=np.int32)
+    records = store.get('poems', {})
+    gold = {}
+    changed = set(records) != set(files)
+
+    for key, path in files.items():
+        record = records.get(key)
+        state = get_file_state(path, record)
+        if record is not None and record['hash'] == state['hash']:
+            codes = {classifier: stored_codes[np.array(record['codes'][classifier], dtype=np.int32)]
+                     for classifier in GOLD_CLASSIFIERS}
+            gold[key] = (np.array(record['line_numbers'], dtype=np.int32), codes)
+            changed = changed or record['mtime'] != state['mtime']
+        else:
+            gold[key] = compile_gold_poem(path)
+            changed = True
+        records[key] = state
+
+    if changed:
+        poems = {}
+        for key, (line_numbers, codes) in gold.items():
+            poems[key] = dict(records[key], line_numbers=line_numbers.tolist(),
+                              codes={classifier: codes[classifier].tolist() for classifier in GOLD_CLASSIFIERS})
+
+        tmp_path = store_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'version': GOLD_VERSION, 'labels': get_labels(), 'poems': poems}, file)
+        os.replace(tmp_path, store_path)
+
+    return gold
@@ -0,0 +1,90 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file holds the registry of the labels used in evaluation, so
+   that annotations can be scored as arrays of integer codes.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# label of lines without enjambment, and of enjambments left unclassified
+EMPTY = '[]'
+UNCLASSIFIED = 'None'
+
+# types each classifier can produce
+REGEX_TYPES = ['[cc_cross_clause]', '[pb_adj_adj]', '[pb_noun_adj]', '[pb_det_noun]', '[pb_noun_noun]',
+               '[pb_noun_prep]', '[pb_verb_adv]', '[pb_verb_chain]', '[pb_verb_prep]', '[pb_adv_adv]',
+               '[pb_to_verb]', '[pb_verb_cprep]', '[pb_comp]', '[pb_adj_adv]', '[ex_subj_verb]', '[ex_dobj_verb]']
+DEPENDENCY_TYPES = ['[pb_noun_noun]', '[pb_det_noun]', '[pb_noun_adj]', '[pb_verb_prep]', '[pb_verb_chain]',
+                    '[pb_adj_adv]', '[pb_verb_adv]', '[ex_dobj_verb]', '[ex_subj_verb]', '[pb_phrasal_verb]',
+                    '[cc_cross_clause]', '[pb_adj_prep]', '[pb_relword]', '[ex_verb_adjunct]', '[pb_noun_prep]']
+DICTIONARY_TYPES = ['[pb_phrasal_verb]', '[ex_dobj_pverb]']
+CLASSIFIER_TYPES = {'regex': REGEX_TYPES, 'dependencies': DEPENDENCY_TYPES, 'dictionary': DICTIONARY_TYPES}
+
+# labels are given codes in order of registration, see get_code
+_registry = {'labels': [], 'codes': {}}
+
+
+def get_code(label):
+    """
+        Return the integer code of a label, registering it if it is new.
+    """
+    code = _registry['codes'].get(label)
+    if code is None:
+        code = len(_registry['labels'])
+        _registry['labels'].append(label)
+        _registry['codes'][label] = code
+
+    return code
+
+
+def get_labels():
+    """
+        Return every label registered so far, by code.
+    """
+    return list(_registry['labels'])
+
+
+def encode(labels):
+    """
+        Convert labels into an array of codes.
+    """
+    import numpy as np
+
+    return np.array([get_code(label) for label in labels], dtype=np.int32)
+
+
+def decode(codes):
+    """
+        Convert an array of codes back into labels.
+    """
+    return [_registry['labels'][code] for code in codes]
+
+
+def filter_label(annotation, classifier):
+    """
+        Keep an automatic annotation only if the classifier can produce it.
+    """
+    if classifier == 'all' or annotation in CLASSIFIER_TYPES[classifier]:
+        return annotation
+
+    return EMPTY
+
+
+for known_label in [EMPTY, UNCLASSIFIED] + REGEX_TYPES + DEPENDENCY_TYPES + DICTIONARY_TYPES:
+    get_code(known_label)
+
+EMPTY_CODE = get_code(EMPTY)
+UNCLASSIFIED_CODE = get_code(UNCLASSIFIED)
@@ -0,0 +1,226 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the manifest kept in output directories, so that
+   directory runs can skip unchanged files and resume after a crash.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+from .utils import PHRASAL_VERBS, RULES_VERSION
+
+MANIFEST_NAME = '.jade_manifest.jsonl'
+
+
+def hash_file(path):
+    """
+        Compute the sha256 digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_model_version(model):
+    """
+        Read the version of a language model without loading it: from its
+        meta.json if it is given by path, from its package otherwise.
+
+        Returns
+        -------
+            version: str
+                None if the model cannot be found
+    """
+    meta_path = os.path.join(model, 'meta.json')
+    if os.path.isfile(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            return json.load(file).get('version')
+
+    try:
+        try:
+            from importlib import metadata
+            return metadata.version(model)
+        except ImportError:
+            import pkg_resources
+            return pkg_resources.get_distribution(model).version
+    except Exception:
+        return None
+
+
+def get_settings(nlp, model, classifier='all', parse_mode='pair'):
+    """
+        Gather everything, apart from the input itself, an annotation depends
+        on. A change in any of them invalidates the manifest entries.
+
+        Parameters
+        ----------
+            nlp:
+                spacy nlp pipeline
+            model: str
+                name of the language model, as given by the user
+            classifier: str
+                classifier whose output is kept
+            parse_mode: str
+                one of processing.PARSE_MODES
+
+        Returns
+        -------
+            settings: dict
+    """
+    meta = nlp.meta if nlp is not None else {}
+
+    return {'model': model,
+            'model_name': meta.get('lang', '') + '_' + meta.get('name', ''),
+            'model_version': meta.get('version', ''),
+            'rules_version': RULES_VERSION,
+            'lexicon': hash_file(PHRASAL_VERBS),
+            'classifier': classifier,
+            'parse_mode': parse_mode}
+
+
+def load_manifest(outdir):
+    """
+        Read the manifest of an output directory. The manifest is an append-only
+        JSONL log, the last record of a file being the one that holds.
+
+        Parameters
+        ----------
+            outdir: str
+                path to the output directory
+
+        Returns
+        -------
+            manifest: dict
+                {input key: record}
+    """
+    manifest = {}
+    path = os.path.join(outdir, MANIFEST_NAME)
+
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be truncated if a run was interrupted
+                    continue
+                manifest[record['key']] = record
+
+    return manifest
+
+
+def get_file_state(path, record=None):
+    """
+        Stat and hash an input file. The digest recorded in the manifest is
+        reused if neither the size nor the modification time changed.
+
+        Parameters
+        ----------
+            path: str
+                path to the input file
+            record: dict
+                manifest record of the file, if any
+
+        Returns
+        -------
+            state: dict
+                {size, mtime, hash}
+    """
+    stat = os.stat(path)
+    state = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    if record is not None and record.get('size') == state['size'] and record.get('mtime') == state['mtime']:
+        state['hash'] = record['hash']
+    else:
+        state['hash'] = hash_file(path)
+
+    return state
+
+
+def is_up_to_date(record, state, settings, export=None, text=True, outfile=None):
+    """
+        Whether a file was successfully annotated from the same content and
+        with the same settings, its outputs still being on disk: the annotated
+        file, if text output is required, and the shard it was exported to, 
+        if an export format is given. If outfile is given, the file must have
+        been annotated to it, so that a file whose output path changed is 
+        annotated again rather than left pointing at the output of another.
+    """
+    return record is not None \
+        and record.get('status') == 'done' \
+        and record.get('hash') == state['hash'] \
+        and record.get('settings') == settings \
+        and (not text or os.path.exists(record.get('outfile') or '')) \
+        and (not text or outfile is None 
+             or os.path.abspath(record.get('outfile') or '') == os.path.abspath(outfile)) \
+        and (export is None or (record.get('shard') or '').endswith('.' + export) 
+             and os.path.exists(record['shard']))
+
+
+def update_manifest(outdir, manifest, key, state, settings, outfile, error=None, shard=None):
+    """
+        Record the outcome of a file annotation. The record is appended and
+        flushed at once, so that an interrupted run can be resumed.
+
+        Parameters
+        ----------
+            outdir: str
+                path to the output directory
+            manifest: dict
+                manifest, as returned by load_manifest, updated in place
+            key: str
+                input key, ie path to the file relative to the input directory
+            state: dict
+                as returned by get_file_state
+            settings: dict
+                as returned by get_settings
+            outfile: str
+                path to the annotated file, None if it was only exported
+            error: str
+                why the file could not be annotated, if it failed
+            shard: str
+                path to the shard the annotation was exported to, if any
+    """
+    record = {'key': key, 'outfile': outfile, 'settings': settings,
+              'status': 'done' if error is None else 'failed'}
+    record.update(state or {})
+    if error is not None:
+        record['error'] = error
+    if shard is not None:
+        record['shard'] = shard
+
+    manifest[key] = record
+    with open(os.path.join(outdir, MANIFEST_NAME), 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record) + '\n')
+        file.flush()
+
+
+def compact_manifest(outdir, manifest):
+    """
+        Rewrite the manifest with a single record per file.
+    """
+    path = os.path.join(outdir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        for record in manifest.values():
+            file.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, path)
@@ -0,0 +1,148 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the annotation of a batch of files by a pool of
+   processes.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import multiprocessing
+from .corpus import get_source_size, is_sequential, read_source
+from .processing import annotate_poems, load_pipeline, render_poem, save_poem, BATCH_SIZE
+from .profiling import timed, Profiler
+
+# state of the worker processes. When processes are forked, the pipeline
+# loaded by the parent process is inherited and shared copy-on-write.
+_worker = {'nlp': None, 'cache': None, 'inherited': False, 'options': {}, 'profile': False, 'text': True, 
+           'lines': False}
+
+
+def _init_worker(model, options, profile=False, text=True, lines=False):
+    """
+        Load the pipeline, unless it was inherited from the parent process.
+    """
+    if not _worker['inherited']:
+        _worker['nlp'] = load_pipeline(model, options['classifier'])
+    _worker['options'] = options
+    _worker['profile'] = profile
+    _worker['text'] = text
+    _worker['lines'] = lines
+
+
+def _annotate_file(job):
+    """
+        Annotate a single file and save the result. Errors are returned rather
+        than raised so that a single file cannot abort the whole batch. When
+        profiling, what was collected is returned as well, and so are the 
+        LineAnnotation of the poem if the calling process asked for them.
+    """
+    infile, outfile = job
+    profiler = Profiler() if _worker['profile'] else None
+    lines = None
+    try:
+        poem = read_source(infile)
+
+        for _, lines in annotate_poems([(outfile, poem)], _worker['nlp'], cache=_worker['cache'], 
+                                       profiler=profiler, **_worker['options']):
+            if _worker['text']:
+                annotated_poem = timed(profiler, 'render_poem', render_poem, lines, _worker['options']['classifier'])
+                timed(profiler, 'save_poem', save_poem, annotated_poem, True, outfile, False, True)
+    except Exception as err:
+        return job, repr(err), profiler.get_stats() if profiler is not None else None, None
+
+    return job, None, profiler.get_stats() if profiler is not None else None, lines if _worker['lines'] else None
+
+
+def process_files(jobs, nlp, model, workers, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair', 
+                  cache=None, profiler=None, text=True, on_lines=None, cascade=False):
+    """
+        Annotate files with a pool of processes.
+
+        Larger files are scheduled first so that no worker is left with a
+        long poem when the others are done, unless they lie in a compressed
+        tar archive: they are then scheduled in the order of the archive, so
+        that each worker only ever seeks forward in the decompressed stream.
+        Where processes can be forked,
+        the pipeline already loaded is shared with the workers, otherwise
+        each worker loads the model once. Likewise, forked workers look up 
+        the parse cache as it was when the pool was started; what they parse
+        is not added to the persistent cache.
+
+        Parameters
+        ----------
+            jobs: list
+                (path to the poem or its source in a corpus, path to where the
+                result is saved) tuples. Workers are only handed the byte range
+                of the poems of anthologies, JSONL dumps and uncompressed tar
+                archives, which they read in place from a memory map.
+            nlp:
+                spacy nlp pipeline, loaded by the calling process
+            model: str
+                language model to be loaded by workers that cannot be forked
+            workers: int
+                number of processes
+            classifier: str
+                classifier whose output is to be kept
+            batch_size: int
+                number of texts parsed at once by spaCy
+            parse_mode: str
+                one of PARSE_MODES, see processing.get_parse_units
+            cache: ParseCache
+                persistent cache of spaCy analyses, if any
+            profiler: Profiler
+                if given, what the workers collect is merged into it
+            text: bool
+                whether annotated poems are saved. If not, they are only 
+                passed to on_lines.
+            on_lines: callable
+                if given, called by the calling process with the job and the 
+                LineAnnotation of the poem, once the poem is annotated
+            cascade: bool
+                whether the classifiers are run as a cascade, see 
+                processing.annotate_poems
+
+        Yields
+        ------
+            job: tuple
+                each job, as soon as its file has been saved
+            error: str
+                why the file could not be annotated, None if it was
+    """
+    if not any(is_sequential(job[0]) for job in jobs):
+        jobs = sorted(jobs, key=lambda job: get_source_size(job[0]), reverse=True)
+    options = {'classifier': classifier, 'batch_size': batch_size, 'parse_mode': parse_mode, 'cascade': cascade}
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        _worker['nlp'] = nlp
+        _worker['cache'] = cache
+        _worker['inherited'] = True
+    else:
+        context = multiprocessing.get_context('spawn')
+
+    try:
+        initargs = (model, options, profiler is not None, text, on_lines is not None)
+        with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            for job, error, stats, lines in pool.imap_unordered(_annotate_file, jobs):
+                if stats is not None:
+                    profiler.merge(stats)
+                if lines is not None:
+                    on_lines(job, lines)
+                yield job, error
+    finally:
+        _worker['nlp'] = None
+        _worker['cache'] = None
+        _worker['inherited'] = False
@@ -23,10 +23,103 @@ import os
 import pathlib
 import sys
 import re
-from fuzzywuzzy import fuzz
-import spacy
+import time
+from bisect import bisect_left
+from collections import deque
+from itertools import chain, islice
+from .labels import EMPTY
+from .profiling import timed
 from .utils import get_pos_type, get_dep_type, detect_phrasal_verb
 
+# number of line pairs handed to spaCy at once
+BATCH_SIZE = 256
+# line pairs are parsed on their own, or retrieved from their poem or stanza
+PARSE_MODES = ['pair', 'poem', 'stanza']
+CLASSIFIERS = ['all', 'dependencies', 'regex', 'dictionary']
+# number of lines held at once when a poem is streamed, see annotate_lines
+STREAM_CHUNK_SIZE = 4096
+# components that can be left out, depending on the classifier (None: no model at all)
+OPTIONAL_COMPONENTS = ['parser', 'ner', 'entity_ruler', 'entity_linker', 'textcat', 'lemmatizer', 'senter']
+CLASSIFIER_COMPONENTS = {'all': ['parser'], 'dependencies': ['parser'], 'regex': [], 'dictionary': None}
+
+
+def load_pipeline(model, classifier='all'):
+    """
+        Load the spaCy model with only the components the classifier needs. 
+
+        The regex classifier only needs POS and tags, the dependency one needs
+        the parser as well, and the dictionary one does not need any model.
+
+        Parameters
+        ----------
+            model: str
+                name of or path to the language model
+            classifier: str
+                classifier to be run
+
+        Returns
+        -------
+            nlp:
+                spacy nlp pipeline, None if no model is needed
+    """
+    needed = CLASSIFIER_COMPONENTS[classifier]
+    if needed is None: 
+        return None
+
+    import spacy
+
+    return spacy.load(model, disable=[name for name in OPTIONAL_COMPONENTS if name not in needed])
+
+
+def get_parser(nlp):
+    """
+        Return the dependency parser of the pipeline, None if it has none.
+    """
+    if nlp is None or 'parser' not in nlp.pipe_names:
+        return None
+
+    return nlp.get_pipe('parser')
+
+
+def pipe_without_parser(texts, nlp, batch_size=BATCH_SIZE):
+    """
+        Same as nlp.pipe(texts, as_tuples=True), every component of the 
+        pipeline but the parser being run, so that texts are tokenized and 
+        tagged only. The parser is run later on the texts that need it, see
+        set_dependency_types.
+
+        Parameters
+        ----------
+            texts: iterable
+                (text, context) tuples
+            nlp:
+                spacy nlp pipeline
+            batch_size: int
+                number of texts handed to each component at once
+
+        Yields
+        ------
+            doc: Doc
+                the tagged text
+            context:
+                the context the text was given with
+    """
+    contexts = deque()
+
+    def make_docs():
+        for text, context in texts:
+            contexts.append(context)
+            yield nlp.make_doc(text)
+
+    docs = make_docs()
+    for name, component in nlp.pipeline:
+        if name == 'parser':
+            continue
+        docs = component.pipe(docs, batch_size=batch_size) if hasattr(component, 'pipe') else map(component, docs)
+
+    for doc in docs:
+        yield doc, contexts.popleft()
+
 
 def get_poem_lines(poem):
     return poem.split('\n')
@@ -94,6 +187,8 @@ def fuzzy_enjambment_matching(enjambment_line, poem_sentences):
             sentence: str
                 The sentence in which occurs the enjambment
     """
+    from fuzzywuzzy import fuzz
+
     for sentence in poem_sentences:
         ratio = fuzz.token_set_ratio(enjambment_line, sentence)
         if ratio > 75:
@@ -115,13 +210,13 @@ def remove_annotations(poem):
                 The text of the poem
     """
     lines = re.findall(r'(^\d{1,}\. )(.*)(\n\n)?', poem, flags=re.MULTILINE)
-    text = ""
+    text = []
     for line in lines: 
-        text += line[1] + '\n'
+        text.append(line[1] + '\n')
         if '\n\n' in line: 
-            text += '\n'
+            text.append('\n')
 
-    return text
+    return ''.join(text)
 
 
 def handle_multiclassification(dependency_types):
@@ -173,111 +268,574 @@ def handle_multiclassification(dependency_types):
     return dependency_types
                         
 
-def processor(file, save, outfile, nlp, classifier='all', is_eval=False, is_dir=False):
+def prepare_poem(poem):
     """
-        Execute the whole preprocessing module. 
-
-        Split the poem into lines, then check whether a line end-stopped. 
-        If not, checks if the line is contained into a given sentence, then the 
-        sentence is tagged and regex are ran against  spacy POS and tags. 
-
-        If there is a match (or several), an annotation is added to the end of 
-        the line. 
+        Remove manual annotations if any, then split the poem into lines and 
+        collect every line pair that has to be parsed. 
 
-        Finally, the poem is reconstructed, unfortunately removing the blanks 
-        between stanzas 
-        (at least for now).
+        A line pair is built for every run-on line: it is made of the line 
+        and the next one, or the first line of the next stanza if the line 
+        ends a stanza. 
 
         Parameters
         ----------
-            file: TextIOWrapper
-                poem file to process
-            save: bool
-                whether the file is to be printed to cmd or save to disk
-            outfile: str
-                path to where the result will be saved
-            nlp: 
-                spacy nlp pipeline
-    """
-    filename = str(file)[31:]
-
-    poem = file.read()
+            poem: str
+                the poem as read from the file
 
+        Returns
+        -------
+            poem_lines: list
+                lines of the poem
+            pairs: list
+                (line index, line pair, is_end_of_stanza) for each run-on line
+    """
     if re.findall(r'(^\d{1,}\. )(.*)', poem, flags=re.MULTILINE):
         poem = remove_annotations(poem)
-    
-    preprocessed_poem = nlp(poem)
+
     poem_lines = get_poem_lines(poem)
     if not poem_lines[-1] == '\n':
         poem_lines.append('\n')
-        
-    # poem_sentences = [str(sent) for sent in preprocessed_poem.sents]
-        transformed_lines = []
-
-    for i in range(len(poem_lines)+1):
-        if i < len(poem_lines)-1: 
-            line = poem_lines[i].strip()
-            is_end_of_stanza = False
-
-            if len(line) > 1:
-                if is_enjambment(line):
-                    if poem_lines[i+1] != '':
-                        line_pair = poem_lines[i] + '\n' + poem_lines[i+1]
-                    else:
-                        line_pair = poem_lines[i] + '\n' + poem_lines[i+2]
-                        is_end_of_stanza = True
-                    
-                    line_break = line_pair.index('\n')
-                    last_word_before_enjambment = line_break - 1
-                    line_pair = line_pair.replace('\n', '\t')
-                    phrasal = detect_phrasal_verb(line_pair)
-    
-                    # better results were obtained with only the line-pair part of the sentence
-                    # so it is used instead of the whole sentence
-                    tagged_sentence = nlp(line_pair.lower())
-                    #TODO: change list to dict so that it is easier to read utils (/!\ effets de bord dans utils)
-                    sentence_part_of_speech = [(token, str(token.pos_), str(token.tag_)) for token in tagged_sentence]
-                    dependency_dict = {token.text : (str(token.dep_), str(token.pos_), str(token.tag_), token.head.text,
-                                                    token.head.pos_, [str(child) for child in token.children]) 
-                                        for token in tagged_sentence}
-                    pos_types = get_pos_type(sentence_part_of_speech)
-                    dep_types = list(set(get_dep_type(dependency_dict)))
-
-                    if len(dep_types) > 1:
-                        dep_types = handle_multiclassification(dep_types)
-                    
-                    if classifier == 'all':
-                        # TODO: choose between pos and dep tag if both are > 0 ?
-                        if len(phrasal) > 0:
-                            line += ' [' + str(', '.join(phrasal)) + ']'
-                        elif len(pos_types) > 0 and len(dep_types) == 0:
-                            if 'pb_verb_prep' in pos_types and 'ex_verb_adjunct' in dep_types: 
-                                line += '[' + str(', '.join(dep_types))
-                            else:
-                                line += ' [' + str(','.join(pos_types)) + ']'
-                        elif len(dep_types) > 0 and len(pos_types) == 0: 
-                            line += ' [' + str(', '.join(dep_types)) + ']'
-                        elif len(dep_types) > 0 and len(pos_types) > 0:
-                            line += ' [' + str(', '.join(pos_types)) + ']'
-
-                    elif classifier == 'dependencies': 
-                        if len(dep_types) > 0:
-                            line += ' [' + str(', '.join(dep_types)) + ']'
-
-                    elif classifier == 'regex': 
-                        if len(pos_types) > 0:
-                            line += ' [' + str(','.join(pos_types)) + ']'
-
-                    elif classifier == 'dictionary': 
-                        if len(phrasal) > 0:
-                            line += ' [' + str(','.join(phrasal)) + ']'
-                
-                    if is_end_of_stanza: 
-                        line += '\n'
-                    
-            transformed_lines.append(line)
-
-            
+
+    pairs = []
+    for i in range(len(poem_lines)-1):
+        line = poem_lines[i].strip()
+
+        if len(line) > 1 and is_enjambment(line):
+            if poem_lines[i+1] != '':
+                line_pair = poem_lines[i] + '\n' + poem_lines[i+1]
+                is_end_of_stanza = False
+            else:
+                line_pair = poem_lines[i] + '\n' + poem_lines[i+2]
+                is_end_of_stanza = True
+
+            pairs.append((i, line_pair.replace('\n', '\t'), is_end_of_stanza))
+
+    return poem_lines, pairs
+
+
+def get_parse_units(poem_lines, pairs, parse_mode='pair'):
+    """
+        Build the texts to be parsed by spaCy for a given poem. 
+
+        In `pair` mode, each line pair is parsed on its own. In `poem` mode,
+        the whole poem is parsed once and each line pair is retrieved from 
+        the poem Doc using character offsets. `stanza` mode does the same 
+        stanza by stanza, pairs spanning two stanzas being parsed on their own.
+        Interior lines are thus parsed once instead of twice.
+
+        Parameters
+        ----------
+            poem_lines: list
+                lines of the poem, as returned by prepare_poem
+            pairs: list
+                line pairs, as returned by prepare_poem
+            parse_mode: str
+                one of PARSE_MODES
+
+        Returns
+        -------
+            units: list
+                (text, targets) tuples, where targets is a list of (pair 
+                position, start offset, end offset). Offsets are None when 
+                the whole text is the line pair.
+    """
+    if parse_mode not in PARSE_MODES:
+        raise ValueError('Unknown parse mode: ' + str(parse_mode))
+
+    if parse_mode == 'pair':
+        return [(pair[1].lower(), [(k, None, None)]) for k, pair in enumerate(pairs)]
+
+    if parse_mode == 'poem': 
+        blocks = [(0, len(poem_lines))]
+    else: 
+        blocks = []
+        start = None
+        for i, line in enumerate(poem_lines):
+            if line != '' and start is None:
+                start = i
+            elif line == '' and start is not None:
+                blocks.append((start, i))
+                start = None
+        if start is not None:
+            blocks.append((start, len(poem_lines)))
+
+    lowered_lines = [line.lower() for line in poem_lines]
+    units = []
+    for start, end in blocks:
+        line_offsets = {}
+        offset = 0
+        for i in range(start, end):
+            line_offsets[i] = offset
+            offset += len(lowered_lines[i]) + 1
+        units.append(('\n'.join(lowered_lines[start:end]), []))
+        for k, (i, _, is_end_of_stanza) in enumerate(pairs):
+            next_line = i + 2 if is_end_of_stanza else i + 1
+            if start <= i and next_line < end: 
+                units[-1][1].append((k, line_offsets[i], line_offsets[next_line] + len(lowered_lines[next_line])))
+
+    covered = set(target[0] for _, targets in units for target in targets)
+    units = [unit for unit in units if len(unit[1]) > 0]
+    for k, pair in enumerate(pairs):
+        if k not in covered:
+            units.append((pair[1].lower(), [(k, None, None)]))
+
+    return units
+
+
+def get_pair_views(units, docs, number_of_pairs):
+    """
+        Retrieve the part of the parsed texts corresponding to each line pair.
+
+        Parameters
+        ----------
+            units: list
+                texts parsed, as returned by get_parse_units
+            docs: list
+                parsed texts, in the same order as units (None when no 
+                model is used)
+            number_of_pairs: int
+                number of line pairs in the poem
+
+        Returns
+        -------
+            views: list
+                one spaCy Span per line pair
+    """
+    views = [None] * number_of_pairs
+    for (_, targets), doc in zip(units, docs):
+        if doc is None:
+            continue
+        token_starts = [token.idx for token in doc]
+        for k, start, end in targets: 
+            if start is None:
+                views[k] = doc[:]
+            else:
+                views[k] = doc[bisect_left(token_starts, start):bisect_left(token_starts, end)]
+
+    return views
+
+
+def get_token_text(token):
+    """
+        Return the token text, a line break being always represented by a 
+        tab, as it is in line pairs parsed on their own.
+    """
+    if token.is_space and '\n' in token.text:
+        return '\t'
+
+    return token.text
+
+
+def get_dependency_arrays(tagged_sentence):
+    """
+        Gather the token attributes the dependency classifier relies on, 
+        token by token, from a single export of the parse.
+
+        Parameters
+        ----------
+            tagged_sentence: Span
+                the lowercased line pair, as parsed by spaCy
+
+        Returns
+        -------
+            arrays: tuple
+                deps, pos, tags, heads, words and enjambment_index, as 
+                expected by utils.get_dep_type. Heads are indices in the line 
+                pair, -1 if the head lies outside of it.
+    """
+    from spacy.attrs import DEP, HEAD, POS, TAG
+
+    strings = tagged_sentence.vocab.strings
+    array = tagged_sentence.to_array([DEP, POS, TAG, HEAD])
+    length = len(array)
+
+    deps = [strings[int(dep)] for dep in array[:, 0]]
+    pos = [strings[int(pos)] for pos in array[:, 1]]
+    tags = [strings[int(tag)] for tag in array[:, 2]]
+    # heads are exported relative to the token, as unsigned integers
+    heads = [index + relative_head if 0 <= index + relative_head < length else -1 
+             for index, relative_head in enumerate(array[:, 3].astype('int64').tolist())]
+    words = [get_token_text(token) for token in tagged_sentence]
+
+    try:
+        enjambment_index = words.index('\t')
+    except ValueError:
+        enjambment_index = None
+
+    return deps, pos, tags, heads, words, enjambment_index
+
+
+def get_phrasal_types(line_pair, profiler=None):
+    """
+        Run the dictionary classifier against a line pair.
+    """
+    return timed(profiler, 'detect_phrasal_verb', detect_phrasal_verb, line_pair)
+
+
+def get_regex_types(tagged_sentence, profiler=None):
+    """
+        Run the regex classifier against a tagged line pair, which only relies
+        on POS and tags.
+    """
+    #TODO: change list to dict so that it is easier to read utils (/!\ effets de bord dans utils)
+    sentence_part_of_speech = [(token, str(token.pos_), str(token.tag_)) for token in tagged_sentence]
+
+    return timed(profiler, 'get_pos_type', get_pos_type, sentence_part_of_speech)
+
+
+def get_dependency_types(tagged_sentence, profiler=None):
+    """
+        Run the dependency classifier against a parsed line pair.
+    """
+    # heads outside of the line pair are ignored
+    arrays = timed(profiler, 'get_dependency_arrays', get_dependency_arrays, tagged_sentence)
+    dep_types = list(dict.fromkeys(timed(profiler, 'get_dep_type', get_dep_type, *arrays)))
+
+    if len(dep_types) > 1:
+        dep_types = timed(profiler, 'handle_multiclassification', handle_multiclassification, dep_types)
+
+    return dep_types
+
+
+def classify_line_pair(line_pair, tagged_sentence, classifier='all', profiler=None):
+    """
+        Run the classifiers against a line pair. Only the classifiers whose 
+        output is to be kept are run.
+
+        Parameters
+        ----------
+            line_pair: str
+                line pair, the line break being replaced by a tab
+            tagged_sentence: Span
+                the lowercased line pair, as parsed by spaCy, either on its own
+                or as part of its poem. None if no model is needed.
+            classifier: str
+                classifier whose output is to be kept
+            profiler: Profiler
+                if given, the classifiers are timed and their output counted
+
+        Returns
+        -------
+            phrasal: list
+                types detected by the dictionary classifier
+            pos_types: list
+                types detected by the regex classifier
+            dep_types: list
+                types detected by the dependency classifier
+    """
+    phrasal = []
+    pos_types = []
+    dep_types = []
+
+    if classifier in ['all', 'dictionary']:
+        phrasal = get_phrasal_types(line_pair, profiler)
+
+    if classifier in ['all', 'regex']:
+        pos_types = get_regex_types(tagged_sentence, profiler)
+
+    if classifier in ['all', 'dependencies']:
+        dep_types = get_dependency_types(tagged_sentence, profiler)
+
+    return phrasal, pos_types, dep_types
+
+
+def get_line_label(phrasal, pos_types, dep_types, classifier='all'):
+    """
+        Choose the types retained for the given classifier and format them as
+        the label of the line.
+
+        Parameters
+        ----------
+            phrasal: list
+                types detected by the dictionary classifier
+            pos_types: list
+                types detected by the regex classifier
+            dep_types: list
+                types detected by the dependency classifier
+            classifier: str
+                classifier whose output is to be kept
+
+        Returns
+        -------
+            label: str
+                types between brackets, None if no type is retained
+    """
+    if classifier == 'all':
+        # TODO: choose between pos and dep tag if both are > 0 ?
+        if len(phrasal) > 0:
+            return '[' + str(', '.join(phrasal)) + ']'
+        elif len(pos_types) > 0:
+            return '[' + str(','.join(pos_types)) + ']'
+        elif len(dep_types) > 0:
+            return '[' + str(', '.join(dep_types)) + ']'
+
+    elif classifier == 'dependencies': 
+        if len(dep_types) > 0:
+            return '[' + str(', '.join(dep_types)) + ']'
+
+    elif classifier == 'regex': 
+        if len(pos_types) > 0:
+            return '[' + str(','.join(pos_types)) + ']'
+
+    elif classifier == 'dictionary': 
+        if len(phrasal) > 0:
+            return '[' + str(','.join(phrasal)) + ']'
+
+    return None
+
+
+def annotate_line(line, phrasal, pos_types, dep_types, classifier='all'):
+    """
+        Append the types retained for the given classifier to the line, see
+        get_line_label.
+
+        Parameters
+        ----------
+            line: str
+                the (stripped) run-on line
+            phrasal: list
+                types detected by the dictionary classifier
+            pos_types: list
+                types detected by the regex classifier
+            dep_types: list
+                types detected by the dependency classifier
+            classifier: str
+                classifier whose output is to be kept
+
+        Returns
+        -------
+            line: str
+                annotated line
+    """
+    label = get_line_label(phrasal, pos_types, dep_types, classifier)
+    if label is not None:
+        line += ' ' + label
+
+    return line
+
+
+class LineAnnotation:
+    """
+        Annotation of a line of a poem, see annotate_poems.
+
+        Attributes
+        ----------
+            number: int
+                position of the line among the non-blank lines of the poem, 
+                starting from 1 as in the annotated test data. None for blank
+                lines.
+            text: str
+                the line, stripped
+            run_on: bool
+                whether the line is run-on, in which case its line pair was
+                classified
+            labels: dict
+                {classifier: types} for each classifier run against the line
+                pair (`dictionary`, `regex` and/or `dependencies`), see 
+                set_line_types. Empty if the line is end-stopped.
+            stanza_end: bool
+                whether the line is followed by a blank line
+    """
+    __slots__ = ['number', 'text', 'run_on', 'labels', 'stanza_end']
+
+    def __init__(self, number, text, run_on=False, labels=None, stanza_end=False):
+        self.number = number
+        self.text = text
+        self.run_on = run_on
+        self.labels = labels if labels is not None else {}
+        self.stanza_end = stanza_end
+
+    def __repr__(self):
+        return 'LineAnnotation(%r, %r, run_on=%r, labels=%r, stanza_end=%r)' \
+            % (self.number, self.text, self.run_on, self.labels, self.stanza_end)
+
+    def to_dict(self):
+        """
+            Return the annotation as a JSON-serialisable dict.
+        """
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @staticmethod
+    def from_dict(record):
+        """
+            Build an annotation back from the output of to_dict.
+        """
+        return LineAnnotation(record['number'], record['text'], record['run_on'], record['labels'], 
+                              record['stanza_end'])
+
+    def annotate(self, classifier='all'):
+        """
+            Return the line followed by the types retained for the given 
+            classifier, as written in annotated poems.
+        """
+        if not self.run_on:
+            return self.text
+
+        return annotate_line(self.text, self.labels.get('dictionary', []), self.labels.get('regex', []), 
+                             self.labels.get('dependencies', []), classifier)
+
+    def get_label(self, classifier='all'):
+        """
+            Return the types retained for the given classifier, between 
+            brackets as in annotated poems. EMPTY if the line is not annotated.
+        """
+        label = get_line_label(self.labels.get('dictionary', []), self.labels.get('regex', []), 
+                               self.labels.get('dependencies', []), classifier) if self.run_on else None
+
+        return label if label is not None else EMPTY
+
+    def get_source(self, classifier='all'):
+        """
+            Return the classifier whose types annotate the line for the given
+            classifier, following the priorities of annotate_line. None if 
+            the line is not annotated.
+        """
+        names = ['dictionary', 'regex', 'dependencies'] if classifier == 'all' else [classifier]
+        for name in names:
+            if self.run_on and len(self.labels.get(name, [])) > 0:
+                return name
+
+        return None
+
+
+def get_line_annotations(poem_lines, pairs, views, classifier='all', profiler=None, deferred=None):
+    """
+        Classify the line pairs of a poem.
+
+        Parameters
+        ----------
+            poem_lines: list
+                lines of the poem, as returned by prepare_poem
+            pairs: list
+                line pairs, as returned by prepare_poem
+            views: list
+                parsed line pairs, in the same order as pairs
+            classifier: str
+                classifier whose output is to be kept
+            profiler: Profiler
+                if given, the classifiers are timed, see classify_line_pair
+            deferred: list
+                if given, the classifiers are run as a cascade, see 
+                set_line_types
+
+        Returns
+        -------
+            lines: list
+                one LineAnnotation per line of the poem, blank lines included
+    """
+    parsed_pairs = {pair[0]: (pair, view) for pair, view in zip(pairs, views)}
+    lines = []
+    number = 0
+
+    for i in range(len(poem_lines)-1):
+        text = poem_lines[i].strip()
+        if len(text) > 0:
+            number += 1
+        line = LineAnnotation(number if len(text) > 0 else None, text, stanza_end=poem_lines[i+1] == '')
+
+        if i in parsed_pairs:
+            (_, line_pair, _), tagged_sentence = parsed_pairs[i]
+            # better results were obtained with only the line-pair part of the sentence
+            # so it is used instead of the whole sentence
+            set_line_types(line, line_pair, tagged_sentence, classifier, profiler, deferred)
+
+        lines.append(line)
+
+    return lines
+
+
+def set_line_types(line, line_pair, tagged_sentence, classifier='all', profiler=None, deferred=None):
+    """
+        Mark a line as run-on and record the types its line pair is given by
+        the classifiers, see classify_line_pair.
+
+        If deferred is given, the classifiers of the `all` classifier are run
+        as a cascade, in the order annotate_line gives them priority, and stop
+        as soon as the types retained for the line are known: the regex 
+        classifier only runs if the dictionary one found nothing, the 
+        dependency classifier if neither did. The latter being the only one 
+        that needs the parse, such lines are appended to deferred along with 
+        their line pair instead, see set_dependency_types. Labels then only 
+        hold the classifiers that were run, which annotate the line as all 
+        three would.
+    """
+    line.run_on = True
+    if deferred is None or classifier != 'all':
+        types = classify_line_pair(line_pair, tagged_sentence, classifier, profiler)
+        line.labels = {name: name_types for name, name_types in zip(['dictionary', 'regex', 'dependencies'], types) 
+                       if classifier in ['all', name]}
+        return
+
+    line.labels = {'dictionary': get_phrasal_types(line_pair, profiler)}
+    if len(line.labels['dictionary']) == 0:
+        line.labels['regex'] = get_regex_types(tagged_sentence, profiler)
+        if len(line.labels['regex']) == 0:
+            deferred.append((line, tagged_sentence))
+
+
+def set_dependency_types(deferred, parser=None, batch_size=BATCH_SIZE, profiler=None):
+    """
+        Record the types the dependency classifier gives the lines the 
+        cascade of set_line_types left undecided.
+
+        Parameters
+        ----------
+            deferred: list
+                (LineAnnotation, line pair) tuples, see set_line_types
+            parser:
+                spaCy parser (see get_parser), to be run first when the line 
+                pairs were only tagged (see pipe_without_parser). Texts are 
+                parsed by batches, once whatever the number of their line 
+                pairs, and in place so that line pairs are parsed as well.
+            batch_size: int
+                number of texts parsed at once by spaCy
+            profiler: Profiler
+                if given, parsing and classifiers are timed and the line pairs
+                that needed the parser counted
+    """
+    if parser is not None:
+        docs = list({id(tagged_sentence.doc): tagged_sentence.doc for _, tagged_sentence in deferred}.values())
+        parsed = parser.pipe(docs, batch_size=batch_size) if hasattr(parser, 'pipe') else map(parser, docs)
+        if profiler is not None:
+            parsed = profiler.iterate('parse_dependencies', parsed)
+        for _ in parsed:
+            pass
+
+    start = time.perf_counter()
+    for line, tagged_sentence in deferred:
+        line.labels['dependencies'] = get_dependency_types(tagged_sentence, profiler)
+
+    if profiler is not None:
+        if len(deferred) > 0:
+            profiler.add('get_line_annotations', time.perf_counter() - start)
+        profiler.count('pairs needing the parser', len(deferred))
+
+
+def render_poem(lines, classifier='all'):
+    """
+        Rebuild the poem, adding an annotation at the end of each run-on line.
+
+        Parameters
+        ----------
+            lines: list
+                LineAnnotation of every line of the poem
+            classifier: str
+                classifier whose output is to be kept
+
+        Returns
+        -------
+            poem: str
+                the annotated poem
+    """
+    transformed_lines = []
+
+    for line in lines:
+        annotated_line = line.annotate(classifier)
+        if line.run_on and line.stanza_end: 
+            annotated_line += '\n'
+
+        transformed_lines.append(annotated_line)
+
     # Merge lines together back so that we have something readable
     poem = '\n'.join(transformed_lines)
     # because we keep stanzas, some file ends with multiple \n; messing with eval
@@ -289,6 +847,421 @@ def processor(file, save, outfile, nlp, classifier='all', is_eval=False, is_dir=
     # same but between stanzas
     poem = poem.replace('\n\n\n', '\n\n')
 
+    return poem
+
+
+def annotate_poems(poems, nlp, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair', on_error=None, 
+                   cache=None, profiler=None, cascade=False):
+    """
+        Classify the run-on lines of a stream of poems. 
+
+        Processing is done in two phases: the line pairs of every poem are 
+        first collected, then parsed by batches through nlp.pipe, which is 
+        much faster than parsing each pair separately. Pairs from different 
+        poems share batches, so that short poems do not prevent batching. 
+        Poems are yielded in the order they were given as soon as all their
+        line pairs have been parsed. 
+
+        With cascade, the `all` classifier stops at the first classifier that
+        finds types (see set_line_types), and texts are only tagged at first.
+        The parser is then run by batches on the texts holding line pairs 
+        neither the dictionary nor the regex classifier could classify, poems
+        waiting for it meanwhile. Poems are annotated as they would be 
+        otherwise.
+
+        Parameters
+        ----------
+            poems: iterable
+                (key, poem) tuples, key being anything identifying the poem
+            nlp: 
+                spacy nlp pipeline, see load_pipeline. None for the dictionary
+                classifier, which does not need any model.
+            classifier: str
+                classifier whose output is to be kept
+            batch_size: int
+                number of texts parsed at once by spaCy
+            parse_mode: str
+                whether line pairs are parsed on their own (`pair`), or 
+                retrieved from the parse of their poem (`poem`) or of their
+                stanza (`stanza`). See get_parse_units.
+            on_error: callable
+                if given, called with the key of the poem and the exception 
+                when a poem cannot be processed, the poem being skipped. 
+                Otherwise, the exception is raised.
+            cache: ParseCache
+                if given, texts already parsed are retrieved from the cache 
+                instead of being parsed again
+            profiler: Profiler
+                if given, each stage is timed and lines, run-on lines and line
+                pairs are counted
+            cascade: bool
+                whether the classifiers of the `all` classifier are run as a
+                cascade, labels only holding those that were run. Default to
+                False.
+
+        Yields
+        ------
+            key: 
+                the key the poem was given with
+            lines: list
+                one LineAnnotation per line of the poem
+    """
+    pending = deque()
+    cascade = cascade and classifier == 'all' and nlp is not None
+    parser = get_parser(nlp) if cascade and cache is None else None
+    # poems waiting for the dependency classifier, see set_dependency_types
+    waiting = deque()
+    deferred = []
+
+    def parse_units():
+        for key, poem in poems:
+            try:
+                poem_lines, pairs = timed(profiler, 'prepare_poem', prepare_poem, poem)
+                units = timed(profiler, 'get_parse_units', get_parse_units, poem_lines, pairs, parse_mode)
+            except Exception as err:
+                if on_error is None:
+                    raise
+                on_error(key, err)
+                continue
+            entry = (key, poem_lines, pairs, units, [])
+            pending.append(entry)
+            for text, _ in units:
+                yield text, entry[4]
+
+    def completed():
+        while pending and len(pending[0][4]) == len(pending[0][3]):
+            key, poem_lines, pairs, units, docs = pending.popleft()
+            poem_deferred = [] if cascade else None
+            try:
+                views = timed(profiler, 'get_pair_views', get_pair_views, units, docs, len(pairs))
+                lines = timed(profiler, 'get_line_annotations', get_line_annotations, poem_lines, pairs, views, 
+                              classifier, profiler, poem_deferred)
+            except Exception as err:
+                if on_error is None:
+                    raise
+                on_error(key, err)
+                continue
+            if profiler is not None:
+                profiler.count('poems')
+                profiler.count('lines', sum(1 for line in lines if line.number is not None))
+                profiler.count('run-on lines', len(pairs))
+            if not poem_deferred and not waiting:
+                yield key, lines
+                continue
+            waiting.append((key, lines))
+            deferred.extend(poem_deferred)
+            if len(deferred) >= batch_size:
+                yield from classified()
+
+    def classified():
+        try:
+            set_dependency_types(deferred, parser, batch_size, profiler)
+        except Exception as err:
+            if on_error is None:
+                raise
+            while waiting:
+                on_error(waiting.popleft()[0], err)
+        deferred.clear()
+        while waiting:
+            yield waiting.popleft()
+
+    if nlp is None:
+        parsed_units = ((None, context) for _, context in parse_units())
+    elif parser is not None:
+        parsed_units = pipe_without_parser(parse_units(), nlp, batch_size)
+    elif cache is None:
+        parsed_units = nlp.pipe(parse_units(), as_tuples=True, batch_size=batch_size)
+    else: 
+        parsed_units = cache.pipe(parse_units(), nlp, batch_size)
+
+    if profiler is not None and nlp is not None:
+        # texts to be parsed are prepared as nlp.pipe consumes them
+        parsed_units = profiler.iterate('parse', parsed_units, nested=['prepare_poem', 'get_parse_units'])
+
+    for doc, docs in parsed_units:
+        docs.append(doc)
+        yield from completed()
+
+    yield from completed()
+    if cascade:
+        yield from classified()
+
+
+def process_poems(poems, nlp, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair', on_error=None, 
+                  cache=None, profiler=None, cascade=False):
+    """
+        Annotate a stream of poems, see annotate_poems for the parameters.
+
+        Yields
+        ------
+            key: 
+                the key the poem was given with
+            poem: str
+                the annotated poem
+    """
+    for key, lines in annotate_poems(poems, nlp, classifier, batch_size, parse_mode, on_error, cache, profiler, 
+                                     cascade):
+        yield key, timed(profiler, 'render_poem', render_poem, lines, classifier)
+
+
+def iter_poem_lines(file):
+    """
+        Lazily split a poem file into lines, manual annotations being removed
+        if any, as prepare_poem does on the whole poem.
+
+        The file is read twice: once to find out whether it holds manual 
+        annotations, which are then removed from every line, and once to 
+        split it.
+
+        Parameters
+        ----------
+            file: TextIOWrapper
+                poem file, which must be seekable
+
+        Yields
+        ------
+            line: str
+                lines of the poem, as given by get_poem_lines
+    """
+    numbered_line = re.compile(r'\d{1,}\. (.*)')
+    start = file.tell()
+    is_annotated = any(numbered_line.match(line) for line in file)
+    file.seek(start)
+
+    if not is_annotated:
+        ends_with_newline = True
+        for line in file:
+            ends_with_newline = line.endswith('\n')
+            yield line[:-1] if ends_with_newline else line
+        if ends_with_newline:
+            yield ''
+        return
+
+    # see remove_annotations: numbered lines only, followed by a blank line
+    # if they were in the annotated poem
+    previous = None
+    for line in file:
+        match = numbered_line.match(previous) if previous is not None else None
+        if match:
+            yield match.group(1)
+            if line == '\n':
+                yield ''
+        previous = line
+    match = numbered_line.match(previous) if previous is not None else None
+    if match:
+        yield match.group(1)
+    yield ''
+
+
+def annotate_lines(poem_lines, nlp, classifier='all', batch_size=BATCH_SIZE, cache=None, profiler=None, 
+                   chunk_size=STREAM_CHUNK_SIZE, cascade=False):
+    """
+        Classify the run-on lines of a poem given line by line, so that 
+        memory does not depend on the length of the poem. 
+
+        Line pairs are built with a window of three lines, the line, the next 
+        one and the one after it for stanza ends, as prepare_poem does. Lines 
+        are then classified by chunks, line pairs being parsed on their own 
+        (`pair` parse mode).
+
+        Parameters
+        ----------
+            poem_lines: iterable
+                lines of the poem, see iter_poem_lines
+            nlp: 
+                spacy nlp pipeline, None for the dictionary classifier
+            classifier: str
+                classifier whose output is to be kept
+            batch_size: int
+                number of texts parsed at once by spaCy
+            cache: ParseCache
+                if given, texts already parsed are retrieved from the cache
+            profiler: Profiler
+                if given, each stage is timed and lines and run-on lines are 
+                counted
+            chunk_size: int
+                number of lines classified at once
+            cascade: bool
+                whether the classifiers of the `all` classifier are run as a
+                cascade, see annotate_poems
+
+        Yields
+        ------
+            line: LineAnnotation
+                one per line of the poem, blank lines included
+    """
+    poem_lines = chain(poem_lines, ['\n'])
+    window = deque(islice(poem_lines, 3))
+    chunk = []
+    number = 0
+
+    while len(window) > 1:
+        text = window[0].strip()
+        if len(text) > 0:
+            number += 1
+        line = LineAnnotation(number if len(text) > 0 else None, text, stanza_end=window[1] == '')
+
+        line_pair = None
+        if len(text) > 1 and is_enjambment(text):
+            next_line = window[1] if window[1] != '' else window[2]
+            line_pair = (window[0] + '\n' + next_line).replace('\n', '\t')
+        chunk.append((line, line_pair))
+
+        if len(chunk) >= chunk_size:
+            yield from annotate_chunk(chunk, nlp, classifier, batch_size, cache, profiler, cascade)
+            chunk = []
+
+        window.popleft()
+        window.extend(islice(poem_lines, 1))
+
+    yield from annotate_chunk(chunk, nlp, classifier, batch_size, cache, profiler, cascade)
+
+
+def annotate_chunk(chunk, nlp, classifier='all', batch_size=BATCH_SIZE, cache=None, profiler=None, cascade=False):
+    """
+        Parse and classify the line pairs of a chunk of lines, see 
+        annotate_lines.
+
+        Parameters
+        ----------
+            chunk: list
+                (LineAnnotation, line pair) tuples, the line pair being None
+                for end-stopped lines
+
+        Returns
+        -------
+            lines: list
+                the LineAnnotation of the chunk, classified
+    """
+    line_pairs = [(line_pair.lower(), line) for line, line_pair in chunk if line_pair is not None]
+    deferred = [] if cascade and classifier == 'all' and nlp is not None else None
+    parser = get_parser(nlp) if deferred is not None and cache is None else None
+    if nlp is None:
+        parsed_pairs = ((None, line) for _, line in line_pairs)
+    elif parser is not None:
+        parsed_pairs = pipe_without_parser(line_pairs, nlp, batch_size)
+    elif cache is None:
+        parsed_pairs = nlp.pipe(line_pairs, as_tuples=True, batch_size=batch_size)
+    else: 
+        parsed_pairs = cache.pipe(line_pairs, nlp, batch_size)
+
+    if profiler is not None and nlp is not None:
+        parsed_pairs = profiler.iterate('parse', parsed_pairs)
+    docs = {id(line): doc for doc, line in parsed_pairs}
+
+    start = time.perf_counter()
+    for line, line_pair in chunk:
+        if line_pair is not None:
+            doc = docs[id(line)]
+            set_line_types(line, line_pair, doc[:] if doc is not None else None, classifier, profiler, deferred)
+
+    if profiler is not None:
+        profiler.add('get_line_annotations', time.perf_counter() - start)
+        profiler.count('lines', sum(1 for line, _ in chunk if line.number is not None))
+        profiler.count('run-on lines', len(line_pairs))
+    if deferred is not None:
+        set_dependency_types(deferred, parser, batch_size, profiler)
+
+    return [line for line, _ in chunk]
+
+
+def render_lines(lines, classifier='all'):
+    """
+        Rebuild the poem piece by piece, as render_poem does on the whole 
+        poem. Line breaks are held back until the next non-blank line, so 
+        that runs of blank lines are reduced as render_poem reduces them.
+
+        Parameters
+        ----------
+            lines: iterable
+                LineAnnotation of every line of the poem
+            classifier: str
+                classifier whose output is to be kept
+
+        Yields
+        ------
+            text: str
+                the annotated poem, piece by piece
+    """
+    def reduce(newlines):
+        # what replacing '\n\n\n' with '\n\n' leaves of a run of line breaks
+        return '\n' * (2 * (newlines // 3) + newlines % 3)
+
+    newlines = -1
+    for line in lines:
+        newlines += 1
+        annotated_line = line.annotate(classifier)
+        if len(annotated_line) > 0:
+            yield reduce(newlines) + annotated_line
+            newlines = 0
+        if line.run_on and line.stanza_end:
+            newlines += 1
+
+    # some poems end with multiple \n, see render_poem
+    if newlines >= 3:
+        newlines -= 2
+    elif newlines == 2:
+        newlines = 1
+    yield reduce(max(newlines, 0))
+
+
+def stream_poem(file, save, outfile, nlp, classifier='all', batch_size=BATCH_SIZE, cache=None, profiler=None, 
+                cascade=False):
+    """
+        Annotate a poem file line by line, writing the annotated lines as they
+        come, so that book-length poems or whole anthologies stored as one file
+        are processed with bounded memory. The output is that of processor, 
+        line pairs being parsed on their own.
+
+        Parameters
+        ----------
+            file: TextIOWrapper
+                poem file to process, which must be seekable
+            save: bool
+                whether the file is to be printed to cmd or save to disk
+            outfile: str
+                path to where the result will be saved
+            nlp: 
+                spacy nlp pipeline
+            classifier: str
+                classifier whose output is to be kept
+            batch_size: int
+                number of texts parsed at once by spaCy
+            cache: ParseCache
+                persistent cache of spaCy analyses, if any
+            profiler: Profiler
+                if given, each stage is timed, see annotate_lines
+            cascade: bool
+                whether the classifiers of the `all` classifier are run as a
+                cascade, see annotate_poems
+    """
+    lines = annotate_lines(iter_poem_lines(file), nlp, classifier, batch_size, cache, profiler, cascade=cascade)
+    if save:
+        with open(outfile, 'w', encoding='utf-8') as out:
+            for text in render_lines(lines, classifier):
+                out.write(text)
+    else:
+        for text in render_lines(lines, classifier):
+            sys.stdout.write(text)
+        sys.stdout.write('\n')
+
+    if profiler is not None:
+        profiler.count('poems')
+
+
+def save_poem(poem, save, outfile, is_eval=False, is_dir=False):
+    """
+        Print the annotated poem or save it to disk.
+
+        Parameters
+        ----------
+            poem: str
+                the annotated poem
+            save: bool
+                whether the file is to be printed to cmd or save to disk
+            outfile: str
+                path to where the result will be saved
+    """
     if save:
         with open(outfile, 'w', encoding='utf-8') as file:
             file.write(poem)
@@ -297,3 +1270,57 @@ def processor(file, save, outfile, nlp, classifier='all', is_eval=False, is_dir=
 
     else: 
         print(poem)
+
+
+def processor(file, save, outfile, nlp, classifier='all', is_eval=False, is_dir=False, 
+            batch_size=BATCH_SIZE, parse_mode='pair', cache=None, profiler=None, cascade=False):
+    """
+        Execute the whole preprocessing module. 
+
+        Split the poem into lines, then check whether a line end-stopped. 
+        If not, the line pair is tagged and parsed, and the classifiers are 
+        run against spacy POS, tags and dependencies (see process_poems). 
+
+        If there is a match (or several), an annotation is added to the end of 
+        the line. 
+
+        Finally, the poem is reconstructed, keeping the blanks between 
+        stanzas.
+
+        When line pairs are parsed on their own, the poem is streamed line by
+        line (see stream_poem), so that memory does not depend on its length.
+
+        Parameters
+        ----------
+            file: TextIOWrapper
+                poem file to process
+            save: bool
+                whether the file is to be printed to cmd or save to disk
+            outfile: str
+                path to where the result will be saved
+            nlp: 
+                spacy nlp pipeline
+            batch_size: int
+                number of texts parsed at once by spaCy
+            parse_mode: str
+                one of PARSE_MODES, see get_parse_units
+            cache: ParseCache
+                persistent cache of spaCy analyses, if any
+            profiler: Profiler
+                if given, each stage is timed, see annotate_poems
+            cascade: bool
+                whether the classifiers are run as a cascade, the parser only
+                running on the line pairs the dictionary and regex classifiers
+                cannot classify. Default to False, see annotate_poems.
+    """
+    if parse_mode == 'pair' and file.seekable():
+        stream_poem(file, save, outfile, nlp, classifier, batch_size, cache, profiler, cascade)
+        if save and not is_eval and not is_dir:
+            print('Files has been saved to disk at', outfile)
+        return
+
+    poem = file.read()
+
+    for _, annotated_poem in process_poems([(outfile, poem)], nlp, classifier, batch_size, parse_mode, 
+                                           cache=cache, profiler=profiler, cascade=cascade):
+        timed(profiler, 'save_poem', save_poem, annotated_poem, save, outfile, is_eval, is_dir)
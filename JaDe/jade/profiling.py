@@ -0,0 +1,201 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the profiling of runs: time spent in each stage
+   of the pipeline, counts and latency of the classifiers.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import cProfile
+import time
+from collections import defaultdict
+
+# stages of the pipeline in the order they run, along with their depth:
+# stages of depth 1 are run within the preceding stage of depth 0
+STAGES = [('load_pipeline', 0), ('detect_lines', 0), ('prepare_poem', 0), ('get_parse_units', 0), ('parse', 0),
+          ('get_pair_views', 0), ('get_line_annotations', 0), ('detect_phrasal_verb', 1), ('get_pos_type', 1),
+          ('get_dependency_arrays', 1), ('get_dep_type', 1), ('handle_multiclassification', 1),
+          ('parse_dependencies', 0), ('render_poem', 0), ('save_poem', 0), ('load_gold', 0), ('get_aligned_codes', 0)]
+# stages running a classifier, whose output is counted label by label
+RULE_STAGES = {'detect_phrasal_verb': 'dictionary', 'get_pos_type': 'regex', 'get_dep_type': 'dependencies'}
+
+
+class Profiler:
+    """
+        Collect the time spent in each stage, counts and the labels each
+        classifier produced, along with the latency of the calls that
+        produced them.
+
+        Processing functions take an optional profiler, so that nothing is
+        collected, and next to no time lost, when profiling is disabled.
+
+        Attributes
+        ----------
+            times: dict
+                {stage: seconds}
+            calls: dict
+                {stage: number of calls}
+            counts: dict
+                {name: count}, eg lines, run-on lines or cache hits
+            labels: dict
+                {(classifier, label): [number of line pairs, seconds]}
+            pstats_path: str
+                path to which cProfile statistics are dumped, if any
+    """
+    def __init__(self, pstats_path=None):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.labels = defaultdict(lambda: [0, 0.0])
+        self.pstats_path = pstats_path
+        self.cprofile = cProfile.Profile() if pstats_path is not None else None
+        self.wall_time = 0.0
+        self.started = None
+
+    def start(self):
+        """
+            Start the wall clock, and cProfile if statistics are to be dumped.
+        """
+        self.started = time.perf_counter()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def stop(self):
+        """
+            Stop the wall clock, and dump cProfile statistics if requested.
+        """
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.pstats_path)
+        if self.started is not None:
+            self.wall_time += time.perf_counter() - self.started
+            self.started = None
+
+    def add(self, stage, seconds, output=None):
+        """
+            Record a call to a stage. The output of the classifier stages is
+            recorded label by label.
+        """
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+        if output is not None and stage in RULE_STAGES:
+            for label in set(output):
+                record = self.labels[(RULE_STAGES[stage], label)]
+                record[0] += 1
+                record[1] += seconds
+
+    def count(self, name, value=1):
+        """
+            Increase a counter.
+        """
+        self.counts[name] += value
+
+    def iterate(self, stage, iterable, nested=()):
+        """
+            Time the production of each item of an iterable, eg docs parsed
+            by nlp.pipe, leaving out the time spent meanwhile in the nested
+            stages (eg the preparation of the texts to be parsed).
+        """
+        iterator = iter(iterable)
+        while True:
+            nested_time = sum(self.times[name] for name in nested)
+            start = time.perf_counter()
+            item = next(iterator, StopIteration)
+            seconds = time.perf_counter() - start - (sum(self.times[name] for name in nested) - nested_time)
+            if item is StopIteration:
+                self.times[stage] += seconds
+                return
+            self.add(stage, seconds)
+            yield item
+
+    def get_stats(self):
+        """
+            Return what was collected as plain dicts, so that it can be sent
+            from a worker process and merged, see merge.
+        """
+        return {'times': dict(self.times), 'calls': dict(self.calls), 'counts': dict(self.counts),
+                'labels': {key: list(record) for key, record in self.labels.items()}}
+
+    def merge(self, stats):
+        """
+            Add what another profiler collected, see get_stats.
+        """
+        for stage, seconds in stats['times'].items():
+            self.times[stage] += seconds
+        for stage, calls in stats['calls'].items():
+            self.calls[stage] += calls
+        for name, value in stats['counts'].items():
+            self.counts[name] += value
+        for key, (fired, seconds) in stats['labels'].items():
+            self.labels[key][0] += fired
+            self.labels[key][1] += seconds
+
+    def report(self):
+        """
+            Summarise the run as tables of stages, counts and labels.
+        """
+        known = [stage for stage, _ in STAGES]
+        stages = [(stage, depth) for stage, depth in STAGES if stage in self.times] + \
+                 [(stage, 0) for stage in sorted(self.times) if stage not in known]
+        total = self.wall_time or sum(self.times[stage] for stage, depth in stages if depth == 0)
+
+        rows = ['%-30s %10s %8s %10s %7s' % ('stage', 'seconds', 'calls', 'ms/call', 'share')]
+        for stage, depth in stages:
+            seconds = self.times[stage]
+            calls = self.calls[stage]
+            rows.append('%-30s %10.3f %8d %10.3f %6.1f%%' % ('  ' * depth + stage, seconds, calls,
+                                                             seconds / calls * 1e3 if calls else 0.0,
+                                                             seconds / total * 100 if total else 0.0))
+        if self.wall_time:
+            rows.append('%-30s %10.3f' % ('wall time', self.wall_time))
+
+        if self.counts:
+            rows.append('')
+            rows.append('%-30s %10s' % ('count', 'value'))
+            for name in sorted(self.counts):
+                rows.append('%-30s %10d' % (name, self.counts[name]))
+            # run-on lines whose line pair the classifier cascade had to parse
+            if 'pairs needing the parser' in self.counts and self.counts['run-on lines']:
+                rows.append('%-30s %9.1f%%' % ('share needing the parser', self.counts['pairs needing the parser'] 
+                                               / self.counts['run-on lines'] * 100))
+
+        if self.labels:
+            rows.append('')
+            rows.append('%-14s %-20s %8s %10s' % ('classifier', 'label', 'pairs', 'ms/pair'))
+            for (classifier, label), (fired, seconds) in sorted(self.labels.items(),
+                                                                key=lambda item: (item[0][0], -item[1][0])):
+                rows.append('%-14s %-20s %8d %10.3f' % (classifier, label, fired, seconds / fired * 1e3))
+
+        if self.pstats_path is not None:
+            rows.append('')
+            rows.append('cProfile statistics saved to ' + self.pstats_path)
+
+        return '\n'.join(rows)
+
+
+def timed(profiler, stage, function, *args):
+    """
+        Call a function, recording the call to the given stage if a profiler
+        is given.
+    """
+    if profiler is None:
+        return function(*args)
+
+    start = time.perf_counter()
+    output = function(*args)
+    profiler.add(stage, time.perf_counter() - start, output)
+
+    return output
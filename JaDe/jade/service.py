@@ -0,0 +1,304 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the annotation service: a local HTTP server that
+   loads the model once and coalesces concurrent requests into micro-batches.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from .processing import annotate_poems, render_poem, BATCH_SIZE
+
+HOST = '127.0.0.1'
+PORT = 8000
+# maximum number of poems annotated together
+MAX_BATCH = 32
+# seconds the oldest request of a batch may wait for others to join it
+MAX_WAIT = 0.01
+# maximum number of requests waiting for a batch, others being rejected
+QUEUE_SIZE = 256
+# seconds a request waits for its annotation before giving up
+REQUEST_TIMEOUT = 60.0
+# number of recent requests the latency percentiles are computed on
+LATENCY_WINDOW = 10000
+
+
+class MicroBatcher:
+    """
+        Annotate poems submitted by concurrent requests, a single thread
+        gathering them into batches: a batch is processed as soon as it
+        holds max_batch poems, or max_wait seconds after its oldest poem was
+        submitted. Line pairs of the poems of a batch are parsed together,
+        see processing.annotate_poems.
+
+        The queue of waiting poems is bounded, so that a service lagging
+        behind rejects requests instead of piling them up.
+
+        Attributes
+        ----------
+            nlp:
+                spacy nlp pipeline, only used by the batching thread
+            classifier: str
+                classifier whose output is kept
+            batch_size: int
+                number of texts parsed at once by spaCy
+            parse_mode: str
+                one of processing.PARSE_MODES
+            max_batch: int
+                maximum number of poems per batch
+            max_wait: float
+                seconds the oldest poem of a batch may wait for others
+            queue_size: int
+                maximum number of waiting poems
+    """
+    def __init__(self, nlp, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair', max_batch=MAX_BATCH,
+                 max_wait=MAX_WAIT, queue_size=QUEUE_SIZE):
+        self.nlp = nlp
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.parse_mode = parse_mode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue_size = queue_size
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.started = None
+        self.counts = {'requests': 0, 'rejected': 0, 'failed': 0, 'batches': 0, 'poems': 0}
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        """
+            Start the batching thread.
+        """
+        self.started = time.perf_counter()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name='jade-batcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Stop the batching thread once the poems already submitted are
+            annotated.
+        """
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, poem):
+        """
+            Queue a poem to be annotated.
+
+            Returns
+            -------
+                future: Future
+                    resolved with the annotated poem and its LineAnnotation
+
+            Raises
+            ------
+                queue.Full
+                    if too many poems are waiting already
+        """
+        future = Future()
+        try:
+            self.queue.put_nowait((poem, future, time.perf_counter()))
+        except queue.Full:
+            with self.lock:
+                self.counts['rejected'] += 1
+            raise
+        with self.lock:
+            self.counts['requests'] += 1
+
+        return future
+
+    def _get_batch(self):
+        """
+            Wait for a poem, then for others until the batch is full or the
+            oldest poem has waited max_wait seconds. None once stopped.
+        """
+        while True:
+            try:
+                first = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return None
+
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            if batch is None:
+                return
+
+            def on_error(k, err):
+                batch[k][1].set_exception(err)
+
+            try:
+                for k, lines in annotate_poems(((k, request[0]) for k, request in enumerate(batch)), self.nlp,
+                                               self.classifier, self.batch_size, self.parse_mode, on_error):
+                    batch[k][1].set_result((render_poem(lines, self.classifier), lines))
+            except Exception as err:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(err)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError('The poem could not be annotated'))
+
+            now = time.perf_counter()
+            with self.lock:
+                self.counts['batches'] += 1
+                self.counts['poems'] += len(batch)
+                self.batch_sizes.append(len(batch))
+                for _, future, submitted in batch:
+                    self.latencies.append(now - submitted)
+                    if future.exception() is not None:
+                        self.counts['failed'] += 1
+
+    def get_metrics(self):
+        """
+            Describe the state of the service: queue depth, counts, batch
+            sizes and latency percentiles over the last requests.
+        """
+        import numpy as np
+
+        with self.lock:
+            batch_sizes = list(self.batch_sizes)
+            latencies = np.array(self.latencies) * 1e3
+            metrics = dict(self.counts)
+
+        metrics.update({
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue_size,
+            'max_batch': self.max_batch,
+            'max_wait_ms': self.max_wait * 1e3,
+            'mean_batch_size': round(sum(batch_sizes) / len(batch_sizes), 3) if batch_sizes else 0.0,
+            'last_batch_size': batch_sizes[-1] if batch_sizes else 0,
+            'latency_p50_ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else 0.0,
+            'latency_p99_ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else 0.0,
+            'uptime_seconds': round(time.perf_counter() - self.started, 3) if self.started else 0.0,
+        })
+
+        return metrics
+
+
+class AnnotationHandler(BaseHTTPRequestHandler):
+    """
+        Requests of the annotation service:
+
+        - `POST /annotate`, the poem being sent as plain text or as JSON
+          (`{"poem": "..."}`), answers `{"poem": annotated poem, "lines":
+          [annotation of each line]}`. A service with too many waiting poems
+          answers 503 at once.
+        - `GET /metrics` answers the metrics of the batcher, see
+          MicroBatcher.get_metrics.
+    """
+    def _send(self, status, content, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send(200, self.server.batcher.get_metrics())
+        else:
+            self._send(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/annotate':
+            self._send(404, {'error': 'Unknown path: ' + self.path})
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                poem = json.loads(body)['poem']
+            else:
+                poem = body
+            if not isinstance(poem, str):
+                raise ValueError('The poem must be a string')
+        except (ValueError, KeyError, TypeError) as err:
+            self._send(400, {'error': 'Invalid request: ' + repr(err)})
+            return
+
+        try:
+            future = self.server.batcher.submit(poem)
+        except queue.Full:
+            self._send(503, {'error': 'Too many poems waiting, retry later'}, {'Retry-After': '1'})
+            return
+
+        try:
+            annotated_poem, lines = future.result(self.server.timeout_seconds)
+        except TimeoutError:
+            self._send(504, {'error': 'The poem was not annotated in time'})
+            return
+        except Exception as err:
+            self._send(500, {'error': repr(err)})
+            return
+
+        self._send(200, {'poem': annotated_poem, 'lines': [line.to_dict() for line in lines]})
+
+    def log_message(self, format, *args):
+        # one line per request would flood the output of a loaded service
+        pass
+
+
+class AnnotationServer(ThreadingMixIn, HTTPServer):
+    """
+        HTTP server of the annotation service, one thread handling each
+        connection while a single batcher annotates the poems.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher, timeout=REQUEST_TIMEOUT):
+        super().__init__(address, AnnotationHandler)
+        self.batcher = batcher
+        self.timeout_seconds = timeout
+
+
+def make_server(batcher, host=HOST, port=PORT, timeout=REQUEST_TIMEOUT):
+    """
+        Build the HTTP server of the annotation service. Port 0 picks a free
+        port, see server.server_address.
+    """
+    return AnnotationServer((host, port), batcher, timeout)
@@ -0,0 +1,114 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the store of raw classifier outputs, from which
+   the annotation of every classifier can be derived without parsing again.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+from .manifest import get_model_version, hash_file
+from .processing import LineAnnotation
+from .utils import PHRASAL_VERBS, RULES_VERSION
+
+STORE_NAME = '.raw_annotations.json'
+
+
+def hash_text(text):
+    """
+        Compute the sha256 digest of a poem.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def save_store(path, poems, settings):
+    """
+        Write the raw outputs of the three classifiers for a set of poems.
+
+        Parameters
+        ----------
+            path: str
+                path to the store
+            poems: dict
+                {key: (hash of the poem, list of LineAnnotation)}, the line
+                pairs having been classified with the `all` classifier
+            settings: dict
+                as returned by manifest.get_settings
+    """
+    store = {'settings': settings,
+             'poems': {key: {'hash': poem_hash, 'lines': [line.to_dict() for line in lines]}
+                       for key, (poem_hash, lines) in poems.items()}}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(store, file)
+    os.replace(tmp_path, path)
+
+
+def load_store(path, hashes, model=None, parse_mode=None):
+    """
+        Read the raw outputs of a set of poems, provided that they are up to
+        date, ie that neither the poems nor the rules and the phrasal verbs
+        lexicon changed since they were stored, and that they were stored with
+        the given model and parse mode.
+
+        Parameters
+        ----------
+            path: str
+                path to the store
+            hashes: dict
+                {key: hash of the poem} of the poems expected in the store
+            model: str
+                language model the outputs should come from, whose version is
+                checked as well when it can be read without loading the model,
+                see manifest.get_model_version. Not checked if None.
+            parse_mode: str
+                parse mode the outputs should come from. Not checked if None.
+
+        Returns
+        -------
+            poems: dict
+                {key: list of LineAnnotation}, None if the store is missing
+                or out of date
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            store = json.load(file)
+    except ValueError:
+        return None
+
+    settings = store.get('settings', {})
+    if settings.get('rules_version') != RULES_VERSION or settings.get('lexicon') != hash_file(PHRASAL_VERBS):
+        return None
+
+    if model is not None:
+        version = get_model_version(model)
+        if settings.get('model') != model or version is not None and settings.get('model_version') != version:
+            return None
+
+    if parse_mode is not None and settings.get('parse_mode') != parse_mode:
+        return None
+
+    poems = store.get('poems', {})
+    if set(poems) != set(hashes) or any(poems[key]['hash'] != poem_hash for key, poem_hash in hashes.items()):
+        return None
+
+    return {key: [LineAnnotation.from_dict(record) for record in poem['lines']] for key, poem in poems.items()}
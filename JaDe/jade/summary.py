@@ -0,0 +1,140 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file handles the summary kept in output directories: counts
+   per label, line and enjambment totals, so that charts can be built without
+   reading the annotated poems again.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+from .labels import EMPTY
+
+SUMMARY_NAME = '.jade_summary.json'
+SUMMARY_VERSION = 1
+COUNTS = ['lines', 'run_on', 'enjambments']
+
+
+def summarise_poem(lines, classifier='all', outfile=None):
+    """
+        Count the lines, run-on lines and enjambments of an annotated poem,
+        along with the occurrences of each label.
+
+        Parameters
+        ----------
+            lines: list
+                LineAnnotation of every line of the poem
+            classifier: str
+                classifier whose output is kept
+            outfile: str
+                path to the annotated poem, if it was saved. Its size and
+                modification time are recorded, so that readers can tell
+                whether the poem was modified since.
+
+        Returns
+        -------
+            entry: dict
+                counts of the poem. Labels are given without brackets, as
+                jane counts them.
+    """
+    entry = {'lines': 0, 'run_on': 0, 'enjambments': 0, 'labels': {}}
+    for line in lines:
+        if line.number is None:
+            continue
+        entry['lines'] += 1
+        if not line.run_on:
+            continue
+        entry['run_on'] += 1
+        label = line.get_label(classifier)
+        if label != EMPTY:
+            label = label.replace('[', '').replace(']', '')
+            entry['enjambments'] += 1
+            entry['labels'][label] = entry['labels'].get(label, 0) + 1
+
+    if outfile is not None:
+        stat = os.stat(outfile)
+        entry.update(outfile=os.path.basename(outfile), size=stat.st_size, mtime=stat.st_mtime)
+
+    return entry
+
+
+def get_totals(entries):
+    """
+        Sum the counts of several poems.
+    """
+    totals = {'poems': 0, 'lines': 0, 'run_on': 0, 'enjambments': 0, 'labels': {}}
+    for entry in entries:
+        totals['poems'] += 1
+        for count in COUNTS:
+            totals[count] += entry[count]
+        for label, occurrences in entry['labels'].items():
+            totals['labels'][label] = totals['labels'].get(label, 0) + occurrences
+
+    return totals
+
+
+def load_summary(outdir):
+    """
+        Read the summary of an output directory.
+
+        Returns
+        -------
+            summary: dict
+                {'version', 'classifier', 'totals', 'poems': {key: entry}},
+                with no poems if the directory has no summary yet
+    """
+    path = os.path.join(outdir, SUMMARY_NAME)
+    summary = None
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                summary = json.load(file)
+        except ValueError:
+            summary = None
+
+    if summary is None or summary.get('version') != SUMMARY_VERSION:
+        summary = {'version': SUMMARY_VERSION, 'classifier': None, 'totals': get_totals([]), 'poems': {}}
+
+    return summary
+
+
+def save_summary(outdir, summary, manifest, classifier='all'):
+    """
+        Write the summary of an output directory, keeping only the poems the
+        manifest holds as successfully annotated, and update its totals.
+
+        Parameters
+        ----------
+            outdir: str
+                path to the output directory
+            summary: dict
+                as returned by load_summary, entries of the poems annotated
+                in the run being updated
+            manifest: dict
+                manifest of the output directory, see manifest.load_manifest
+            classifier: str
+                classifier whose output is kept
+    """
+    summary['poems'] = {key: entry for key, entry in summary['poems'].items()
+                        if manifest.get(key, {}).get('status') == 'done'}
+    summary['classifier'] = classifier
+    summary['totals'] = get_totals(summary['poems'][key] for key in sorted(summary['poems']))
+
+    path = os.path.join(outdir, SUMMARY_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(summary, file)
+    os.replace(path + '.tmp', path)
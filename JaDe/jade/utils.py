@@ -19,10 +19,83 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import pathlib
 import re
+from functools import lru_cache
+
+# to be increased whenever a change in the rules below changes the annotations
+RULES_VERSION = '2'
+# resolved from the package rather than the working directory
+PHRASAL_VERBS = str(pathlib.Path(__file__).resolve().parent.parent / 'resources' / 'phrasal_verbs.txt')
+# (pattern, layer, label, priority) of the regex classifier: patterns are 
+# searched in the sequence of POS or of tags of the line pair, the first 
+# match by priority (lowest first) giving the type
+POS_RULES = [
+    (r'DET SPACE NOUN', 'pos', 'pb_det_noun', 1),
+    (r'ADJ SPACE NOUN', 'pos', 'pb_noun_adj', 2),
+    (r'VBN _SP NOUN', 'tag', 'pb_noun_adj', 2),
+    (r'RB.? _SP (JJ.?|VBN)', 'tag', 'pb_adj_adv', 3),
+    (r'ADV SPACE VERB|VERB SPACE ADV', 'pos', 'pb_verb_adv', 4),
+    (r'ADV SPACE ADV', 'pos', 'pb_adv_adv', 5),
+    (r'ADJ SPACE ADJ', 'pos', 'pb_adj_adj', 6),
+    (r'NOUN SPACE ADP', 'pos', 'pb_noun_prep', 7),
+    (r'NOUN SPACE NOUN', 'pos', 'pb_noun_noun', 8),
+    (r'NN _SP (WDT|VBG)', 'tag', 'cc_cross_clause', 9),
+    (r'TO _SP VB.?', 'tag', 'pb_to_verb', 10),
+    (r'VB.? _SP TO', 'tag', 'pb_verb_cprep', 11),
+    (r'VERB SPACE AUX|AUX SPACE VERB', 'pos', 'pb_verb_chain', 12),
+    (r'VB.? _SP IN', 'tag', 'pb_verb_prep', 13),
+    (r'(RB|JJ)[RS]( \w*){0,3} _SP( \w*){0,4}((JJ|RB)[RS]|IN)?', 'tag', 'pb_comp', 14),
+    (r'NN(.+)? _SP VB[^NG].?', 'tag', 'ex_subj_verb', 15),
+    (r'VB.? _SP (\w+ ){0,2}NN(.+)?', 'tag', 'ex_dobj_verb', 16),
+]
+# subordinating words introducing an adjunct after the break
+ADJUNCT_WORDS = ['although', 'while', 'from', 'though', 'after', 'before', 'because', 'as', 'to']
+
+
+def compile_pos_rules(rules):
+    """
+        Compile a table of POS rules, once, into a matcher per layer: the 
+        patterns of a layer are joined into a single alternation, in order of 
+        priority, each pattern being followed by an empty group named after 
+        its rule so that the group tells which rule matched.
+
+        Parameters
+        ----------
+            rules: list
+                (pattern, layer, label, priority) tuples, see POS_RULES
+
+        Returns
+        -------
+            matchers: list
+                (layer, first_match, all_matches, lowest rank) tuples. At a 
+                given position, first_match reports the rule of highest 
+                priority; all_matches sets the group of every rule matching
+                anywhere in the layer.
+            ranks: dict
+                {group name: rank of the rule, in order of priority}
+            labels: list
+                label of each rule, by rank
+    """
+    ranked_rules = sorted(rules, key=lambda rule: rule[3])
+    ranks = {'rule_' + str(rank): rank for rank in range(len(ranked_rules))}
+    labels = [rule[2] for rule in ranked_rules]
+    matchers = []
+
+    for layer in ['pos', 'tag']:
+        layer_ranks = [rank for rank, rule in enumerate(ranked_rules) if rule[1] == layer]
+        if len(layer_ranks) == 0:
+            continue
+        first_match = re.compile('|'.join('(?:' + ranked_rules[rank][0] + ')(?P<rule_' + str(rank) + '>)' 
+                                          for rank in layer_ranks))
+        all_matches = re.compile(''.join('(?:(?=.*?(?:' + ranked_rules[rank][0] + ')(?P<rule_' + str(rank) + '>)))?' 
+                                         for rank in layer_ranks))
+        matchers.append((layer, first_match, all_matches, layer_ranks[0]))
+
+    return matchers, ranks, labels
 
 
-def get_pos_type(sentence):
+def get_pos_type(sentence, all_matches=False, compiled_rules=None):
     """
         Retrieve the type of enjambment present in a sentence based on regex 
         patterns. 
@@ -33,9 +106,9 @@ def get_pos_type(sentence):
         a configuration and that these occurrences tend to be stronger that way.
         This can be easily changed by adding {0,x} after the desired POS, where
         x is the number of POS that can be inserted between the two explicitly
-        expressed in the regular exession. 
+        expressed in the regular exession in POS_RULES. 
         Furthermore, when allowing for broader range in regular expression search, 
-        you might want to change if/elif to if/if. Doing so will allow 
+        you might want to set all_matches. Doing so will allow 
         multi-classification, which is bound to happen at some point when making
         the patterns more flexible. 
 
@@ -43,6 +116,12 @@ def get_pos_type(sentence):
         ----------
             sentence: list
                 list of tokens, spacy's pos and spacy's tags
+            all_matches: bool
+                whether every type matched should be returned, in order of 
+                priority, rather than the one of highest priority only
+            compiled_rules: tuple
+                rules to be matched, as returned by compile_pos_rules. Default
+                to POS_RULES.
 
         Returns
         ------- 
@@ -50,242 +129,275 @@ def get_pos_type(sentence):
                 list of detected types
 
     """
+    matchers, ranks, labels = compiled_rules if compiled_rules is not None else POS_MATCHERS
+    layers = {'pos': ' '.join([token[1] for token in sentence]) + ' ', 
+              'tag': ' '.join([token[2] for token in sentence]) + ' '}
 
-    DET_NOUN = r'DET SPACE NOUN'
-    NOUN_NOUN = r'NOUN SPACE NOUN'
-    ADJ_NOUN = r'ADJ SPACE NOUN'
-    VBN_NOUN = r'VBN _SP NOUN'
-    ADJ_ADJ = r'ADJ SPACE ADJ'
-    NOUN_PREP = r'NOUN SPACE ADP'
-    CROSS = r'NN _SP (WDT|VBG)'
-    V_CHAIN = r'VERB SPACE AUX|AUX SPACE VERB'
-    ADV_ADV = r'ADV SPACE ADV'
-    VERB_ADV = r'ADV SPACE VERB|VERB SPACE ADV'
-    VBN_ADV = r'RB.? _SP (JJ.?|VBN)'
-    VERB_TO = r'TO _SP VB.?'
-    CPREP = r'VB.? _SP TO'
-    VERB_PREP = r'VB.? _SP IN'
-    COMP = r'(RB|JJ)[RS]( \w*){0,3} _SP( \w*){0,4}((JJ|RB)[RS]|IN)?'
-    SUB_VERB_tag  = r'NN(.+)? _SP VB[^NG].?'
-    DOB_VERB = r'VB.? _SP (\w+ ){0,2}NN(.+)?'
+    if all_matches:
+        matched = []
+        for layer, _, every_match, _ in matchers:
+            match = every_match.match(layers[layer])
+            matched.extend(ranks[name] for name, group in match.groupdict().items() if group is not None)
+        return list(dict.fromkeys(labels[rank] for rank in sorted(matched)))
 
-    types = []
-    tag = ""
-    pos = ""
-    text = ""
+    best = None
+    for layer, first_match, _, lowest_rank in matchers:
+        if best is not None and best < lowest_rank:
+            continue
+        # every position where a rule matches is visited once, left to right
+        text = layers[layer]
+        match = first_match.search(text)
+        while match is not None:
+            rank = ranks[match.lastgroup]
+            if best is None or rank < best:
+                best = rank
+            match = first_match.search(text, match.start() + 1)
 
-    for token in sentence: 
-        pos += token[1] + " "
-        tag += token[2] + " "
-        text += str(token[0]) + " "
+    if best is None:
+        return []
 
-    if re.search(DET_NOUN, pos):
-        types.append('pb_det_noun')
+    return [labels[best]]
 
-    elif re.search(ADJ_NOUN, pos) or re.search(VBN_NOUN, tag):
-        types.append('pb_noun_adj')
 
-    elif re.search(VBN_ADV, tag):
-        types.append('pb_adj_adv')
+POS_MATCHERS = compile_pos_rules(POS_RULES)
 
-    elif re.search(VERB_ADV, pos):
-        types.append('pb_verb_adv')
 
-    elif re.search(ADV_ADV, pos):
-        types.append('pb_adv_adv')
+def get_dep_type(deps, pos, tags, heads, words, enjambment_index, window=1):
+    """
+        Retrieve the type of enjambment present in a sentence based on a 
+        combination of dependency relationships and POS.
 
-    elif re.search(ADJ_ADJ, pos):
-        types.append('pb_adj_adj')
+        Most rules are concerned only with the last word before the break 
+        and the first one afterward, based on the assumption that most of
+        enjambment occurrences can be captured with such a configuration. 
+        Tokens are identified by their index in the line pair, so that 
+        repeated words do not shadow one another, and every arc is looked at
+        once, from the dependent to its head.
 
-    elif re.search(NOUN_PREP, pos):
-        types.append('pb_noun_prep')
+        Parameters
+        ----------
+            deps: list
+                dependency label of each token
+            pos: list
+                coarse-grained part of speech of each token
+            tags: list
+                fine-grained part of speech of each token
+            heads: list
+                index of the head of each token in the line pair, -1 if the 
+                head lies outside of it
+            words: list
+                lowercased text of each token
+            enjambment_index: int
+                index of the line break token, None if there is none
+            window: int
+                number of words on each side of the break the rules about 
+                the last word before the break and the first one afterward 
+                look at. Default to 1.
+        Returns
+        -------
+            types: list
+                list of detected types
+    """
+    types = []
+
+    if enjambment_index is None:
+        return types
+
+    for child_index, token_index in enumerate(heads):
+        # the root is its own head, and the break is no dependent of interest
+        if token_index < 0 or token_index == child_index or child_index == enjambment_index:
+            continue
+
+        # arcs lying before the break and not touching it match no rule
+        if token_index < enjambment_index and child_index < enjambment_index - window:
+            continue
+
+        child_dep = deps[child_index]
 
-    elif re.search(NOUN_NOUN, pos):
-        types.append('pb_noun_noun')
+        if enjambment_index - window <= child_index < enjambment_index < token_index <= enjambment_index + window \
+            or enjambment_index - window <= token_index < enjambment_index < child_index <= enjambment_index + window:
 
-    elif re.search(CROSS, tag):
-        types.append('cc_cross_clause')
+            if child_dep == 'compound' and pos[child_index] == 'NOUN': 
+                types.append('pb_noun_noun')
 
-    elif re.search(VERB_TO, tag):
-        types.append('pb_to_verb')
+            elif child_dep in ['poss', 'det']:
+                types.append('pb_det_noun')
+            
+            elif child_dep in ['acl', 'amod', 'nummod']:
+                types.append('pb_noun_adj')
+                
+            elif child_dep == 'prep' and pos[token_index] == 'VERB': 
+                types.append('pb_verb_prep')     
+            
+            elif 'aux' in child_dep: 
+                types.append('pb_verb_chain')
 
-    elif re.search(CPREP, tag): 
-        types.append('pb_verb_cprep')
+            elif child_dep == 'nmod' or child_dep == 'prep' and pos[token_index] == 'NOUN': 
+                types.append('pb_noun_prep')
 
-    elif re.search(V_CHAIN, pos):
-        types.append('pb_verb_chain')
+            elif 'adv' in child_dep:
+                if tags[token_index] == 'VBN' or 'JJ' in tags[token_index]: 
+                    types.append('pb_adj_adv')
+                
+                elif pos[token_index] == 'VERB': 
+                    types.append('pb_verb_adv')
 
-    elif re.search(VERB_PREP, tag):
-        types.append('pb_verb_prep')
+        if child_index > enjambment_index and token_index < enjambment_index \
+            or child_index < enjambment_index and token_index > enjambment_index:
 
-    elif re.search(COMP, tag): 
-        types.append('pb_comp')
+            if child_dep in ['dobj', 'agent']: 
+                types.append('ex_dobj_verb')
+            
+            elif 'nsubj' in child_dep: 
+                types.append('ex_subj_verb')
+
+            elif child_dep == 'prt':
+                types.append('pb_phrasal_verb')
 
-    elif re.search(SUB_VERB_tag, tag): 
-        types.append('ex_subj_verb')
+            elif child_dep == 'relcl' and 'NN' in tags[token_index]:
+                types.append('cc_cross_clause')
 
-    elif re.search(DOB_VERB, tag): 
-        types.append('ex_dobj_verb')
+            elif child_dep in ['xcomp'] and tags[token_index] in ['JJ', 'VBN', 'JJR', 'JJS']: 
+                types.append('pb_adj_prep')
+                    
+        elif enjambment_index - window <= child_index < enjambment_index and token_index < child_index:
+            if child_dep == 'prep' and deps[token_index] == 'pobj' \
+                or child_dep == 'prep' and pos[token_index] in ['NOUN', 'PRON'] \
+                or child_dep == 'cc': 
+                types.append('pb_relword')
+
+        if token_index > enjambment_index and child_index > token_index:
+            if child_dep in ['conj', 'prep', 'mark'] and tags[child_index] == 'IN':
+                if words[child_index] in ADJUNCT_WORDS:
+                    types.append('ex_verb_adjunct')
 
     return types
 
 
-def get_dep_type(tokendict):
+def compile_phrasal_verb(phrasal):
     """
-        Retrieve the type of enjambment present in a sentence based on a 
-        combination of dependency relationships and POS.
-
-        Most rules are concerned only with the last word before the break 
-        and the first one afterward, based on the assumption that most of
-        enjambment occurrences can be captured with such a configuration. This
-        can be changed by adjusting the first if in the try clause: instead of 
-        enjambment +/- 1, change 1 to the desired scale. Be aware that doing so
-        will cause multiclassification. 
+        Build the regular expressions matching a phrasal verb of the lexicon.
 
         Parameters
         ----------
-            tokendict: dict
-                {token: [dep, pos, tag, token_head_text, token_head_pos, 
-                token_children]}
+            phrasal: str
+                entry of the phrasal verbs lexicon, eg `back somebody up`
+
         Returns
         -------
-            types: list
-                list of detected types
+            verb: str
+                the verb of the phrasal verb
+            label: str
+                type of enjambment detected by the patterns
+            patterns: list
+                compiled patterns, any of which detects the type
     """
-    types = []
-    dict_as_list = list(tokendict)
-
-    if '\t' in tokendict:
-        enjambment_index = dict_as_list.index('\t')
+    object_pattern = r'some\w*'
+
+    split_phrasal = phrasal.split(' ')
+    if re.sub(object_pattern, '', " ".join(split_phrasal[1:])):
+        particle = re.sub(object_pattern, '', " ".join(split_phrasal[1:])).strip()
+    else: 
+        particle  = split_phrasal[1]
+    verb = split_phrasal[0]
+    ing_verb = verb + '(.?ing|e?d|t)? '
+    phrasal = ing_verb + ' '.join(split_phrasal[1:])
     
-        for token, token_info in tokendict.items(): 
-            token_index = dict_as_list.index(token)
-            if len(token_info[5]) > 0:
-                children = token_info[5]
-                if '\t' in children: 
-                    newline_index = children.index('\t')
-                    del children[newline_index]
-            
-                for child in children: 
-                    try:
-                        child_infos = tokendict[child]
-                        child_index = dict_as_list.index(child)
-
-                        if child_index == (enjambment_index - 1) and token_index == (enjambment_index + 1) \
-                            or child_index == (enjambment_index + 1) and token_index == (enjambment_index - 1) :
-
-                            if child_infos[0] == 'compound' and child_infos[1] == 'NOUN': 
-                                types.append('pb_noun_noun')
-
-                            elif child_infos[0] in ['poss', 'det']:
-                                types.append('pb_det_noun')
-                            
-                            elif child_infos[0] in ['acl', 'amod', 'nummod']:
-                                types.append('pb_noun_adj')
-                                
-                            elif child_infos[0] == 'prep' and token_info[1] == 'VERB': 
-                                types.append('pb_verb_prep')     
-                            
-                            elif 'aux' in child_infos[0]: 
-                                types.append('pb_verb_chain')
-
-                            elif child_infos[0] == 'nmod' or child_infos[0] == 'prep' and token_info[1] == 'NOUN': 
-                                types.append('pb_noun_prep')
-
-                            elif 'adv' in child_infos[0]:
-                                if token_info[2] == 'VBN' or 'JJ' in token_info[2]: 
-                                    types.append('pb_adj_adv')
-                                
-                                elif token_info[1] == 'VERB': 
-                                    types.append('pb_verb_adv')
-
-                        if child_index > enjambment_index  and token_index < enjambment_index  \
-                            or child_index < enjambment_index and token_index > enjambment_index:
-
-                            if child_infos[0] in ['dobj', 'agent']: 
-                                types.append('ex_dobj_verb')
-                            
-                            elif 'nsubj' in child_infos[0]: 
-                                types.append('ex_subj_verb')
-
-                            elif child_infos[0] == 'prt':
-                                types.append('pb_phrasal_verb')
-
-                            elif child_infos[0] == 'relcl' and 'NN' in token_info[2]:
-                                types.append('cc_cross_clause')
-
-                            elif child_infos[0] in ['xcomp'] and token_info[2] in ['JJ', 'VBN', 'JJR', 'JJS']: 
-                                types.append('pb_adj_prep')
-                                    
-                        elif child_index == enjambment_index - 1 and token_index < child_index:
-                            if child_infos[0] == 'prep' and token_info[0] == 'pobj' \
-                                or child_infos[0] == 'prep' and token_info[1] in  ['NOUN', 'PRON'] \
-                                or child_infos[0] == 'cc': 
-                                types.append('pb_relword')
-
-                        if token_index > enjambment_index:
-                            if child_index > token_index and token_index - child_index < 3: 
-                                if child_infos[0] in ['conj', 'prep', 'mark'] and child_infos[2] == 'IN':
-                                    if child.lower() in ['although', 'while', 'from', 'though', 'after', 'before','because', 'as', 'to'] :
-                                        types.append('ex_verb_adjunct')
- 
-                    except KeyError as err: 
-                        continue
+    if re.search(object_pattern, phrasal): 
+        ex_verb_pattern_1 = verb + r'(.?ing|e?d|t)?( \w*){1,3}' + r'\t( ?\w*){0,3} ' + particle
+        ex_verb_pattern_2 = verb + r'(.?ing|e?d|t)?' + ' ' + particle + r'\t( ?\w*){1,3}'
 
+        ex_verb_pattern_2 = ex_verb_pattern_2.replace(' \\t', '\\t')
+        ex_verb_pattern_1 = ex_verb_pattern_1.replace( ' \\t', '\\t')
+
+        return verb, 'ex_dobj_pverb', [re.compile(ex_verb_pattern_1, flags=re.MULTILINE), 
+                                       re.compile(ex_verb_pattern_2, flags=re.MULTILINE)]
         
-    return types
+    pb_phrasal = ing_verb + '\\t' + ' '.join(split_phrasal[1:])
+    pb_phrasal = pb_phrasal.replace(' \\t', '\\t')
+    pb_phrasal = re.sub(object_pattern+' ', '', pb_phrasal)
 
+    return verb, 'pb_phrasal_verb', [re.compile(pb_phrasal, flags=re.MULTILINE)]
 
-def detect_phrasal_verb(line_pair): 
+
+@lru_cache(maxsize=None)
+def load_phrasal_index(path=PHRASAL_VERBS):
+    """
+        Compile the phrasal verbs lexicon once and index it by verb, so that 
+        only the entries whose verb occurs in a line pair need to be checked.
+
+        Parameters
+        ----------
+            path: str
+                path to the phrasal verbs lexicon, one phrasal verb per line. 
+                Default to the lexicon shipped with JaDe.
+
+        Returns
+        -------
+            index: dict
+                {verb: [(entry position, label, patterns)]}
+            verb_lengths: list
+                lengths of the indexed verbs
+            unindexed: list
+                (entry position, label, patterns) of the entries whose verb 
+                contains regex special characters, always checked
+    """
+    index = {}
+    unindexed = []
+
+    with open(path, 'r', encoding='utf-8') as file: 
+        phrasal_verbs = [line.strip() for line in file if line.strip()]
+
+    for position, phrasal in enumerate(phrasal_verbs): 
+        verb, label, patterns = compile_phrasal_verb(phrasal)
+        if re.escape(verb) == verb:
+            index.setdefault(verb, []).append((position, label, patterns))
+        else: 
+            unindexed.append((position, label, patterns))
+
+    verb_lengths = sorted(set(len(verb) for verb in index))
+
+    return index, verb_lengths, unindexed
+
+
+def detect_phrasal_verb(line_pair, path=PHRASAL_VERBS): 
     """
         Retrieve the type of enjambment present in a sentence based on a list
         of phrasal verbs. 
 
+        Patterns are not anchored to word boundaries, so a verb can occur 
+        anywhere inside a space-separated chunk of the line pair: every 
+        substring having the length of an indexed verb is looked up. 
+
         Parameters
         ----------
             line_pair: str
                 line pair as found in the poem 
+            path: str
+                path to the phrasal verbs lexicon. Default to the lexicon 
+                shipped with JaDe.
         Returns
         -------
             types: list
                 detected types
     """
-    types =  []
-    with open('JaDe/resources/phrasal_verbs.txt', 'r', encoding='utf-8') as file: 
-        phrasal_verbs = file.readlines()
-
+    index, verb_lengths, unindexed = load_phrasal_index(path)
 
-    for phrasal in phrasal_verbs: 
-        phrasal = phrasal.strip()
-        object_pattern = r'some\w*'
+    candidates = set()
+    for chunk in re.split(r'[ \t]', line_pair):
+        for length in verb_lengths:
+            for start in range(len(chunk) - length + 1):
+                verb = chunk[start:start+length]
+                if verb in index:
+                    candidates.add(verb)
 
-        split_phrasal = phrasal.split(' ')
-        if re.sub(object_pattern, '', " ".join(split_phrasal[1:])):
-            particle = re.sub(object_pattern, '', " ".join(split_phrasal[1:])).strip()
-        else: 
-            particle  = split_phrasal[1]
-        verb = split_phrasal[0]
-        ing_verb = verb + '(.?ing|e?d|t)? '
-        phrasal = ing_verb + ' '.join(split_phrasal[1:])
-        
-        if re.search(object_pattern, phrasal): 
-            ex_verb_pattern_1 = verb + r'(.?ing|e?d|t)?( \w*){1,3}' + r'\t( ?\w*){0,3} ' + particle
-            ex_verb_pattern_2 = verb + r'(.?ing|e?d|t)?' + ' ' + particle + r'\t( ?\w*){1,3}'
-            ex_verb_pattern_3 = verb + r'(.?ing|e?d|t)?( \w*){0,3}' + r'\t( ?\w*){1,3} ' + particle
-
-            ex_verb_pattern_2 = ex_verb_pattern_2.replace(' \\t', '\\t')
-            ex_verb_pattern_1 = ex_verb_pattern_1.replace( ' \\t', '\\t')
+    entries = list(unindexed)
+    for verb in candidates: 
+        entries.extend(index[verb])
 
-            if re.search(ex_verb_pattern_1, line_pair, flags=re.MULTILINE) \
-                or re.search(ex_verb_pattern_2, line_pair, flags=re.MULTILINE):
-                types.append('ex_dobj_pverb')
-            
-        else: 
-            pb_phrasal = ing_verb + '\\t' + ' '.join(split_phrasal[1:])
-            pb_phrasal = pb_phrasal.replace(' \\t', '\\t')
-            pb_phrasal = re.sub(object_pattern+' ', '', pb_phrasal)
-
-            if re.search(pb_phrasal, line_pair, flags=re.MULTILINE): 
-                types.append('pb_phrasal_verb')
+    types = []
+    for _, label, patterns in sorted(entries, key=lambda entry: entry[0]):
+        if any(pattern.search(line_pair) for pattern in patterns):
+            types.append(label)
 
-    return types
\ No newline at end of file
+    return types
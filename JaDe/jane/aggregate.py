@@ -0,0 +1,240 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file gathers the label counts of annotated files, reading them
+   line by line and counting straight into counters, so that large annotated
+   corpora can be charted with bounded memory.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import pathlib
+import re
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
+
+# summary written by JaDe's run.py in each output directory
+SUMMARY_NAME = '.jade_summary.json'
+GROUP_KEYS = ['directory', 'poem', 'stanza_position']
+ANNOTATION = re.compile(r'\[(.*?)\]')
+# number of files sent at once to a worker
+CHUNK_SIZE = 64
+# number of chunks per worker submitted ahead of the results
+IN_FLIGHT = 2
+
+
+def read_summary(directory):
+    """
+        Read the label counts from the summary JaDe keeps in the directory,
+        provided that the annotated files are the ones it summarises: same
+        files, none of them modified since.
+
+        Parameters
+        ----------
+            directory: pathlib.Path
+                path to the annotated files
+
+        Returns
+        -------
+            counts: dict
+                {label: number of occurrences}, None if the directory has no
+                up-to-date summary
+    """
+    try:
+        with open(str(directory / SUMMARY_NAME), 'r', encoding='utf-8') as file:
+            summary = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    files = {file.name: file for file in directory.glob('*.txt')}
+    summarised = [entry for entry in summary.get('poems', {}).values() if entry.get('outfile')]
+    if len(summarised) != len(files):
+        return None
+    for entry in summarised:
+        file = files.get(entry['outfile'])
+        if file is None:
+            return None
+        stat = file.stat()
+        if stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+            return None
+
+    return summary['totals']['labels']
+
+
+def count_file(job):
+    """
+        Count the labels of an annotated file, reading it line by line.
+
+        Parameters
+        ----------
+            job: tuple
+                path to the file, name of its directory and the group key,
+                one of GROUP_KEYS. Stanza positions start from 1, blank lines
+                separating stanzas.
+
+        Returns
+        -------
+            counts: dict
+                {group: Counter of labels}
+    """
+    path, directory, group_by = job
+    counts = {}
+    position = 0
+
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if len(line.strip()) == 0:
+                position = 0
+                continue
+            position += 1
+            labels = ANNOTATION.findall(line)
+            if len(labels) == 0:
+                continue
+
+            if group_by == 'directory':
+                group = directory
+            elif group_by == 'poem':
+                group = directory + '/' + os.path.splitext(os.path.basename(path))[0]
+            else:
+                group = position
+            counts.setdefault(group, Counter()).update(labels)
+
+    return counts
+
+
+def count_files(jobs):
+    """
+        Count the labels of several annotated files, see count_file.
+    """
+    counts = {}
+    for job in jobs:
+        merge_counts(counts, count_file(job))
+
+    return counts
+
+
+def merge_counts(groups, counts):
+    """
+        Add the label counts of a file or a chunk of files to those gathered
+        so far, group by group.
+    """
+    for group, labels in counts.items():
+        groups.setdefault(group, Counter()).update(labels)
+
+
+def iter_jobs(directories, group_by):
+    """
+        Lazily list the annotated files of several directories.
+    """
+    for directory in directories:
+        with os.scandir(str(directory)) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.txt'):
+                    yield entry.path, pathlib.Path(directory).name, group_by
+
+
+def aggregate(directories, group_by='directory', workers=1, processes=True, use_summaries=True):
+    """
+        Count the labels of the annotated files of several directories, by
+        group. Files are read line by line and their counts merged as they
+        come, so that memory only depends on the number of groups and labels.
+
+        Parameters
+        ----------
+            directories: list
+                paths to the annotated files, eg one directory per author
+            group_by: str
+                `directory` (default), `poem` or `stanza_position`, ie the
+                position of the run-on line in its stanza
+            workers: int
+                number of workers reading the files. Default to 1.
+            processes: bool
+                whether the workers are processes (default) or threads
+            use_summaries: bool
+                whether up-to-date directory summaries are used instead of
+                reading the files, when grouping by directory
+
+        Returns
+        -------
+            groups: dict
+                {group: Counter of labels}
+    """
+    if group_by not in GROUP_KEYS:
+        raise ValueError('Unknown group key: ' + str(group_by))
+
+    groups = {}
+    remaining = []
+    for directory in directories:
+        directory = pathlib.Path(directory)
+        counts = read_summary(directory) if use_summaries and group_by == 'directory' else None
+        if counts is not None:
+            groups[directory.name] = Counter(counts)
+        else:
+            remaining.append(directory)
+
+    jobs = iter_jobs(remaining, group_by)
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+        with executor:
+            # chunks are submitted as results come back, so that the files
+            # listed and the counts pending stay bounded
+            pending = set()
+            chunks = iter(lambda: list(islice(jobs, CHUNK_SIZE)), [])
+            for chunk in chunks:
+                pending.add(executor.submit(count_files, chunk))
+                if len(pending) >= IN_FLIGHT * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        merge_counts(groups, future.result())
+            for future in pending:
+                merge_counts(groups, future.result())
+    else:
+        for counts in map(count_file, jobs):
+            merge_counts(groups, counts)
+
+    return groups
+
+
+def to_multibars_data(groups, max_groups=None):
+    """
+        Format group counts as expected by charmak.multibars_plot:
+        {enjambment_types: [types], group_1: [0,1,2.], group_2: [3,4,5]}
+
+        Parameters
+        ----------
+            groups: dict
+                {group: Counter of labels}, as returned by aggregate
+            max_groups: int
+                if given, only the groups with the most labels are kept
+
+        Returns
+        -------
+            data: dict
+    """
+    names = sorted(groups, key=lambda group: (-sum(groups[group].values()), str(group)))
+    if max_groups is not None:
+        names = names[:max_groups]
+    if all(isinstance(name, int) for name in names):
+        names = sorted(names)
+    types = sorted(set(label for name in names for label in groups[name]))
+
+    data = {'enjambment_types': types}
+    for name in names:
+        data[str(name)] = [groups[name].get(label, 0) for label in types]
+
+    return data
@@ -20,74 +20,64 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import os 
+import argparse
 import pathlib
-import re
-import sys
 from bokeh.io import show
 from bokeh.layouts import gridplot
 from bokeh.models import ColumnDataSource
 from bokeh.palettes import cividis
-from charmak.diagrams import classic_barplot
+from aggregate import aggregate, to_multibars_data, GROUP_KEYS
+from charmak.diagrams import classic_barplot, multibars_plot
 
-def get_annotation(directory): 
+def get_label_counts(directory, workers=1):
     """
-        Retrieve JaDe's annotations in a given directory. 
+        Count the occurrences of each label in a directory, from its summary
+        if it is up to date, otherwise from the annotated files, see 
+        aggregate.aggregate. 
 
         Parameters
         ----------
             directory: pathlib.Path
-                path to the annotated file
-    
+                path to the annotated files
+            workers: int
+                number of processes reading the files
+
         Returns
         -------
-            directory_annotations: list
-                list of every annotation found in the directory
+            counts: dict
+                {label: number of occurrences}
     """
-    directory_annotations = []
-    for file in directory.iterdir():
+    groups = aggregate([directory], 'directory', workers)
 
-        with open(str(file), 'r', encoding='utf-8') as curfile: 
-            poem = curfile.read()
-            annotations = re.findall(r'\[.*?\]', poem, flags=re.MULTILINE)
-        
-        for annotation in annotations:
-            directory_annotations.append(annotation)
+    return dict(groups.get(directory.name, {}))
 
-    return directory_annotations
 
-
-def build_plot_dict_list(new_values, existing_list=None): 
+def build_multibars_data(directories, group_by='directory', workers=1, max_groups=None):
     """
-        Updates values of a given list. 
-
-        When building the data required for multi bars plot from different 
-        directory (eg authors from a given century if each author has their own 
-        directory), the number of occurrences of a given type may need to be 
-        updated (dictionary for multi_bar_plot() should look like: 
-        {enjambment_types: [types], compared_value_1: [0,1,2.], 
-        compared_value_2: [3,4,5]})
+        Gather the label counts of several directories (eg one per author) 
+        in the format expected by charmak.multibars_plot: 
+        {enjambment_types: [types], group_1: [0,1,2.], group_2: [3,4,5]}
 
         Parameters
         ----------
-            existing_list: list
-                
-    """
-    if len(existing_list) > 0 or existing_list is None:
-        tmp_list = []
-        for i in range(len(new_values)):
-            tmp_value = existing_list[i] + new_values[i]
-            tmp_list.append(tmp_value)
-        
-        return tmp_list
-
-    else: 
-        existing_list = new_values
+            directories: list
+                paths (pathlib.Path) to the annotated files
+            group_by: str
+                one bar per directory (default), poem or position of the line
+                in its stanza (`stanza_position`)
+            workers: int
+                number of processes reading the files
+            max_groups: int
+                if given, only the groups with the most labels are plotted
 
-        return existing_list
+        Returns
+        -------
+            data: dict
+    """
+    return to_multibars_data(aggregate(directories, group_by, workers), max_groups)
 
 
-def run(working_dir, title):
+def run(working_dirs, title, group_by='directory', workers=1, max_groups=10):
     """
         The goal is to provide a quick way to build classic diagrams and give 
         an example on how the data need to be built for other kinds of charts, 
@@ -95,31 +85,46 @@ def run(working_dir, title):
 
         The two arguments, working_dir and title, are to be given when running 
         the script, for ex: `python run.py /path/to/annotated/files chart_name`.
+        Several directories can be given before the title, in which case they
+        are compared in a multibars plot, eg 
+        `python run.py annotated_sylvia_plath annotated_charles_bukowski chart_name`.
+
+        Label counts are read from the summary JaDe writes in output 
+        directories when it is up to date, so that annotated files are only
+        read when there is none. Files are then streamed, line by line, by 
+        `--workers` processes. With `--group_by poem` or 
+        `--group_by stanza_position`, counts are compared per poem or per 
+        position of the run-on line in its stanza rather than per directory.
 
         More details on the arguments accepted by each type of diagram can 
         be found in charmak.diagrams' docstring or in the project documentation.
 
         Parameters
         ----------
-            working_dir: str
-                path to the annotated files
+            working_dirs: list
+                paths to the annotated files
 
             title: str
                 title of the chart to be built 
-    """
 
-    working_path = pathlib.Path(working_dir)
-    annotations = get_annotation(working_path)
+            group_by: str
+                how counts are grouped when several groups are compared
+
+            workers: int
+                number of processes reading the annotated files
 
-    chart_data = {}
-    
-    for annotation in annotations: 
-        annotation = annotation.replace('[', '').replace(']', '')
-        try: 
-            chart_data[annotation] += 1 
-        except KeyError: 
-            chart_data[annotation] = 1
+            max_groups: int
+                maximum number of groups plotted, those with the most labels
+                being kept
+    """
+    if len(working_dirs) > 1 or group_by != 'directory':
+        data = build_multibars_data([pathlib.Path(working_dir) for working_dir in working_dirs], group_by, 
+                                    workers, max_groups)
+        chart = multibars_plot(data, title, orientation='vertical', y_margin=5)
+        show(gridplot([[chart]]))
+        return
 
+    chart_data = get_label_counts(pathlib.Path(working_dirs[0]), workers)
 
     x_axis = list(chart_data.keys())
     y_axis = list(chart_data.values())
@@ -133,5 +138,11 @@ def run(working_dir, title):
 
 
 if __name__ == "__main__":
-    working_dir, title = sys.argv[1:]
-    run(working_dir, title)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build enjambment charts from annotated files")
+    parser.add_argument('working_dirs', nargs='+', help="Paths to the annotated files")
+    parser.add_argument('title', help="Title of the chart")
+    parser.add_argument('--group_by', default='directory', choices=GROUP_KEYS)
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--max_groups', default=10, type=int)
+    args = parser.parse_args()
+    run(args.working_dirs, args.title, args.group_by, args.workers, args.max_groups)
\ No newline at end of file
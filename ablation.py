@@ -0,0 +1,325 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file runs what-if experiments on the rules: variants of the
+   classifiers are evaluated against the test data from features extracted
+   once, see `python ablation.py --help`.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import time
+import click
+from JaDe.jade.cache import ParseCache, CACHE_SIZE
+from JaDe.jade.features import classify_features, extract_features, get_feature_settings, load_features, \
+    save_features, CLASSIFIER_ORDER, FEATURES_NAME
+from JaDe.jade.gold import load_gold
+from JaDe.jade.labels import decode, encode, filter_label, DEPENDENCY_TYPES, EMPTY
+from JaDe.jade.processing import load_pipeline, BATCH_SIZE, PARSE_MODES
+from JaDe.jade.store import hash_text
+from JaDe.jade.utils import compile_pos_rules, POS_RULES
+from evaluation import filter_unannotated, get_label_f1, get_scores, get_test_files, read_test_data, DETECTED_DIR, \
+    GOLD_STORE_PATH
+
+FEATURES_PATH = DETECTED_DIR + '/' + FEATURES_NAME
+# widest context window tried, in words on each side of the break
+MAX_WINDOW = 3
+# number of labels whose f1-score changed listed for each variant
+SHOWN_LABELS = 3
+
+# features and gold labels of the test data, shared by the workers
+_shared = {}
+
+
+def widen_pattern(pattern, window):
+    """
+        Let a POS rule skip up to window - 1 words on each side of the break,
+        between the break and the words the rule looks at. Rules already
+        looking further than the words around the break are left as they are.
+    """
+    gap = '(?:\\S+ ){0,' + str(window - 1) + '}'
+
+    return re.sub(r' (SPACE|_SP) ', lambda match: ' ' + gap + match.group(1) + ' ' + gap, pattern)
+
+
+def make_variant(name, rules=POS_RULES, window=1, disabled=(), multiclassification=True, order=CLASSIFIER_ORDER):
+    """
+        Describe a variant of the `all` classifier, see
+        features.classify_features. The default arguments describe the rules
+        as they are.
+    """
+    return {'name': name, 'rules': list(rules), 'window': window, 'disabled': list(disabled),
+            'multiclassification': multiclassification, 'order': list(order)}
+
+
+def get_variants(max_window=MAX_WINDOW):
+    """
+        List the variants of the rules to be evaluated: the rules as they are,
+        each POS rule, dependency type and classifier disabled, each POS rule
+        given the highest priority, every order of the classifiers, no
+        arbitration between dependency types and wider context windows.
+    """
+    variants = [make_variant('baseline')]
+    ranked_rules = sorted(POS_RULES, key=lambda rule: rule[3])
+    names = [f'regex rule {rank + 1} ({rule[2]}, {rule[1]})' for rank, rule in enumerate(ranked_rules)]
+
+    for rank, name in enumerate(names):
+        variants.append(make_variant('no ' + name, ranked_rules[:rank] + ranked_rules[rank + 1:]))
+    for rank, name in enumerate(names[1:], 1):
+        first = ranked_rules[rank][:3] + (ranked_rules[0][3] - 1,)
+        variants.append(make_variant(name + ' first', ranked_rules[:rank] + [first] + ranked_rules[rank + 1:]))
+    for dep_type in DEPENDENCY_TYPES:
+        variants.append(make_variant('no dependency ' + dep_type, disabled=[dep_type.strip('[]')]))
+    variants.append(make_variant('no multiclassification handling', multiclassification=False))
+
+    for classifier in CLASSIFIER_ORDER:
+        variants.append(make_variant('no ' + classifier + ' classifier',
+                                     order=[name for name in CLASSIFIER_ORDER if name != classifier]))
+    for order in itertools.permutations(CLASSIFIER_ORDER):
+        if list(order) != CLASSIFIER_ORDER:
+            variants.append(make_variant('order ' + ' > '.join(order), order=order))
+
+    for window in range(2, max_window + 1):
+        widened_rules = [(widen_pattern(rule[0], window),) + rule[1:] for rule in POS_RULES]
+        variants.append(make_variant(f'regex window {window}', widened_rules))
+        variants.append(make_variant(f'dependency window {window}', window=window))
+        variants.append(make_variant(f'regex and dependency window {window}', widened_rules, window))
+
+    return variants
+
+
+def _init_worker(features, gold):
+    _shared['features'] = features
+    _shared['gold'] = gold
+
+
+def evaluate_variant(variant):
+    """
+        Annotate the test data with a variant of the rules, from its features,
+        and score it against the manual annotation.
+
+        Returns
+        -------
+            name: str
+                name of the variant
+            scores: dict
+                detection and classification accuracy, macro f1-score and
+                {label: f1-score}
+    """
+    compiled_rules = compile_pos_rules(variant['rules'])
+    manual_annotations = []
+    automatic_annotations = []
+
+    for key, (line_numbers, labels) in _shared['gold'].items():
+        predicted = {pair['line']: filter_label(classify_features(pair, compiled_rules, variant['window'],
+                                                                  variant['disabled'],
+                                                                  variant['multiclassification'],
+                                                                  variant['order']), 'all')
+                     for pair in _shared['features'].get(key, [])}
+        manual_annotations.extend(labels)
+        automatic_annotations.extend(predicted.get(line_number, EMPTY) for line_number in line_numbers)
+
+    # labels are coded by each worker, and scores returned by label
+    manual_annotations, automatic_annotations = encode(manual_annotations), encode(automatic_annotations)
+    detection_accuracy, classification_accuracy, macro_f1 = get_scores(manual_annotations, automatic_annotations)
+    labels, f1 = get_label_f1(*filter_unannotated(manual_annotations, automatic_annotations))
+
+    return variant['name'], {'detection_acc': float(detection_accuracy),
+                             'classif_acc': float(classification_accuracy), 'macro_f1': float(macro_f1),
+                             'f1': dict(zip(decode(labels), f1.tolist()))}
+
+
+def evaluate_variants(variants, features, gold, workers=1):
+    """
+        Evaluate variants of the rules, by a pool of processes if several
+        workers are given, see evaluate_variant.
+
+        Parameters
+        ----------
+            variants: list
+                see get_variants
+            features: dict
+                features of the test data, see features.extract_features
+            gold: dict
+                {key: (line numbers, labels)} of the manually annotated lines
+            workers: int
+                number of processes evaluating the variants
+
+        Returns
+        -------
+            results: dict
+                {name: scores}, in the order of the variants
+    """
+    if workers > 1:
+        with multiprocessing.Pool(workers, _init_worker, (features, gold)) as pool:
+            return dict(pool.imap(evaluate_variant, variants))
+
+    _init_worker(features, gold)
+
+    return dict(map(evaluate_variant, variants))
+
+
+def rank_variants(results, baseline='baseline'):
+    """
+        Compare every variant with the baseline.
+
+        Returns
+        -------
+            rows: list
+                one dict per variant, with its scores, its macro f1-score delta
+                and {label: f1-score delta} for the labels whose f1-score
+                changed, by decreasing delta
+    """
+    reference = results[baseline]
+    rows = []
+    for name, scores in results.items():
+        label_deltas = {label: f1 - reference['f1'][label] for label, f1 in scores['f1'].items()}
+        rows.append(dict(scores, variant=name, delta=scores['macro_f1'] - reference['macro_f1'],
+                         label_deltas={label: round(delta, 4) for label, delta in
+                                       sorted(label_deltas.items(), key=lambda item: -abs(item[1]))
+                                       if abs(delta) > 1e-9}))
+
+    return sorted(rows, key=lambda row: -row['delta'])
+
+
+def print_ranking(rows, top=None):
+    """
+        Print the variants by decreasing macro f1-score delta, with the labels
+        whose f1-score changed the most.
+    """
+    print('rank\tmacro_f1\tdelta\t\tclassif_acc\tdetection_acc\tvariant\tlabel deltas')
+    for rank, row in enumerate(rows[:top] if top else rows, 1):
+        shown = ', '.join(f'{label} {delta:+.3f}' for label, delta in
+                          list(row['label_deltas'].items())[:SHOWN_LABELS])
+        if len(row['label_deltas']) > SHOWN_LABELS:
+            shown += f' (+{len(row["label_deltas"]) - SHOWN_LABELS} more)'
+        print(f'{rank}\t{row["macro_f1"]:.3f}\t\t{row["delta"]:+.3f}\t\t{row["classif_acc"]:.3f}\t\t'
+              f'{row["detection_acc"]:.3f}\t\t{row["variant"]}\t{shown}')
+
+
+def get_features(model, batch_size=BATCH_SIZE, parse_mode='pair', extract=False, cache_dir=None,
+                 cache_size=CACHE_SIZE):
+    """
+        Retrieve the features of the test data, only loading the model and
+        parsing the test data if they are missing or out of date.
+    """
+    test_data = read_test_data()
+    hashes = {key: hash_text(poem) for key, poem in test_data.items()}
+    settings = get_feature_settings(model, parse_mode)
+
+    features = None if extract else load_features(FEATURES_PATH, hashes, settings)
+    if features is None:
+        start = time.perf_counter()
+        nlp = load_pipeline(model, 'all')
+        cache = ParseCache(cache_dir, nlp, cache_size) if cache_dir is not None else None
+        features = extract_features(test_data.items(), nlp, batch_size, parse_mode, cache)
+        if cache is not None:
+            cache.save()
+        if not os.path.exists(DETECTED_DIR):
+            os.mkdir(DETECTED_DIR)
+        save_features(FEATURES_PATH, features, hashes, settings)
+        print(f'Features extracted in {time.perf_counter() - start:.2f}s')
+
+    return features
+
+
+@click.command()
+@click.option('--model', help="Language model to be used", default='en_core_web_sm')
+@click.option('--batch_size', help="Number of line pairs parsed at once by spaCy",
+            default=BATCH_SIZE, type=int)
+@click.option('--parse_mode', help="Parse line pairs on their own or retrieve them from their poem/stanza",
+            default='pair', type=click.Choice(PARSE_MODES, case_sensitive=False))
+@click.option('--extract', help="If set to True, extract the features of test data again", default=False)
+@click.option('--cache_dir', help="Path to a persistent cache of spaCy analyses", default=None)
+@click.option('--cache_size', help="Maximum number of analyses kept in the cache",
+            default=CACHE_SIZE, type=int)
+@click.option('--max_window', help="Widest context window tried, in words on each side of the break",
+            default=MAX_WINDOW, type=int)
+@click.option('--workers', help="Number of processes evaluating the variants",
+            default=os.cpu_count() or 1, type=int)
+@click.option('--top', help="Number of variants printed, all of them by default", default=None, type=int)
+@click.option('--output', help="Path to which the scores of every variant are saved, as JSON", default=None)
+def run(model, batch_size, parse_mode, extract, cache_dir, cache_size, max_window, workers, top, output):
+    """
+        Rule ablation command-line interface.
+        The test data is parsed once, the features the classifiers read from
+        each line pair being stored in JaDe/resources/detected, then variants
+        of the rules are evaluated against the manual annotation from these
+        features by a pool of processes: each regex rule, dependency type
+        and classifier disabled, each regex rule given the highest priority,
+        every order of the classifiers, no arbitration between dependency
+        types, and context windows up to --max_window words on each side of
+        the break. Variants are ranked by macro f1-score delta with the rules
+        as they are, along with the labels whose f1-score changed the most.
+
+        Parameters
+        ----------
+            model: str
+                language model to be used. Default to spaCy smaller model.
+            batch_size: int
+                number of line pairs parsed at once by spaCy when extracting
+                features.
+            parse_mode: str
+                whether line pairs are parsed on their own (`pair`, default) or
+                retrieved from the parse of their poem (`poem`) or stanza
+                (`stanza`).
+            extract: bool
+                whether the features should be extracted again. Default to
+                False, in which case stored features are used if they are up
+                to date.
+            cache_dir: str
+                path to a persistent cache of spaCy analyses. Default to None
+                (no cache).
+            cache_size: int
+                maximum number of analyses kept in the cache.
+            max_window: int
+                widest context window tried. Default to 3.
+            workers: int
+                number of processes evaluating the variants. Default to the
+                number of CPUs.
+            top: int
+                number of variants printed. Default to None (all of them).
+            output: str
+                path to which the scores and deltas of every variant are
+                saved, as JSON. Default to None.
+    """
+    extract = extract in ['true', 'True', True]
+
+    features = get_features(model, batch_size, parse_mode, extract, cache_dir, cache_size)
+    gold = {key: (line_numbers.tolist(), decode(codes['all']))
+            for key, (line_numbers, codes) in load_gold(get_test_files(), GOLD_STORE_PATH).items()
+            if key in features}
+
+    variants = get_variants(max_window)
+    start = time.perf_counter()
+    results = evaluate_variants(variants, features, gold, max(1, workers))
+    elapsed = time.perf_counter() - start
+
+    rows = rank_variants(results)
+    print_ranking(rows, top)
+    print(f'{len(variants)} variants evaluated in {elapsed:.2f}s ({len(variants) / elapsed:.1f} variants/s)')
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump({'variants': variants, 'ranking': rows}, file, indent=2)
+
+
+if __name__ == "__main__":
+    run()
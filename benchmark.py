@@ -0,0 +1,889 @@
+"""
+   JaDe is a command-line tool to automatically detect enjambment in English
+   poetry. This file gathers JaDe's benchmarks. See `python benchmark.py --help`
+   for the list of available benchmarks.
+
+    Copyright (C) 2020  Eulalie Monget
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import fnmatch
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import click
+from JaDe.jade.processing import (get_dependency_arrays, get_line_annotations, get_pair_views, get_parse_units, 
+                                  handle_multiclassification, load_pipeline, prepare_poem, process_poems, 
+                                  remove_annotations, render_poem, BATCH_SIZE, CLASSIFIERS, PARSE_MODES)
+from JaDe.jade.service import make_server, MicroBatcher, MAX_BATCH, MAX_WAIT
+from JaDe.jade.utils import detect_phrasal_verb, get_dep_type, get_pos_type
+
+ANNOT_DIR = r'JaDe/resources/annotated_poems'
+# stages of the pipeline benchmark, in the order they run
+STAGES = ['read', 'remove_annotations', 'prepare_poem', 'parse', 'get_pos_type', 'get_dep_type', 
+          'detect_phrasal_verb', 'handle_multiclassification', 'render', 'write']
+# metrics compared against the baseline, and whether higher is better
+COMPARED_METRICS = {'lines_per_second': True, 'pairs_per_second': True, 'p50_ms': False, 'p95_ms': False}
+# command lines of the startup benchmark, which should return before any model is loaded
+STARTUP_COMMANDS = {'run_help': ['run.py', '--help'], 
+                    'run_error': ['run.py', '--classifier', 'unknown'],
+                    'serve_help': ['run.py', 'serve', '--help'],
+                    'evaluation_help': ['evaluation.py', '--help'],
+                    'evaluation_error': ['evaluation.py', '--batch_size', 'many'],
+                    'ablation_help': ['ablation.py', '--help'],
+                    'benchmark_help': ['benchmark.py', '--help']}
+# dependencies that should only be imported on the code paths that use them
+HEAVY_MODULES = ['spacy', 'numpy', 'fuzzywuzzy', 'tqdm', 'sklearn', 'matplotlib', 'pandas', 'seaborn']
+
+
+def legacy_get_pos_type(sentence):
+    """
+        Regex classifier as it was before the rules were moved to
+        utils.POS_RULES, kept as the reference of the pos_rules benchmark.
+    """
+    DET_NOUN = r'DET SPACE NOUN'
+    NOUN_NOUN = r'NOUN SPACE NOUN'
+    ADJ_NOUN = r'ADJ SPACE NOUN'
+    VBN_NOUN = r'VBN _SP NOUN'
+    ADJ_ADJ = r'ADJ SPACE ADJ'
+    NOUN_PREP = r'NOUN SPACE ADP'
+    CROSS = r'NN _SP (WDT|VBG)'
+    V_CHAIN = r'VERB SPACE AUX|AUX SPACE VERB'
+    ADV_ADV = r'ADV SPACE ADV'
+    VERB_ADV = r'ADV SPACE VERB|VERB SPACE ADV'
+    VBN_ADV = r'RB.? _SP (JJ.?|VBN)'
+    VERB_TO = r'TO _SP VB.?'
+    CPREP = r'VB.? _SP TO'
+    VERB_PREP = r'VB.? _SP IN'
+    COMP = r'(RB|JJ)[RS]( \w*){0,3} _SP( \w*){0,4}((JJ|RB)[RS]|IN)?'
+    SUB_VERB_tag  = r'NN(.+)? _SP VB[^NG].?'
+    DOB_VERB = r'VB.? _SP (\w+ ){0,2}NN(.+)?'
+
+    types = []
+    tag = ""
+    pos = ""
+    text = ""
+
+    for token in sentence:
+        pos += token[1] + " "
+        tag += token[2] + " "
+        text += str(token[0]) + " "
+
+    if re.search(DET_NOUN, pos):
+        types.append('pb_det_noun')
+    elif re.search(ADJ_NOUN, pos) or re.search(VBN_NOUN, tag):
+        types.append('pb_noun_adj')
+    elif re.search(VBN_ADV, tag):
+        types.append('pb_adj_adv')
+    elif re.search(VERB_ADV, pos):
+        types.append('pb_verb_adv')
+    elif re.search(ADV_ADV, pos):
+        types.append('pb_adv_adv')
+    elif re.search(ADJ_ADJ, pos):
+        types.append('pb_adj_adj')
+    elif re.search(NOUN_PREP, pos):
+        types.append('pb_noun_prep')
+    elif re.search(NOUN_NOUN, pos):
+        types.append('pb_noun_noun')
+    elif re.search(CROSS, tag):
+        types.append('cc_cross_clause')
+    elif re.search(VERB_TO, tag):
+        types.append('pb_to_verb')
+    elif re.search(CPREP, tag):
+        types.append('pb_verb_cprep')
+    elif re.search(V_CHAIN, pos):
+        types.append('pb_verb_chain')
+    elif re.search(VERB_PREP, tag):
+        types.append('pb_verb_prep')
+    elif re.search(COMP, tag):
+        types.append('pb_comp')
+    elif re.search(SUB_VERB_tag, tag):
+        types.append('ex_subj_verb')
+    elif re.search(DOB_VERB, tag):
+        types.append('ex_dobj_verb')
+
+    return types
+
+
+def get_tagged_pairs(nlp, data_dir, batch_size=BATCH_SIZE):
+    """
+        Tag the line pairs of a corpus the way the regex classifier sees them.
+
+        Parameters
+        ----------
+            nlp:
+                spacy nlp pipeline
+            data_dir: str
+                path to the directory of poems
+            batch_size: int
+                number of line pairs tagged at once
+
+        Returns
+        -------
+            sentences: list
+                one list of (token, pos, tag) tuples per line pair
+    """
+    texts = []
+    for file in sorted(os.listdir(data_dir)):
+        if fnmatch.fnmatch(file, '*.txt'):
+            with open(os.path.join(data_dir, file), 'r', encoding='utf-8') as poem_file:
+                _, pairs = prepare_poem(poem_file.read())
+            texts.extend(pair[1].lower() for pair in pairs)
+
+    return [[(token, str(token.pos_), str(token.tag_)) for token in doc]
+            for doc in nlp.pipe(texts, batch_size=batch_size)]
+
+
+def get_poem_files(data_dir):
+    """
+        List the poems of a directory, sorted by name.
+    """
+    return [os.path.join(data_dir, file) for file in sorted(os.listdir(data_dir)) if fnmatch.fnmatch(file, '*.txt')]
+
+
+def time_poem_stages(file, out_file, nlp, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair'):
+    """
+        Run the pipeline on a single poem, timing each stage separately.
+
+        The classifiers are called one by one on the parsed line pairs so as 
+        to be timed; get_line_annotations, which runs them again, is not 
+        counted in the timings.
+
+        Returns
+        -------
+            timings: dict
+                {stage: seconds}, see STAGES
+            number_of_lines: int
+                number of non-blank lines of the poem
+            number_of_pairs: int
+                number of line pairs classified
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    start = time.perf_counter()
+    with open(file, 'r', encoding='utf-8') as poem_file:
+        poem = poem_file.read()
+    timings['read'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if re.findall(r'(^\d{1,}\. )(.*)', poem, flags=re.MULTILINE):
+        poem = remove_annotations(poem)
+    timings['remove_annotations'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    poem_lines, pairs = prepare_poem(poem)
+    timings['prepare_poem'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    units = get_parse_units(poem_lines, pairs, parse_mode)
+    if nlp is not None:
+        docs = list(nlp.pipe([text for text, _ in units], batch_size=batch_size))
+    else:
+        docs = [None] * len(units)
+    views = get_pair_views(units, docs, len(pairs))
+    timings['parse'] = time.perf_counter() - start
+
+    for (_, line_pair, _), tagged_sentence in zip(pairs, views):
+        if classifier in ['all', 'dictionary']:
+            start = time.perf_counter()
+            detect_phrasal_verb(line_pair)
+            timings['detect_phrasal_verb'] += time.perf_counter() - start
+
+        if classifier in ['all', 'regex']:
+            start = time.perf_counter()
+            get_pos_type([(token, str(token.pos_), str(token.tag_)) for token in tagged_sentence])
+            timings['get_pos_type'] += time.perf_counter() - start
+
+        if classifier in ['all', 'dependencies']:
+            start = time.perf_counter()
+            dep_types = list(dict.fromkeys(get_dep_type(*get_dependency_arrays(tagged_sentence))))
+            timings['get_dep_type'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            if len(dep_types) > 1:
+                handle_multiclassification(dep_types)
+            timings['handle_multiclassification'] += time.perf_counter() - start
+
+    lines = get_line_annotations(poem_lines, pairs, views, classifier)
+
+    start = time.perf_counter()
+    annotated_poem = render_poem(lines, classifier)
+    timings['render'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(out_file, 'w', encoding='utf-8') as poem_file:
+        poem_file.write(annotated_poem)
+    timings['write'] = time.perf_counter() - start
+
+    return timings, sum(1 for line in lines if line.number is not None), len(pairs)
+
+
+def time_corpus(files, out_dir, nlp, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair'):
+    """
+        Annotate a corpus the way run.py does, line pairs of all the poems 
+        sharing batches, and return the wall-clock time in seconds.
+    """
+    def read_poems():
+        for file in files:
+            with open(file, 'r', encoding='utf-8') as poem_file:
+                yield os.path.join(out_dir, os.path.basename(file)), poem_file.read()
+
+    start = time.perf_counter()
+    for out_file, annotated_poem in process_poems(read_poems(), nlp, classifier, batch_size, parse_mode):
+        with open(out_file, 'w', encoding='utf-8') as poem_file:
+            poem_file.write(annotated_poem)
+
+    return time.perf_counter() - start
+
+
+def compare_to_baseline(results, baseline, threshold, metrics=COMPARED_METRICS):
+    """
+        List the metrics that got worse than the baseline by more than the 
+        threshold, a fraction of the baseline value. Metrics are given as 
+        {metric: whether higher is better}.
+
+        Returns
+        -------
+            regressions: list
+                (metric, baseline value, current value) tuples
+    """
+    regressions = []
+    for metric, higher_is_better in metrics.items():
+        reference = baseline['summary'].get(metric)
+        value = results['summary'][metric]
+        if not reference:
+            continue
+        change = (value - reference) / reference
+        if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+            regressions.append((metric, reference, value))
+
+    return regressions
+
+
+def time_startup(command, repeat):
+    """
+        Run a command line of the repository with a fresh interpreter.
+
+        Returns
+        -------
+            wall_time: float
+                best wall-clock time in seconds, out of repeat runs
+            imports: list
+                (module, self time, cumulative time) tuples of the top-level
+                imports in seconds, as reported by `python -X importtime`
+            modules: list
+                every module imported
+            returncode: int
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    wall_time = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable] + command, cwd=cwd, stdout=subprocess.DEVNULL, 
+                                   stderr=subprocess.DEVNULL)
+        wall_time = min(wall_time, time.perf_counter() - start)
+
+    profiled = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=cwd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    modules = []
+    for line in profiled.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if match is None:
+            continue
+        modules.append(match.group(4))
+        # top-level imports are indented by a single space
+        if len(match.group(3)) == 1:
+            imports.append((match.group(4), int(match.group(1)) / 1e6, int(match.group(2)) / 1e6))
+
+    return wall_time, imports, modules, completed.returncode
+
+
+def time_function(function, sentences, repeat):
+    """
+        Best wall-clock time, in seconds, of classifying every sentence.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for sentence in sentences:
+            function(sentence)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def time_single_requests(poems, nlp, classifier='all', batch_size=BATCH_SIZE, parse_mode='pair'):
+    """
+        Annotate poems one at a time, as processor does for each request of
+        a service without batching, and return the latency of each poem in 
+        seconds.
+    """
+    latencies = []
+    for poem in poems:
+        start = time.perf_counter()
+        for _ in process_poems([(None, poem)], nlp, classifier, batch_size, parse_mode):
+            pass
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def post_poem(url, poem):
+    """
+        Send a poem to the annotation service, retrying while the service 
+        rejects it for having too many poems waiting.
+
+        Returns
+        -------
+            seconds: float
+                latency of the request, retries included
+            rejections: int
+                number of times the poem was rejected
+            status: int
+                HTTP status of the last answer
+    """
+    rejections = 0
+    start = time.perf_counter()
+    while True:
+        request = urllib.request.Request(url + '/annotate', data=poem.encode('utf-8'), 
+                                         headers={'Content-Type': 'text/plain; charset=utf-8'})
+        try:
+            with urllib.request.urlopen(request) as answer:
+                answer.read()
+                return time.perf_counter() - start, rejections, answer.status
+        except urllib.error.HTTPError as err:
+            if err.code != 503:
+                return time.perf_counter() - start, rejections, err.code
+            rejections += 1
+            time.sleep(0.01)
+
+
+def load_test(url, poems, concurrency):
+    """
+        Send poems to the annotation service from concurrent clients.
+
+        Returns
+        -------
+            seconds: float
+                wall-clock time of the whole test
+            answers: list
+                (latency, rejections, status) of each poem, see post_poem
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        answers = list(executor.map(lambda poem: post_poem(url, poem), poems))
+
+    return time.perf_counter() - start, answers
+
+
+def summarise_latencies(seconds, latencies):
+    """
+        Throughput and latency percentiles of a run.
+    """
+    import numpy as np
+
+    latencies = np.array(latencies) * 1e3
+
+    return {'seconds': round(seconds, 6),
+            'poems_per_second': round(len(latencies) / seconds, 2) if seconds else 0.0,
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else 0.0,
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else 0.0}
+
+
+@click.group()
+def benchmark():
+    """
+        JaDe benchmarks.
+    """
+
+
+@benchmark.command('pos_rules')
+@click.option('--model', help="Language model to be used", default='en_core_web_sm')
+@click.option('--data_dir', help="Path to the poems whose line pairs are classified", default=ANNOT_DIR)
+@click.option('--repeat', help="Number of timed runs, the best one being kept", default=5, type=int)
+def pos_rules(model, data_dir, repeat):
+    """
+        Compare the compiled regex classifier with the former chain of
+        re.search calls on the line pairs of a corpus, which are tagged
+        beforehand so that only the classifier is timed.
+
+        Parameters
+        ----------
+            model: str
+                language model to be used. Default to spaCy smaller model.
+            data_dir: str
+                path to the poems. Default to the annotated test data.
+            repeat: int
+                number of timed runs over the corpus. Default to 5.
+    """
+    sentences = get_tagged_pairs(load_pipeline(model, 'regex'), data_dir)
+    mismatches = sum(1 for sentence in sentences if get_pos_type(sentence) != legacy_get_pos_type(sentence))
+
+    legacy = time_function(legacy_get_pos_type, sentences, repeat)
+    compiled = time_function(get_pos_type, sentences, repeat)
+    all_matches = time_function(lambda sentence: get_pos_type(sentence, all_matches=True), sentences, repeat)
+
+    print(len(sentences), 'line pairs,', mismatches, 'classified differently')
+    print('re.search chain: %8.2f us/pair' % (legacy / len(sentences) * 1e6))
+    print('compiled rules:  %8.2f us/pair (x%.1f)' % (compiled / len(sentences) * 1e6, legacy / compiled))
+    print('all matches:     %8.2f us/pair' % (all_matches / len(sentences) * 1e6))
+
+
+@benchmark.command('pipeline')
+@click.option('--model', help="Language model to be used", default='en_core_web_sm')
+@click.option('--classifier', help="Classifier to be run", default="all", 
+            type=click.Choice(CLASSIFIERS, case_sensitive=False))
+@click.option('--data_dir', help="Path to the poems to be annotated", default=ANNOT_DIR)
+@click.option('--batch_size', help="Number of texts parsed at once by spaCy", default=BATCH_SIZE, type=int)
+@click.option('--parse_mode', help="Parse line pairs on their own or retrieve them from their poem/stanza", 
+            default='pair', type=click.Choice(PARSE_MODES, case_sensitive=False))
+@click.option('--repeat', help="Number of timed runs, the best one being kept", default=3, type=int)
+@click.option('--output', help="Path to the JSON file the results are written to", default=None)
+@click.option('--baseline', help="Path to the results of a previous run to compare with", default=None)
+@click.option('--threshold', help="Slowdown, as a fraction of the baseline, above which a metric regressed", 
+            default=0.1, type=float)
+def pipeline(model, classifier, data_dir, batch_size, parse_mode, repeat, output, baseline, threshold):
+    """
+        Time the annotation of a corpus, stage by stage, and report the 
+        results as JSON. 
+
+        The corpus is first annotated poem by poem, each stage being timed 
+        separately, which gives the per-poem latency. It is then annotated 
+        as run.py does, which gives the throughput. Annotated poems are 
+        written to a temporary directory. 
+
+        Parameters
+        ----------
+            model: str
+                language model to be used. Default to spaCy smaller model.
+            classifier: str
+                classifier to be run. Default to all.
+            data_dir: str
+                path to the poems. Default to the annotated test data.
+            batch_size: int
+                number of texts parsed at once by spaCy.
+            parse_mode: str
+                one of processing.PARSE_MODES. Default to pair.
+            repeat: int
+                number of timed runs over the corpus. The lowest time is kept
+                for each stage, poem and throughput. Default to 3.
+            output: str
+                path to the JSON file the results are written to. Default to
+                None, in which case they are printed.
+            baseline: str
+                path to the JSON results of a previous run. If given, the run 
+                fails when the throughput or the latency got worse by more 
+                than the threshold.
+            threshold: float
+                fraction of the baseline value. Default to 0.1.
+    """
+    import numpy as np
+
+    nlp = load_pipeline(model, classifier)
+    files = get_poem_files(data_dir)
+
+    stage_timings = {stage: float('inf') for stage in STAGES}
+    latencies = np.full(len(files), np.inf)
+    corpus_time = float('inf')
+    with tempfile.TemporaryDirectory() as out_dir:
+        for _ in range(repeat):
+            run_timings = dict.fromkeys(STAGES, 0.0)
+            number_of_lines = number_of_pairs = 0
+            for i, file in enumerate(files):
+                timings, poem_lines, poem_pairs = time_poem_stages(file, os.path.join(out_dir, os.path.basename(file)),
+                                                                   nlp, classifier, batch_size, parse_mode)
+                latencies[i] = min(latencies[i], sum(timings.values()))
+                number_of_lines += poem_lines
+                number_of_pairs += poem_pairs
+                for stage, seconds in timings.items():
+                    run_timings[stage] += seconds
+            for stage, seconds in run_timings.items():
+                stage_timings[stage] = min(stage_timings[stage], seconds)
+
+            corpus_time = min(corpus_time, time_corpus(files, out_dir, nlp, classifier, batch_size, parse_mode))
+
+    results = {
+        'settings': {'model': model, 'classifier': classifier, 'batch_size': batch_size, 
+                     'parse_mode': parse_mode, 'data_dir': data_dir, 'repeat': repeat},
+        'corpus': {'poems': len(files), 'lines': number_of_lines, 'pairs': number_of_pairs},
+        'stages': {stage: round(seconds, 6) for stage, seconds in stage_timings.items()},
+        'summary': {
+            'seconds': round(corpus_time, 6),
+            'lines_per_second': round(number_of_lines / corpus_time, 2),
+            'pairs_per_second': round(number_of_pairs / corpus_time, 2),
+            'p50_ms': round(float(np.percentile(latencies, 50)) * 1e3, 3) if len(files) else 0.0,
+            'p95_ms': round(float(np.percentile(latencies, 95)) * 1e3, 3) if len(files) else 0.0,
+        }
+    }
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if baseline is not None:
+        with open(baseline, 'r', encoding='utf-8') as file:
+            regressions = compare_to_baseline(results, json.load(file), threshold)
+        for metric, reference, value in regressions:
+            print('Regression on %s: %s (baseline %s)' % (metric, value, reference), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regression above %d%% of the baseline' % (threshold * 100), file=sys.stderr)
+
+
+
+@benchmark.command('service')
+@click.option('--model', help="Language model to be used", default='en_core_web_sm')
+@click.option('--classifier', help="Classifier to be run", default="all", 
+            type=click.Choice(CLASSIFIERS, case_sensitive=False))
+@click.option('--data_dir', help="Path to the poems sent to the service", default=ANNOT_DIR)
+@click.option('--url', help="URL of a running service, started in-process by default", default=None)
+@click.option('--concurrency', help="Number of concurrent clients", default=16, type=int)
+@click.option('--repeat', help="Number of times each poem is sent", default=3, type=int)
+@click.option('--max_batch', help="Maximum number of poems annotated together", default=MAX_BATCH, type=int)
+@click.option('--max_wait', help="Milliseconds a poem may wait for others to join its batch", 
+            default=MAX_WAIT * 1e3, type=float)
+@click.option('--output', help="Path to the JSON file the results are written to", default=None)
+def service(model, classifier, data_dir, url, concurrency, repeat, max_batch, max_wait, output):
+    """
+        Load test of the annotation service (`python run.py serve`): poems 
+        are sent by concurrent clients, and throughput and latency are 
+        compared with the annotation of the same poems one request at a 
+        time, without batching. Results are reported as JSON, along with 
+        the metrics of the service.
+
+        Parameters
+        ----------
+            model: str
+                language model to be used. Default to spaCy smaller model.
+            classifier: str
+                classifier to be run. Default to all.
+            data_dir: str
+                path to the poems. Default to the annotated test data.
+            url: str
+                URL of a running service, eg http://127.0.0.1:8000. Default
+                to None, in which case a service is started in-process on a
+                free port.
+            concurrency: int
+                number of concurrent clients. Default to 16.
+            repeat: int
+                number of times each poem is sent. Default to 3.
+            max_batch: int
+                maximum number of poems annotated together by the in-process
+                service. Default to 32.
+            max_wait: float
+                milliseconds a poem of the in-process service may wait for 
+                others to join its batch. Default to 10.
+            output: str
+                path to the JSON file the results are written to. Default to
+                None, in which case they are printed.
+    """
+    poems = []
+    for file in get_poem_files(data_dir):
+        with open(file, 'r', encoding='utf-8') as poem_file:
+            poems.append(poem_file.read())
+    poems = poems * repeat
+
+    nlp = load_pipeline(model, classifier)
+    start = time.perf_counter()
+    single_latencies = time_single_requests(poems, nlp, classifier)
+    single = summarise_latencies(time.perf_counter() - start, single_latencies)
+
+    server = batcher = None
+    if url is None:
+        batcher = MicroBatcher(nlp, classifier, max_batch=max_batch, max_wait=max_wait / 1e3)
+        server = make_server(batcher, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        batcher.start()
+        url = 'http://%s:%d' % server.server_address[:2]
+
+    try:
+        seconds, answers = load_test(url, poems, concurrency)
+        with urllib.request.urlopen(url + '/metrics') as answer:
+            metrics = json.loads(answer.read().decode('utf-8'))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            batcher.stop()
+
+    served = summarise_latencies(seconds, [latency for latency, _, _ in answers])
+    served['rejections'] = sum(rejections for _, rejections, _ in answers)
+    served['errors'] = sum(1 for _, _, status in answers if status != 200)
+
+    results = {
+        'settings': {'model': model, 'classifier': classifier, 'data_dir': data_dir, 'url': url, 
+                     'concurrency': concurrency, 'repeat': repeat, 'max_batch': max_batch, 'max_wait_ms': max_wait},
+        'single_request': single,
+        'service': served,
+        'speedup': round(served['poems_per_second'] / single['poems_per_second'], 2) 
+                   if single['poems_per_second'] else 0.0,
+        'metrics': metrics
+    }
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+def request_service(url, path, body=None, content_type='text/plain; charset=utf-8'):
+    """
+        Send a request to the annotation service, GET without body and POST
+        otherwise.
+
+        Returns
+        -------
+            status: int
+                HTTP status of the answer
+            headers: dict
+                headers of the answer
+            content: dict
+                JSON content of the answer
+    """
+    data = body.encode('utf-8') if body is not None else None
+    request = urllib.request.Request(url + path, data=data, headers={'Content-Type': content_type} if data else {})
+    try:
+        with urllib.request.urlopen(request) as answer:
+            return answer.status, dict(answer.headers), json.loads(answer.read().decode('utf-8'))
+    except urllib.error.HTTPError as err:
+        return err.code, dict(err.headers), json.loads(err.read().decode('utf-8'))
+
+
+def wait_for_queue(batcher, depth, timeout=5.0):
+    """
+        Wait until depth poems are waiting in the queue of a batcher.
+    """
+    deadline = time.perf_counter() + timeout
+    while batcher.queue.qsize() < depth and time.perf_counter() < deadline:
+        time.sleep(0.005)
+
+    return batcher.queue.qsize() >= depth
+
+
+def check_service(poem, max_batch=4, max_wait=0.2, queue_size=10):
+    """
+        Check the behaviour of the annotation service from a local client.
+        The dictionary classifier, which needs no model, stands in for the
+        pipeline: batching, rejection and the HTTP interface do not depend
+        on the classifier.
+
+        Poems are queued before the batcher is started, so that the queue is
+        full and batches are formed from poems that are all waiting already.
+
+        Returns
+        -------
+            checks: dict
+                {name: (passed, detail)}
+    """
+    checks = {}
+    batcher = MicroBatcher(None, 'dictionary', max_batch=max_batch, max_wait=max_wait, queue_size=queue_size)
+    server = make_server(batcher, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://%s:%d' % server.server_address[:2]
+
+    try:
+        with ThreadPoolExecutor(queue_size) as executor:
+            waiting = [executor.submit(request_service, url, '/annotate', poem) for _ in range(queue_size)]
+            queued = wait_for_queue(batcher, queue_size)
+            status, headers, _ = request_service(url, '/annotate', poem)
+            checks['queue_full_rejected'] = (queued and status == 503 and headers.get('Retry-After') == '1',
+                                             {'queued': queued, 'status': status,
+                                              'retry_after': headers.get('Retry-After')})
+            _, _, metrics = request_service(url, '/metrics')
+            checks['queue_depth_reported'] = (metrics['queue_depth'] == queue_size and metrics['rejected'] == 1,
+                                              {'queue_depth': metrics['queue_depth'],
+                                               'rejected': metrics['rejected']})
+
+            batcher.start()
+            statuses = [future.result()[0] for future in waiting]
+        expected_sizes = [max_batch] * (queue_size // max_batch) + ([queue_size % max_batch]
+                                                                    if queue_size % max_batch else [])
+        checks['queued_poems_answered'] = (statuses == [200] * queue_size, {'statuses': statuses})
+        checks['batches_up_to_max_batch'] = (list(batcher.batch_sizes) == expected_sizes,
+                                             {'batch_sizes': list(batcher.batch_sizes), 'expected': expected_sizes})
+
+        # a poem alone waits max_wait for others, then is annotated alone
+        start = time.perf_counter()
+        status, _, _ = request_service(url, '/annotate', poem)
+        latency = time.perf_counter() - start
+        checks['batch_closed_after_max_wait'] = (status == 200 and latency >= max_wait
+                                                 and batcher.batch_sizes[-1] == 1,
+                                                 {'status': status, 'latency_ms': round(latency * 1e3, 3),
+                                                  'batch_size': batcher.batch_sizes[-1]})
+
+        # a poem sent within max_wait of another joins its batch
+        with ThreadPoolExecutor(2) as executor:
+            first = executor.submit(request_service, url, '/annotate', poem)
+            time.sleep(max_wait / 4)
+            second = executor.submit(request_service, url, '/annotate', poem)
+            statuses = [first.result()[0], second.result()[0]]
+        checks['batch_joined_within_max_wait'] = (statuses == [200, 200] and batcher.batch_sizes[-1] == 2,
+                                                  {'statuses': statuses, 'batch_size': batcher.batch_sizes[-1]})
+
+        plain = request_service(url, '/annotate', poem)
+        as_json = request_service(url, '/annotate', json.dumps({'poem': poem}), 'application/json')
+        checks['json_and_plain_text_bodies'] = (plain[0] == 200 and as_json[0] == 200 and plain[2] == as_json[2]
+                                                and len(plain[2]['lines']) == len(poem.split('\n')),
+                                                {'statuses': [plain[0], as_json[0]],
+                                                 'same_answer': plain[2] == as_json[2]})
+
+        invalid = [request_service(url, '/annotate', '{"poem":', 'application/json')[0],
+                   request_service(url, '/annotate', '{"text": "a poem"}', 'application/json')[0],
+                   request_service(url, '/annotate', '{"poem": 3}', 'application/json')[0],
+                   request_service(url, '/poems', poem)[0], request_service(url, '/annotation')[0]]
+        checks['invalid_requests'] = (invalid == [400, 400, 400, 404, 404],
+                                      {'statuses': invalid, 'expected': [400, 400, 400, 404, 404]})
+
+        status, _, metrics = request_service(url, '/metrics')
+        fields = ['requests', 'rejected', 'failed', 'batches', 'poems', 'queue_depth', 'queue_size', 'max_batch',
+                  'max_wait_ms', 'mean_batch_size', 'last_batch_size', 'latency_p50_ms', 'latency_p99_ms',
+                  'uptime_seconds']
+        counts = {'requests': queue_size + 5, 'rejected': 1, 'failed': 0, 'poems': queue_size + 5,
+                  'queue_depth': 0, 'queue_size': queue_size, 'max_batch': max_batch, 'last_batch_size': 1}
+        checks['metrics_fields'] = (status == 200 and sorted(metrics) == sorted(fields)
+                                    and all(metrics[name] == value for name, value in counts.items())
+                                    and metrics['latency_p50_ms'] <= metrics['latency_p99_ms'],
+                                    {'status': status, 'metrics': metrics})
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.stop()
+
+    return checks
+
+
+@benchmark.command('service_check')
+@click.option('--output', help="Path to the JSON file the results are written to", default=None)
+def service_check(output):
+    """
+        Check the annotation service from a local client, without any model
+        (see check_service): 503 with Retry-After when the queue is full,
+        batches of up to max_batch poems closed after max_wait, JSON and
+        plain-text bodies, invalid requests and the fields of /metrics. The
+        run fails if a check does not pass.
+
+        Parameters
+        ----------
+            output: str
+                path to the JSON file the results are written to. Default to
+                None, in which case they are printed.
+    """
+    poem = 'I was looking up\nat the wide sky, and\nthe stars came out.'
+    checks = check_service(poem)
+    results = {name: {'passed': passed, 'detail': detail} for name, (passed, detail) in checks.items()}
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    failures = [name for name, (passed, _) in checks.items() if not passed]
+    for name in failures:
+        print('Check failed:', name, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+@benchmark.command('startup')
+@click.option('--repeat', help="Number of timed runs, the best one being kept", default=5, type=int)
+@click.option('--budget', help="Seconds within which every command line should return", default=1.0, type=float)
+@click.option('--output', help="Path to the JSON file the results are written to", default=None)
+@click.option('--baseline', help="Path to the results of a previous run to compare with", default=None)
+@click.option('--threshold', help="Slowdown, as a fraction of the baseline, above which a metric regressed", 
+            default=0.2, type=float)
+def startup(repeat, budget, output, baseline, threshold):
+    """
+        Time the startup of the command-line tools: `--help` and argument
+        errors, which should return before any model is loaded. Import 
+        times are broken down with `python -X importtime`, and the run fails
+        if a command line exceeds the budget or imports a heavy dependency 
+        (spaCy, sklearn, matplotlib...) it does not use.
+
+        Parameters
+        ----------
+            repeat: int
+                number of timed runs of each command line. The lowest time 
+                is kept. Default to 5.
+            budget: float
+                seconds. Default to 1.
+            output: str
+                path to the JSON file the results are written to. Default to
+                None, in which case they are printed.
+            baseline: str
+                path to the JSON results of a previous run. If given, the run
+                fails when a command line got slower by more than the 
+                threshold.
+            threshold: float
+                fraction of the baseline value. Default to 0.2.
+    """
+    commands = {}
+    failures = []
+    for name, command in STARTUP_COMMANDS.items():
+        wall_time, imports, modules, returncode = time_startup(command, repeat)
+        heavy_imports = sorted(set(module.split('.')[0] for module in modules) & set(HEAVY_MODULES))
+        commands[name] = {
+            'command': ' '.join(command),
+            'returncode': returncode,
+            'wall_ms': round(wall_time * 1e3, 3),
+            'import_ms': round(sum(cumulative for _, _, cumulative in imports) * 1e3, 3),
+            'slowest_imports': [[module, round(cumulative * 1e3, 3)] 
+                                for module, _, cumulative in sorted(imports, key=lambda item: -item[2])[:5]],
+            'heavy_imports': heavy_imports
+        }
+        if wall_time > budget:
+            failures.append('%s took %.3f s (budget %.3f s)' % (name, wall_time, budget))
+        if heavy_imports:
+            failures.append('%s imported %s' % (name, ', '.join(heavy_imports)))
+
+    results = {
+        'settings': {'python': sys.version.split()[0], 'repeat': repeat, 'budget': budget},
+        'commands': commands,
+        'summary': {name + '_ms': command['wall_ms'] for name, command in commands.items()}
+    }
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if baseline is not None:
+        with open(baseline, 'r', encoding='utf-8') as file:
+            regressions = compare_to_baseline(results, json.load(file), threshold, 
+                                              {metric: False for metric in results['summary']})
+        for metric, reference, value in regressions:
+            failures.append('Regression on %s: %s (baseline %s)' % (metric, value, reference))
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -25,25 +25,21 @@ import re
 import sys
 import pathlib
 import statistics
+import time
 import click
-import spacy
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sn
-from sklearn.metrics import classification_report, confusion_matrix
-from tqdm import tqdm
-from JaDe.jade.processing import processor
+from JaDe.jade.cache import ParseCache, CACHE_SIZE
+from JaDe.jade.gold import get_gold_labels, load_gold, GOLD_STORE_NAME
+from JaDe.jade.labels import decode, encode, filter_label, get_labels, EMPTY, EMPTY_CODE, UNCLASSIFIED_CODE
+from JaDe.jade.manifest import get_settings
+from JaDe.jade.processing import annotate_poems, load_pipeline, render_poem, save_poem, BATCH_SIZE, CLASSIFIERS, \
+    PARSE_MODES
+from JaDe.jade.profiling import timed, Profiler
+from JaDe.jade.store import hash_text, load_store, save_store, STORE_NAME
 
 ANNOT_DIR = r'JaDe/resources/annotated_poems'
 DETECTED_DIR = r'JaDe/resources/detected'
-
-regex_types = ['[cc_cross_clause]', '[pb_adj_adj]', '[pb_noun_adj]', '[pb_det_noun]', '[pb_noun_noun]', '[pb_noun_prep]',
-                '[pb_verb_adv]', '[pb_verb_chain]', '[pb_verb_prep]', '[pb_adv_adv]', '[pb_to_verb]', '[pb_verb_cprep]', 
-                '[pb_comp]', '[pb_adj_adv]', '[ex_subj_verb]', '[ex_dobj_verb]']
-dependency_rules = ['[pb_noun_noun]', '[pb_det_noun]', '[pb_noun_adj]', '[pb_verb_prep]', '[pb_verb_chain]', '[pb_adj_adv]',
-                     '[pb_verb_adv]', '[ex_dobj_verb]', '[ex_subj_verb]', '[pb_phrasal_verb]', '[cc_cross_clause]', 
-                     '[pb_adj_prep]', '[pb_relword]', '[ex_verb_adjunct]', '[pb_noun_prep]']
-pdict = ['[pb_phrasal_verb]', '[ex_dobj_pverb]']
+STORE_PATH = DETECTED_DIR + '/' + STORE_NAME
+GOLD_STORE_PATH = ANNOT_DIR + '/' + GOLD_STORE_NAME
 
 
 def get_filename(file): 
@@ -57,64 +53,141 @@ def get_filename(file):
     return filename
 
 
-def process_annotated(model, classifier):
+def get_test_files():
+    """
+        List the test data, keyed by the path of its automatic annotation.
+    """
+    data_dir = pathlib.Path(ANNOT_DIR)
+    out_dir = pathlib.Path(DETECTED_DIR)
+    files = [str(data_dir)+'/'+file for file in sorted(os.listdir(data_dir)) if fnmatch.fnmatch(file, '*.txt')]
+
+    return {str(out_dir) + '/' + get_filename(file): file for file in files}
+
+
+def read_annotated(files):
+    """
+        Lazily read the test data, pairing each poem with its output path.
+    """
+    for out_file, file in files.items():
+        with open(file, 'r', encoding='utf-8') as curfile:
+            yield out_file, curfile.read()
+
+
+def read_test_data():
+    """
+        Read the test data, keyed by the path of its automatic annotation.
+    """
+    return dict(read_annotated(get_test_files()))
+
+
+def process_annotated(model, batch_size=BATCH_SIZE, parse_mode='pair', nlp=None, cache=None, test_data=None, 
+                      profiler=None):
     """
-        Run the processor against test data
+        Run the three classifiers against test data, parsing it once, and 
+        store their raw outputs so that the annotation of any classifier can
+        be derived from them. Return the annotations of every poem.
     """
-    nlp = spacy.load(model)
-    data_dir = pathlib.Path('JaDe/resources/annotated_poems')
-    out_dir = pathlib.Path('JaDe/resources/detected')
+    from tqdm import tqdm
+
+    if nlp is None:
+        nlp = load_pipeline(model, 'all')
     
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
+    if not os.path.exists(DETECTED_DIR):
+        os.mkdir(DETECTED_DIR)
+
+    if test_data is None:
+        test_data = read_test_data()
+    poems = {}
+    annotated_poems = annotate_poems(test_data.items(), nlp, 'all', batch_size, parse_mode, cache=cache, 
+                                     profiler=profiler)
+    for out_file, lines in tqdm(annotated_poems, total=len(test_data)):
+        poems[out_file] = (hash_text(test_data[out_file]), lines)
+
+    save_store(STORE_PATH, poems, get_settings(nlp, model, 'all', parse_mode))
+
+    return {out_file: lines for out_file, (_, lines) in poems.items()}
 
-    files = [str(data_dir)+'/'+file for file in os.listdir(data_dir) if fnmatch.fnmatch(file, '*.txt')]
 
-    for i in tqdm(range(len(files))):
-        with open(files[i], 'r', encoding='utf-8') as curfile:
-            file_name = get_filename(str(files[i]))
-            out_file = str(out_dir) + '/' + file_name
-            processor(curfile, True, out_file, nlp, classifier=classifier, is_eval=True)
-            
+def save_detected(poems, classifier):
+    """
+        Write the automatic annotation of the given classifier, derived from 
+        the raw outputs, and return the number of lines processed.
+    """
+    number_of_lines = 0
+    for out_file, lines in poems.items():
+        save_poem(render_poem(lines, classifier), True, out_file, is_eval=True)
+        number_of_lines += len([line for line in lines if line.number is not None])
+
+    return number_of_lines
+
 
 def get_manual_annotations(file, classifier): 
     """
-        Retrieve manual annotation
+        Retrieve manual annotation, see gold.get_gold_labels.
     """
     with open(file, 'r', encoding='utf-8') as poem_file:
         poem = poem_file.read()
-        poem_annotations = []
 
-        all_annotations = re.findall(r'^(\d{2,} \d{2,})(.*)', poem, flags=re.MULTILINE)
-        for annotated_line in all_annotations:
-            line_annotation = annotated_line[1].split(' ')
-            wanted = line_annotation[1]
+    return tuple(label for _, label in get_gold_labels(poem, classifier))
 
-            if classifier == 'all':
-                if not 'lex' in wanted and len(wanted) > 2:
-                    poem_annotations.append(wanted)
-                else: 
-                    poem_annotations.append('[]')
-            
-            elif classifier == 'dependencies': 
-                if wanted in dependency_rules: 
-                    poem_annotations.append(wanted)
-                else: 
-                    poem_annotations.append('[]')
 
-            elif classifier == 'regex': 
-                if wanted in regex_types: 
-                    poem_annotations.append(wanted)
-                else: 
-                    poem_annotations.append('[]')
+def get_predicted_labels(lines, classifier):
+    """
+        Retrieve the automatic annotation of a poem from its LineAnnotation,
+        as it would be read from the annotated poem, see LineAnnotation.get_label.
 
-            elif classifier == 'dictionary': 
-                if wanted in pdict: 
-                    poem_annotations.append(wanted)
-                else: 
-                    poem_annotations.append('[]')
+        Returns
+        -------
+            labels: dict
+                {line number: label}
+    """
+    labels = {}
+    for line in lines:
+        if line.number is None:
+            continue
+        labels[line.number] = filter_label(line.get_label(classifier), classifier)
 
-    return tuple(poem_annotations)
+    return labels
+
+
+def get_aligned_codes(gold, poems, classifier):
+    """
+        Build global arrays of manual and automatic label codes from the 
+        annotations held in memory. Poems are aligned by name and lines by 
+        number.
+
+        Parameters
+        ----------
+            gold: dict
+                {key: (line numbers, {classifier: label codes})}, as returned
+                by gold.load_gold
+            poems: dict
+                {key: list of LineAnnotation}, as returned by process_annotated
+            classifier: str
+                classifier evaluated
+
+        Returns
+        -------
+            keys: list
+                keys of the poems evaluated
+            poem_index: array
+                index in keys of the poem of each line
+            manual_annotations: array
+            automatic_annotations: array
+    """
+    import numpy as np
+
+    keys = [key for key in sorted(poems) if key in gold]
+    automatic_labels = []
+    for key in keys:
+        predicted = get_predicted_labels(poems[key], classifier)
+        automatic_labels.extend(predicted.get(line_number, EMPTY) for line_number in gold[key][0].tolist())
+
+    automatic_annotations = encode(automatic_labels)
+    manual_annotations = np.concatenate([gold[key][1][classifier] for key in keys] or [np.zeros(0, np.int32)])
+    poem_index = np.repeat(np.arange(len(keys)), [len(gold[key][0]) for key in keys])
+
+    return keys, poem_index, manual_annotations, automatic_annotations
 
 
 def get_detected_annotations(file, classifier):
@@ -126,127 +199,250 @@ def get_detected_annotations(file, classifier):
     with open(file, 'r', encoding='utf-8') as file:
         poem = file.readlines()
         poem_annotations = []
-        i = 1
         for i in range(len(poem) - 1): 
             if len(poem[i]) > 1:
                 if re.search(r'\[.*?\]', poem[i]):
                     annotation = re.search(r'\[.*?\]', poem[i]).group(0)
-
-                    if classifier == 'all':
-                        poem_annotations.append(annotation)
-                    
-                    elif classifier == 'dependencies':  
-                        if annotation in dependency_rules: 
-                            poem_annotations.append(annotation)
-                        else:
-                            poem_annotations.append('[]')
-
-                    
-                    elif classifier == 'regex': 
-                        if annotation in regex_types: 
-                            poem_annotations.append(annotation)
-                        else:
-                            poem_annotations.append('[]')
-                    
-                    elif classifier == 'dictionary': 
-                        if annotation in pdict: 
-                            poem_annotations.append(annotation)
-                        else:
-                            poem_annotations.append('[]')
+                    poem_annotations.append(filter_label(annotation, classifier))
                 else: 
-                    poem_annotations.append('[]')
+                    poem_annotations.append(EMPTY)
                     
     return tuple(poem_annotations)
 
 
-def build_classification_report(classifier, confusion):
+def get_annotation_lists(classifier):
+    """
+        Build global lists of manual and automatic annotations from the 
+        files of the detected directory, so that scikit metrics can be used.
+        Poems are aligned by name.
+    """
+    manual_annotations = []
+    automatic_annotations = []
+
+    for filepath in sorted(pathlib.Path(ANNOT_DIR).glob('*.txt')):
+        detected_path = pathlib.Path(DETECTED_DIR) / get_filename(str(filepath))
+        if not detected_path.exists():
+            continue
+        manual_annotations.extend(get_manual_annotations(str(filepath), classifier))
+        automatic_annotations.extend(get_detected_annotations(str(detected_path), classifier))
+
+    return manual_annotations, automatic_annotations
+
+
+def filter_unannotated(manual_annotations, automatic_annotations):
+    """
+        Ignore lines without manual annotation, automatic empty labels being 
+        replaced by None.
+    """
+    import numpy as np
+
+    annotated = manual_annotations != EMPTY_CODE
+
+    return manual_annotations[annotated], np.where(automatic_annotations[annotated] == EMPTY_CODE, 
+                                                   UNCLASSIFIED_CODE, automatic_annotations[annotated])
+
+
+def get_confusion_matrix(manual_annotations, automatic_annotations):
+    """
+        Count every (manual, automatic) pair of label codes.
+
+        Returns
+        -------
+            matrix: array
+                matrix[i, j] is the number of lines labelled i and detected j
+    """
+    import numpy as np
+
+    number_of_labels = len(get_labels())
+    counts = np.bincount(manual_annotations.astype(np.int64) * number_of_labels + automatic_annotations, 
+                         minlength=number_of_labels * number_of_labels)
+
+    return counts.reshape(number_of_labels, number_of_labels)
+
+
+def get_scores(manual_annotations, automatic_annotations):
     """
-        Build global dictionnary so that skickit metrics can be used 
-        and compute detection measures. Compute precision, recall and f1-score
-        for detection task as well. 
+        Compute detection accuracy, classification accuracy and classification
+        macro f1-score, over the labels found in the manual annotation.
     """
-    annotations = {}
-    global_ = {'true': [], 'predicted': []}
+    import numpy as np
+
+    if len(manual_annotations) == 0:
+        return 0.0, 0.0, 0.0
+    detection_accuracy = np.mean((manual_annotations == EMPTY_CODE) == (automatic_annotations == EMPTY_CODE))
 
-    tmp_true = []
-    for filepath in pathlib.Path(ANNOT_DIR).iterdir():
-        filename = str(filepath)
-        poem_name = filename[31:]
-        annotations[poem_name] = []
-        annotations[poem_name].append(get_manual_annotations(filename, classifier))
-        tmp_true.append(tuple(get_manual_annotations(filename, classifier)))
+    manual_annotations, automatic_annotations = filter_unannotated(manual_annotations, automatic_annotations)
+    if len(manual_annotations) == 0:
+        return detection_accuracy, 0.0, 0.0
+    classification_accuracy = np.mean(manual_annotations == automatic_annotations)
+    _, f1 = get_label_f1(manual_annotations, automatic_annotations)
 
+    return detection_accuracy, classification_accuracy, f1.mean()
 
-    tmp_predicted = []
-    for filepath in pathlib.Path(DETECTED_DIR).iterdir():
-        filename = str(filepath)
-        curr_poem_name = filename[24:]
-        for poem in annotations.keys():
-            if poem == curr_poem_name:
-                annotations[poem].append(get_detected_annotations(filename, classifier))
-        tmp_predicted.append(get_detected_annotations(filename, classifier))
 
-    for i in range(len(tmp_predicted)):
-        for tag in tmp_predicted[i]:
-            global_['predicted'].append(tag)
-        for tag in tmp_true[i]:
-            global_['true'].append(tag)
+def get_label_f1(manual_annotations, automatic_annotations):
+    """
+        Compute the f1-score of each label found in the manual annotation, 
+        from arrays of label codes of annotated lines (see filter_unannotated).
+
+        Returns
+        -------
+            labels: array
+                codes of the labels
+            f1: array
+                f1-score of each label
+    """
+    import numpy as np
+
+    matrix = get_confusion_matrix(manual_annotations, automatic_annotations)
+    labels = np.unique(manual_annotations)
+    true_positives = np.diag(matrix)[labels]
+    detected = matrix[:, labels].sum(axis=0)
+    actual = matrix[labels, :].sum(axis=1)
+    precision = np.divide(true_positives, detected, out=np.zeros(len(labels)), where=detected > 0)
+    recall = true_positives / actual
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(len(labels)), 
+                   where=precision + recall > 0)
 
+    return labels, f1
 
-    manual_annotations = global_['true']
-    automatic_annotations = global_['predicted']
-    labels = (list(set(dependency_rules + regex_types + pdict)))
+
+def build_classification_report(manual_annotations, automatic_annotations, confusion):
+    """
+        Compute precision, recall and f1-score for detection and classification 
+        tasks, from arrays of label codes. 
+    """
+    from sklearn.metrics import classification_report
+    import numpy as np
 
     # evaluating detection with scikit
     print("\t####### DETECTION #######")
-    automatic_annotations_detection = [0  if x == '[]' else 1 for x in automatic_annotations]
-    manual_annotations_detection = [0 if x == '[]' else 1 for x in manual_annotations]
-    print(classification_report(manual_annotations_detection, automatic_annotations_detection, digits=3, zero_division=0))
+    print(classification_report((manual_annotations != EMPTY_CODE).astype(int), 
+                                (automatic_annotations != EMPTY_CODE).astype(int), digits=3, zero_division=0))
 
-    both = list(zip(manual_annotations, automatic_annotations))
     # ignore empty labels
-    both_filtered = []
-    for x in both: 
-        x = list(x)
-        if x[0] != '[]': 
-            if x[1] == '[]':
-                x[1] = 'None'
-            both_filtered.append(x)
-    
-    manual_annotations_filt = [x[0] for x in both_filtered]
-    automatic_annotations_filt = [x[1] for x in both_filtered]
+    manual_annotations, automatic_annotations = filter_unannotated(manual_annotations, automatic_annotations)
    
     print("\n\t###### CLASSIFICATION ######")
-    automatic_annotations = automatic_annotations_filt
-    manual_annotations = manual_annotations_filt
-    labels = list(set(manual_annotations))
-    print(classification_report(manual_annotations, automatic_annotations, labels=labels, digits=3, zero_division=0))
-    
-    
-    manual_annotations_filt = [x[0] for x in both_filtered]
-    automatic_annotations_filt = [x[1] for x in both_filtered]
-    data = {'true': manual_annotations_filt, 'predicted': automatic_annotations_filt} 
-    
+    # only the labels of the manual annotation are reported, as get_label_f1 does
+    labels = np.unique(manual_annotations)
+    print(classification_report(manual_annotations, automatic_annotations, labels=labels, 
+                                target_names=decode(labels), digits=3, zero_division=0))
+
     if confusion: 
-        df = pd.DataFrame(data, columns=['true', 'predicted'])
-        confusion_matrix = pd.crosstab(df['true'], df['predicted'], rownames=['actual'], colnames=['predicted'])
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sn
+
+        matrix = get_confusion_matrix(manual_annotations, automatic_annotations)
+        predicted = np.unique(automatic_annotations)
+        confusion_matrix = pd.DataFrame(matrix[np.ix_(labels, predicted)], 
+                                        index=pd.Index(decode(labels), name='actual'), 
+                                        columns=pd.Index(decode(predicted), name='predicted'))
         sn.heatmap(confusion_matrix, annot=False, robust=True)
         plt.show()
 
 
+def build_poem_report(keys, poem_index, manual_annotations, automatic_annotations):
+    """
+        Print, for each poem, the number of annotated lines along with 
+        detection and classification accuracies.
+    """
+    import numpy as np
+
+    number_of_poems = len(keys)
+    lines = np.bincount(poem_index, minlength=number_of_poems)
+    detected = (manual_annotations == EMPTY_CODE) == (automatic_annotations == EMPTY_CODE)
+    detection_accuracy = np.bincount(poem_index, weights=detected, minlength=number_of_poems)
+    annotated = manual_annotations != EMPTY_CODE
+    enjambments = np.bincount(poem_index[annotated], minlength=number_of_poems)
+    classified = np.bincount(poem_index[annotated], minlength=number_of_poems,
+                             weights=manual_annotations[annotated] == automatic_annotations[annotated])
+
+    print('poem\tlines\tdetection_acc\tenjambments\tclassif_acc')
+    for i, key in enumerate(keys):
+        classification_accuracy = classified[i] / enjambments[i] if enjambments[i] > 0 else 0.0
+        print(f'{os.path.basename(key)}\t{lines[i]}\t{detection_accuracy[i] / max(lines[i], 1):.3f}\t\t'
+              f'{enjambments[i]}\t\t{classification_accuracy:.3f}')
+
+
+def report_classifiers(gold, poems):
+    """
+        Report accuracy and macro f1-score of every classifier, all being 
+        derived from the same annotation of test data.
+    """
+    print('classifier\tdetection_acc\tclassif_acc\tmacro_f1')
+    for classifier in CLASSIFIERS:
+        _, _, manual_annotations, automatic_annotations = get_aligned_codes(gold, poems, classifier)
+        detection_accuracy, classification_accuracy, macro_f1 = get_scores(manual_annotations, 
+                                                                           automatic_annotations)
+        print(f'{classifier:<12}\t{detection_accuracy:.3f}\t\t{classification_accuracy:.3f}\t\t{macro_f1:.3f}')
+
+
+def compare_parse_modes(model, classifier, batch_size=BATCH_SIZE, nlp=None, cache=None, write=False):
+    """
+        Annotate test data with each parse mode and report accuracy and 
+        throughput side by side. The per-pair mode is run last, so that the 
+        detected directory, if written, is left as it would be with default 
+        settings.
+    """
+    if nlp is None:
+        nlp = load_pipeline(model, 'all')
+    test_data = read_test_data()
+    gold = load_gold(get_test_files(), GOLD_STORE_PATH)
+    print('mode\tdetection_acc\tclassif_acc\tmacro_f1\tseconds\tlines/s')
+
+    for parse_mode in sorted(PARSE_MODES, key=lambda mode: mode == 'pair'):
+        start = time.perf_counter()
+        poems = process_annotated(model, batch_size, parse_mode, nlp=nlp, cache=cache, test_data=test_data)
+        if write:
+            save_detected(poems, classifier)
+        _, _, manual_annotations, automatic_annotations = get_aligned_codes(gold, poems, classifier)
+        elapsed = time.perf_counter() - start
+        number_of_lines = sum(1 for lines in poems.values() for line in lines if line.number is not None)
+
+        detection_accuracy, classification_accuracy, macro_f1 = get_scores(manual_annotations, 
+                                                                           automatic_annotations)
+
+        print(f'{parse_mode}\t{detection_accuracy:.3f}\t\t{classification_accuracy:.3f}\t\t'
+              f'{macro_f1:.3f}\t\t{elapsed:.2f}\t{number_of_lines / elapsed:.1f}')
+
+
 @click.command()
 @click.option('--model', help="Language model to be used", default='en_core_web_sm')
 @click.option('--classifier', help="Classifier to evaluate", default="all", 
-            type=click.Choice(['all', 'dependencies', 'regex', 'dictionary'], 
-                            case_sensitive=False))
+            type=click.Choice(CLASSIFIERS, case_sensitive=False))
 @click.option('--confusion', help="Display confusion matrix in new window", default=False)
-@click.option('--annotate', help="If set to True, run JaDe to annotate test data", default=False)
-def run(model, classifier, annotate, confusion): 
+@click.option('--annotate', help="If set to True, run JaDe to annotate test data with all the classifiers", 
+            default=False)
+@click.option('--batch_size', help="Number of line pairs parsed at once by spaCy", 
+            default=BATCH_SIZE, type=int)
+@click.option('--parse_mode', help="Parse line pairs on their own or retrieve them from their poem/stanza", 
+            default='pair', type=click.Choice(PARSE_MODES, case_sensitive=False))
+@click.option('--compare_modes', help="If set to True, annotate test data with every parse mode and \
+            compare accuracy and throughput", default=False)
+@click.option('--cache_dir', help="Path to a persistent cache of spaCy analyses", default=None)
+@click.option('--cache_size', help="Maximum number of analyses kept in the cache", 
+            default=CACHE_SIZE, type=int)
+@click.option('--write_detected', help="If set to True, write the automatic annotation of test data to \
+            JaDe/resources/detected", default=False)
+@click.option('--per_poem', help="If set to True, report detection and classification accuracy per poem", 
+            default=False)
+@click.option('--compare_classifiers', help="If set to True, report the scores of every classifier", 
+            default=False)
+@click.option('--profile', help="If set to True, print the time spent in each stage along with counts", 
+            default=False)
+@click.option('--pstats', help="Path to which cProfile statistics are dumped, implies --profile", default=None)
+def run(model, classifier, annotate, confusion, batch_size, parse_mode, compare_modes, cache_dir, cache_size, 
+        write_detected, per_poem, compare_classifiers, profile, pstats): 
     """
         Evaluation command-line interface. 
         The evaluation can be run on each classifier separately or on all 3.
-        The automatic annotation can be updated if necessary, for example when 
-        evaluating another classifier (set --annotate to True). 
+        Test data is annotated by the three classifiers at once, their raw 
+        outputs being stored, so that the annotation of any classifier is 
+        derived from them without running JaDe again. The automatic 
+        annotation only needs updating when the test data, the rules or the
+        model changed (set --annotate to True). 
 
         Parameters
         ----------
@@ -257,12 +453,51 @@ def run(model, classifier, annotate, confusion):
                 See evaluation.py --help for a list of accepted values.
             annotate: bool
                 whether JaDe should be run to update automatic test data. 
-                Default to False. 
+                Default to False, in which case the stored outputs are used if
+                they are up to date and come from the same model and parse 
+                mode. 
             confusion: bool
                 whether the confusion matrix should be displayed (in a new window). 
                 Default to False
+            batch_size: int
+                number of line pairs parsed at once by spaCy when annotating.
+            parse_mode: str
+                whether line pairs are parsed on their own (`pair`, default) or 
+                retrieved from the parse of their poem (`poem`) or stanza 
+                (`stanza`) when annotating.
+            compare_modes: bool
+                whether test data should be annotated with every parse mode so 
+                as to compare their accuracy and throughput. Default to False.
+            cache_dir: str
+                path to a persistent cache of spaCy analyses, so that test data
+                is not parsed again when only the rules changed. Default to 
+                None (no cache).
+            cache_size: int
+                maximum number of analyses kept in the cache.
+            write_detected: bool
+                whether the automatic annotation should be written to 
+                JaDe/resources/detected. Default to False: the annotations 
+                are evaluated in memory. The files of the detected directory 
+                are only read when no up-to-date classifier outputs are found.
+            per_poem: bool
+                whether detection and classification accuracy should be 
+                reported for each poem. Default to False.
+            compare_classifiers: bool
+                whether the scores of every classifier should be reported 
+                side by side rather than the report of the one evaluated. 
+                Default to False.
+            profile: bool
+                whether the time spent annotating and scoring test data, 
+                stage by stage, should be printed along with counts. Default 
+                to False.
+            pstats: str
+                path to which cProfile statistics are dumped. Default to None.
+        
+        Manual annotations are compiled once into 
+        JaDe/resources/annotated_poems/.gold_store.json, poems only being 
+        compiled again when their file changed. 
     """
-    bool_true = ['true', 'True']
+    bool_true = ['true', 'True', True]
     if annotate in bool_true:
         annotate = True
     else:
@@ -273,10 +508,64 @@ def run(model, classifier, annotate, confusion):
     else:
         confusion = False
     
-    if annotate:
-        process_annotated(model, classifier)
-    build_classification_report(classifier, confusion)
-
+    profiler = None
+    if profile in bool_true or pstats is not None:
+        profiler = Profiler(pstats)
+        profiler.start()
+
+    nlp = None
+    cache = None
+    if annotate or compare_modes in bool_true:
+        nlp = timed(profiler, 'load_pipeline', load_pipeline, model, 'all')
+        if cache_dir is not None and nlp is not None:
+            cache = ParseCache(cache_dir, nlp, cache_size)
+
+    write_detected = write_detected in bool_true
+
+    if compare_modes in bool_true:
+        compare_parse_modes(model, classifier, batch_size, nlp=nlp, cache=cache, write=write_detected)
+    else:
+        test_data = read_test_data()
+        if annotate:
+            poems = process_annotated(model, batch_size, parse_mode, nlp=nlp, cache=cache, test_data=test_data, 
+                                      profiler=profiler)
+        else:
+            poems = load_store(STORE_PATH, {out_file: hash_text(poem) for out_file, poem in test_data.items()}, 
+                               model, parse_mode)
+
+        if poems is not None:
+            if write_detected:
+                save_detected(poems, classifier)
+            gold = timed(profiler, 'load_gold', load_gold, get_test_files(), GOLD_STORE_PATH)
+            if compare_classifiers in bool_true:
+                report_classifiers(gold, poems)
+                keys = manual_annotations = None
+            else:
+                keys, poem_index, manual_annotations, automatic_annotations = timed(profiler, 'get_aligned_codes', 
+                                                                                    get_aligned_codes, gold, poems, 
+                                                                                    classifier)
+        else:
+            print('No up-to-date classifier outputs were found, annotations in', DETECTED_DIR, 
+                  'are evaluated as they are. Set --annotate to True to update them.')
+            manual_annotations, automatic_annotations = get_annotation_lists(classifier)
+            manual_annotations, automatic_annotations = encode(manual_annotations), encode(automatic_annotations)
+            keys = None
+        
+        if per_poem in bool_true and keys is not None:
+            build_poem_report(keys, poem_index, manual_annotations, automatic_annotations)
+        elif manual_annotations is not None:
+            build_classification_report(manual_annotations, automatic_annotations, confusion)
+
+    if cache is not None:
+        cache.save()
+        print(cache.report())
+
+    if profiler is not None:
+        if cache is not None:
+            profiler.count('cache hits', cache.hits)
+            profiler.count('cache misses', cache.misses)
+        profiler.stop()
+        print(profiler.report())
 
 if __name__ == "__main__":
     run()
@@ -25,9 +25,18 @@ import pathlib
 import re
 import sys
 import click
-import spacy
-from tqdm import tqdm
-from JaDe.jade.processing import processor
+from JaDe.jade.cache import ParseCache, CACHE_SIZE
+from JaDe.jade.corpus import get_poem_outfiles, get_source_state, index_corpus, read_source, ANTHOLOGY_DELIMITER, \
+    CORPUS_FORMATS
+from JaDe.jade.export import EXPORT_FORMATS, SHARD_SIZE
+from JaDe.jade.manifest import compact_manifest, get_settings, is_up_to_date, \
+    load_manifest, update_manifest
+from JaDe.jade.parallel import process_files
+from JaDe.jade.processing import annotate_poems, load_pipeline, processor, render_poem, save_poem, BATCH_SIZE, \
+    CLASSIFIERS, PARSE_MODES
+from JaDe.jade.profiling import timed, Profiler
+from JaDe.jade.service import HOST, MAX_BATCH, MAX_WAIT, PORT, QUEUE_SIZE
+from JaDe.jade.summary import load_summary, save_summary, summarise_poem
 
 
 def get_filename(file): 
@@ -40,8 +49,187 @@ def get_filename(file):
     return filename
 
 
+def get_outfile(curr_file, outdir): 
+    """
+        Build the path to where an analysed file of a directory is saved.
+    """
+    file_name = get_filename(str(curr_file))
+    outfile = outdir + '/' + file_name + '.txt'
+
+    if sys.platform.startswith('win'):
+        outfile = str(pathlib.PureWindowsPath(outfile))
+
+    return outfile
+
+
+def read_poems(jobs, on_error): 
+    """
+        Read the poems of a directory or a corpus, lazily so that only the poems whose 
+        line pairs are being parsed are kept in memory. 
+
+        Parameters
+        ----------
+            jobs: list
+                (path to the poem or its source in a corpus, path to where the
+                analysed poem is saved)
+            on_error: callable
+                called with the job and the exception if a poem cannot be read
+
+        Yields
+        ------
+            job: tuple
+                the job the poem belongs to
+            poem: str
+                the poem
+    """
+    for job in jobs:
+        try:
+            poem = read_source(job[0])
+        except (OSError, UnicodeDecodeError, ValueError, KeyError) as err:
+            on_error(job, err)
+            continue
+
+        yield job, poem
+
+
+def annotate_collection(poems, outdir, nlp, model, classifier, batch_size, parse_mode, workers, force, cache, 
+                        profiler, export, shard_size, text):
+    """
+        Annotate the poems of a directory or of a corpus into an output 
+        directory, skipping those already annotated from the same content 
+        with the same settings, see JaDe/jade/manifest.py.
+
+        Parameters
+        ----------
+            poems: list
+                (key, source, outfile) tuples: key identifies the poem in the
+                manifest, the summary and the export, source is the path to 
+                the poem or its source in a corpus (see JaDe/jade/corpus.py)
+                and outfile the path to where the annotated poem is saved
+            outdir: str
+                path to the output directory, which must exist
+
+        See run for the other parameters.
+    """
+    from tqdm import tqdm
+    from JaDe.jade.export import remove_stale_shards, AnnotationExporter
+
+    # files already annotated from the same content with the same settings are skipped
+    settings = get_settings(nlp, model, classifier, parse_mode)
+    manifest = load_manifest(outdir)
+    states = {}
+    keys = {}
+    jobs = []
+    failed = []
+
+    exporter = AnnotationExporter(outdir, export, classifier, shard_size) if export else None
+    shards = {}
+    # counts per label and totals of the directory, updated poem by poem
+    summary = load_summary(outdir)
+    entries = {}
+
+    def record(job, error=None):
+        key = keys[job]
+        if error is not None:
+            failed.append(key)
+            error = repr(error) if isinstance(error, Exception) else error
+            summary['poems'].pop(key, None)
+        elif job in entries:
+            summary['poems'][key] = entries.pop(job)
+        update_manifest(outdir, manifest, key, states.get(key), settings, job[1] if text else None, 
+                        error, shards.pop(job, None) if error is None else None)
+
+    def collect_lines(job, lines):
+        if exporter is not None:
+            shards[job] = exporter.add(keys[job], lines)
+        entries[job] = summarise_poem(lines, classifier, job[1] if text else None)
+
+    for key, source, outfile in poems:
+        job = (source, outfile)
+        keys[job] = key
+        try:
+            states[key] = get_source_state(source, manifest.get(key))
+        except (OSError, ValueError, KeyError) as err:
+            record(job, err)
+            continue
+        if force or not is_up_to_date(manifest.get(key), states[key], settings, export, text, outfile) \
+                or key not in summary['poems']:
+            jobs.append(job)
+
+    if len(jobs) < len(poems): 
+        print(len(poems) - len(jobs), 'files are up to date and will not be analysed again.')
+
+    if workers > 1:
+        for job, error in tqdm(process_files(jobs, nlp, model, workers, classifier, batch_size, parse_mode, cache, 
+                                             profiler, text, collect_lines, cascade=True), 
+                               total=len(jobs)):
+            record(job, error)
+    else:
+        annotated_poems = annotate_poems(read_poems(jobs, record), nlp, classifier, batch_size, parse_mode, 
+                                         on_error=record, cache=cache, profiler=profiler, cascade=True)
+        for job, lines in tqdm(annotated_poems, total=len(jobs)):
+            try:
+                if text:
+                    poem = timed(profiler, 'render_poem', render_poem, lines, classifier)
+                    timed(profiler, 'save_poem', save_poem, poem, True, job[1], False, True)
+                collect_lines(job, lines)
+            except OSError as err:
+                record(job, err)
+                continue
+            record(job)
+
+    if exporter is not None:
+        exporter.close()
+    compact_manifest(outdir, manifest)
+    save_summary(outdir, summary, manifest, classifier)
+    if exporter is not None:
+        remove_stale_shards(outdir, manifest)
+    if len(failed) > 0:
+        print(len(failed), 'files could not be analysed and will be retried on the next run:', 
+              ', '.join(failed))
+    print('Files have been saved to disk at', outdir)
+
+
+def detect(sources, out_path, save, profiler):
+    """
+        Write the run-on flags and rates of poems as JSON records, one per 
+        poem, without loading any model, see JaDe/jade/detection.py.
+
+        Parameters
+        ----------
+            sources: iterable
+                (key, path to the poem or its source in a corpus) tuples
+            out_path: str
+                path to where the records are saved
+            save: bool
+                whether the records are saved or printed
+
+        See run for the other parameters.
+    """
+    from JaDe.jade.detection import detect_collection
+
+    failed = []
+
+    def on_error(key, err):
+        failed.append(key)
+
+    if save:
+        with open(out_path, 'w', encoding='utf-8') as out:
+            totals = detect_collection(sources, out, on_error, profiler=profiler)
+        print(totals['run_on'], 'run-on lines out of', totals['lines'], 'lines in', totals['poems'], 'poems.')
+    else:
+        detect_collection(sources, sys.stdout, on_error, profiler=profiler)
+
+    if len(failed) > 0:
+        print(len(failed), 'files could not be read:', ', '.join(failed))
+    if save:
+        print('Detection has been saved to disk at', out_path)
+
+
 @click.command()
 @click.option('--model', help="Language model to be used", default='en_core_web_sm')
+@click.option('--classifier', help="Classifier whose annotations are kept", default="all", 
+            type=click.Choice(CLASSIFIERS, case_sensitive=False))
 @click.option('--dir', help="Path to the directory to analyze", default=None, multiple=True)
 @click.option('--file', help="Path to the file to analyze", default=None, multiple=True)
 @click.option('--save', help="Specify whether or not the analysis should be saved.\
@@ -50,7 +238,38 @@ def get_filename(file):
             default=None, multiple=True)
 @click.option('--outdir', help="Path to where the analyzed files in input\
             directory should be saved", default=None, multiple=True)
-def run(model, dir, file, outdir, outfile, save): 
+@click.option('--batch_size', help="Number of line pairs parsed at once by spaCy", 
+            default=BATCH_SIZE, type=int)
+@click.option('--parse_mode', help="Parse line pairs on their own or retrieve them from their poem/stanza", 
+            default='pair', type=click.Choice(PARSE_MODES, case_sensitive=False))
+@click.option('--workers', help="Number of processes annotating the files of a directory", 
+            default=1, type=int)
+@click.option('--force', help="Analyse again the files of a directory even if they are up to date", 
+            default=False, type=bool)
+@click.option('--cache_dir', help="Path to a persistent cache of spaCy analyses", default=None)
+@click.option('--cache_size', help="Maximum number of analyses kept in the cache", 
+            default=CACHE_SIZE, type=int)
+@click.option('--profile', help="Print the time spent in each stage along with counts at the end of the run", 
+            default=False, type=bool)
+@click.option('--pstats', help="Path to which cProfile statistics are dumped, implies --profile", default=None)
+@click.option('--export', help="Also export the annotations of a directory as JSONL records or NumPy columns", 
+            default=None, type=click.Choice(EXPORT_FORMATS, case_sensitive=False))
+@click.option('--shard_size', help="Maximum number of lines per export file", default=SHARD_SIZE, type=int)
+@click.option('--text', help="If set to False along with --export, annotated poems are only exported", 
+            default=True, type=bool)
+@click.option('--corpus', help="Path to a zip/tar archive, JSONL dump or anthology of poems to analyze", 
+            default=None, multiple=True)
+@click.option('--corpus_format', help="Format of the corpora, guessed from their extension by default", 
+            default=None, type=click.Choice(CORPUS_FORMATS, case_sensitive=False))
+@click.option('--delimiter', help="Regular expression matching the lines that start the poems of an anthology", 
+            default=ANTHOLOGY_DELIMITER)
+@click.option('--id_field', help="Field of the JSONL records holding the poem identifier", default='id')
+@click.option('--text_field', help="Field of the JSONL records holding the poem", default='text')
+@click.option('--detect_only', help="Only tell run-on from end-stopped lines, without any model", 
+            default=False, type=bool)
+def run(model, classifier, dir, file, outdir, outfile, save, batch_size, parse_mode, workers, force, 
+        cache_dir, cache_size, profile, pstats, export, shard_size, text, corpus, corpus_format, delimiter, 
+        id_field, text_field, detect_only): 
     """
         JaDe command-line interface manager. 
 
@@ -61,6 +280,11 @@ def run(model, dir, file, outdir, outfile, save):
         ----------
             model: str
                 language model to be used. Default to spacy smaller one.
+            classifier: str
+                classifier whose annotations are kept: `all` (default), 
+                `dependencies`, `regex` or `dictionary`. Only the spaCy 
+                components the classifier needs are loaded, and no model at 
+                all for the dictionary classifier.
             dir: str
                 Path to the directories to be analysed. To analyse a batch of 
                 directories, indicate `--dir` before each path. Eg
@@ -92,8 +316,92 @@ def run(model, dir, file, outdir, outfile, save):
             save: bool
                 Whether or not the save is to be enabled. Can be set to False for
                 single file analysis only. 
+            batch_size: int
+                Number of line pairs parsed at once by spaCy. Line pairs from 
+                all the files of a directory are batched together.
+            parse_mode: str
+                Whether line pairs are parsed on their own (`pair`, default), 
+                or retrieved from a single parse of their poem (`poem`) or 
+                stanza (`stanza`), which avoids parsing interior lines twice.
+            workers: int
+                Number of processes annotating the files of a directory. Default
+                to 1. The model is loaded once and shared with the workers 
+                where processes can be forked.
+            force: bool
+                Whether files of a directory should be analysed again even if
+                the manifest of the output directory shows that neither the 
+                file nor the settings (model, rules, phrasal verbs lexicon) 
+                changed since the last run. Default to False. Files that 
+                could not be analysed are always retried.
+            cache_dir: str
+                Path to a persistent cache of spaCy analyses. Texts found in
+                the cache (eg unchanged poems, repeated refrains) are not 
+                parsed again. Default to None (no cache).
+            cache_size: int
+                Maximum number of analyses kept in the cache, least recently 
+                used ones being evicted first.
+            profile: bool
+                Whether the time spent in each stage of the pipeline, the 
+                number of lines, run-on lines and texts parsed, cache hits, 
+                the share of line pairs that needed the dependency parser, 
+                and how often and how fast each label was produced should be 
+                printed at the end of the run. Default to False. 
+            pstats: str
+                Path to which cProfile statistics of the run are dumped, to be 
+                read with the pstats module. With several workers, only the 
+                main process is profiled by cProfile. Default to None.
+            export: str
+                Format in which the annotations of a directory are exported to
+                the output directory, in addition to the annotated poems: 
+                `jsonl` (one record per line) or `npz` (NumPy columns, labels
+                being coded). Poems are gathered into a few shard files, see 
+                JaDe/jade/export.py. Default to None (no export).
+            shard_size: int
+                Maximum number of lines per shard file, poems being never 
+                split across shards.
+            text: bool
+                Whether annotated poems are saved as text files. Can only be 
+                set to False along with --export. Default to True.
+            corpus: str
+                Path to corpora to be analysed without extracting their poems:
+                zip or tar archives (text files they hold), JSONL dumps (one 
+                poem per record) or anthologies (poems starting with a 
+                delimiter line). Poems keep their identifier in the corpus 
+                (member name, record identifier or delimiter title) in the 
+                manifest, summary and export of the output directory, given 
+                by `--outdir` as for directories.
+            corpus_format: str
+                `zip`, `tar`, `jsonl` or `anthology`. Default to None, the 
+                format being guessed from the extension, anything else than
+                an archive or a JSONL dump being read as an anthology.
+            delimiter: str
+                Regular expression matching the lines that start the poems 
+                of an anthology, its first group being the poem identifier.
+                Default to lines of at least three `=`, followed by the 
+                identifier, eg `=== Admonition`.
+            id_field: str
+                Field of the JSONL records holding the poem identifier, the 
+                line number being used if it is missing. Default to `id`.
+            text_field: str
+                Field of the JSONL records holding the poem. Default to `text`.
+            detect_only: bool
+                Whether lines are only told run-on or end-stopped, without 
+                classifying enjambments nor loading any model. Poems are 
+                tested by batches, whole files at once, and one JSON record 
+                per poem is written: numbers of lines and run-on lines, 
+                run-on rates of the poem and of each stanza, and a flag per
+                line. Records are saved to `detection.jsonl` in the output 
+                directory of directories and corpora, to `--outfile` (default
+                to detected_*filename*.jsonl) for files. Default to False.
     """
-    nlp = spacy.load(model)
+    profiler = Profiler(pstats) if profile or pstats is not None else None
+    if profiler is not None:
+        profiler.start()
+
+    nlp = timed(profiler, 'load_pipeline', load_pipeline, model, classifier) if not detect_only else None
+    if detect_only:
+        from JaDe.jade.detection import DETECTION_NAME
+    cache = ParseCache(cache_dir, nlp, cache_size) if cache_dir is not None and nlp is not None else None
 
     if len(file) == 0:
         file = None
@@ -101,6 +409,9 @@ def run(model, dir, file, outdir, outfile, save):
     if len(dir) == 0: 
         dir = None
 
+    if len(corpus) == 0:
+        corpus = None
+
     if str(save).capitalize() == "False": 
         save = False
     elif str(save).capitalize() == "True": 
@@ -108,6 +419,15 @@ def run(model, dir, file, outdir, outfile, save):
     else: 
         print('save options only accepts True or False.')
 
+    if not text and export is None:
+        print('--text can only be set to False along with --export.')
+        sys.exit(0)
+
+    if corpus is not None and (dir is not None or file is not None):
+        print('JaDe cannot simultaneously analyze a corpus and files or directories.')
+        print('Please specify either --corpus, --dir or --file.')
+        sys.exit(0)
+
     if dir is None and file is not None: 
         
         if len(file) > 1:
@@ -116,6 +436,14 @@ def run(model, dir, file, outdir, outfile, save):
                 
         for i in range(len(file)):
             curr_file = file[i]
+            if detect_only:
+                try: 
+                    curr_outfile = outfile[i]
+                except (IndexError, AttributeError, TypeError):
+                    curr_outfile = 'detected_' + get_filename(str(curr_file)) + '.jsonl'
+                detect([(curr_file, curr_file)], curr_outfile, save, profiler)
+                continue
+
             with open(curr_file, 'r', encoding='utf-8') as poem_file:
                 file_name = get_filename(str(curr_file))
 
@@ -124,7 +452,8 @@ def run(model, dir, file, outdir, outfile, save):
                 except (IndexError, AttributeError, TypeError):
                     curr_outfile = 'annotated_' + file_name + '.txt'
 
-                processor(poem_file, save, curr_outfile, nlp)
+                processor(poem_file, save, curr_outfile, nlp, classifier=classifier, batch_size=batch_size, 
+                          parse_mode=parse_mode, cache=cache, profiler=profiler, cascade=True)
                 print("File has been saved to disk at", curr_outfile)
 
     elif dir is not None and file is None: 
@@ -145,26 +474,49 @@ def run(model, dir, file, outdir, outfile, save):
             if save:
                 files = [curr_dir+file for file in os.listdir(curr_dir) if fnmatch.fnmatch(file, '*.txt')]
 
-                for i in tqdm(range(len(files))):
-                    with open(files[i], 'r', encoding='utf-8') as poem_file:
-                        file_name = get_filename(str(files[i]))
-
-                        outfile = curr_outdir + '/' + file_name + '.txt'
-
-                        if sys.platform.startswith('win'):
-                            outfile = str(pathlib.PureWindowsPath(outfile))
+                if not os.path.exists(curr_outdir): 
+                    os.mkdir(curr_outdir)
 
-                        if not os.path.exists(curr_outdir): 
-                            os.mkdir(curr_outdir)
+                if detect_only:
+                    detect(((os.path.relpath(curr_file, curr_dir), curr_file) for curr_file in files), 
+                           os.path.join(curr_outdir, DETECTION_NAME), True, profiler)
+                    continue
 
-                        processor(poem_file, save, outfile, nlp, is_dir=True)
-                print('Files have been saved to disk at', curr_outdir)
+                poems = [(os.path.relpath(curr_file, curr_dir), curr_file, get_outfile(curr_file, curr_outdir)) 
+                         for curr_file in files]
+                annotate_collection(poems, curr_outdir, nlp, model, classifier, batch_size, parse_mode, workers, 
+                                    force, cache, profiler, export, shard_size, text)
                 
             else: 
                 print('For readability, the --dir command can only be run when save is enabled')
                 print('By default, the --save argument is set to True.')
                 sys.exit(0)
 
+    elif corpus is not None:
+        if not save:
+            print('For readability, the --corpus command can only be run when save is enabled')
+            sys.exit(0)
+
+        for j in range(len(corpus)):
+            try: 
+                curr_outdir = outdir[j]
+            except (IndexError, AttributeError, TypeError):
+                curr_outdir = 'annotated_' + re.sub(r'(\.\w+)+$', '', os.path.basename(corpus[j]))
+
+            if not os.path.exists(curr_outdir): 
+                os.mkdir(curr_outdir)
+
+            if detect_only:
+                sources = index_corpus(corpus[j], corpus_format, curr_outdir, delimiter, id_field, text_field)
+                detect(sources, os.path.join(curr_outdir, DETECTION_NAME), True, profiler)
+                continue
+
+            sources = index_corpus(corpus[j], corpus_format, curr_outdir, delimiter, id_field, text_field)
+            outfiles = get_poem_outfiles([key for key, _ in sources], curr_outdir, load_manifest(curr_outdir))
+            poems = [(key, source, outfiles[key]) for key, source in sources]
+            annotate_collection(poems, curr_outdir, nlp, model, classifier, batch_size, parse_mode, workers, force, 
+                                cache, profiler, export, shard_size, text)
+
     elif dir is not None and file is not None: 
         print('JaDe cannot simultaneously analyze a single file and a whole directory.')
         print('Please specify either --dir or --file, not both.')
@@ -172,9 +524,90 @@ def run(model, dir, file, outdir, outfile, save):
 
     else:
         print("None of the options were recognized or passed.")
-        print("Accepted options are --file, --outfile, --dir, --outdir and --save")
+        print("Accepted options are --file, --outfile, --dir, --corpus, --outdir and --save")
         print("Run run.py --help for further information.")
         sys.exit(0)
 
+    if cache is not None:
+        cache.save()
+        print(cache.report())
+
+    if profiler is not None:
+        if cache is not None:
+            profiler.count('cache hits', cache.hits)
+            profiler.count('cache misses', cache.misses)
+        profiler.stop()
+        print(profiler.report())
+
+
+@click.command()
+@click.option('--model', help="Language model to be used", default='en_core_web_sm')
+@click.option('--classifier', help="Classifier whose annotations are kept", default="all", 
+            type=click.Choice(CLASSIFIERS, case_sensitive=False))
+@click.option('--batch_size', help="Number of line pairs parsed at once by spaCy", 
+            default=BATCH_SIZE, type=int)
+@click.option('--parse_mode', help="Parse line pairs on their own or retrieve them from their poem/stanza", 
+            default='pair', type=click.Choice(PARSE_MODES, case_sensitive=False))
+@click.option('--host', help="Address the service listens on", default=HOST)
+@click.option('--port', help="Port the service listens on", default=PORT, type=int)
+@click.option('--max_batch', help="Maximum number of poems annotated together", default=MAX_BATCH, type=int)
+@click.option('--max_wait', help="Milliseconds a poem may wait for others to join its batch", 
+            default=MAX_WAIT * 1e3, type=float)
+@click.option('--queue_size', help="Maximum number of poems waiting, others being rejected", 
+            default=QUEUE_SIZE, type=int)
+def serve(model, classifier, batch_size, parse_mode, host, port, max_batch, max_wait, queue_size):
+    """
+        JaDe annotation service, started with `python run.py serve`. 
+
+        The model is loaded once, then poems are accepted over HTTP: `POST 
+        /annotate` with the poem as plain text or as JSON (`{"poem": "..."}`)
+        answers the annotated poem along with the annotation of each line, 
+        and `GET /metrics` the queue depth, batch sizes and latencies. 
+        Concurrent requests are annotated together, see 
+        JaDe/jade/service.py.
+
+        Parameters
+        ----------
+            model: str
+                language model to be used. Default to spacy smaller one.
+            classifier: str
+                classifier whose annotations are kept. Default to all.
+            batch_size: int
+                number of line pairs parsed at once by spaCy.
+            parse_mode: str
+                one of `pair`, `poem` or `stanza`, see run.
+            host: str
+                address the service listens on. Default to localhost only.
+            port: int
+                port the service listens on. Default to 8000.
+            max_batch: int
+                maximum number of poems annotated together. Default to 32.
+            max_wait: float
+                milliseconds the first poem of a batch waits for others to 
+                join it. Default to 10.
+            queue_size: int
+                maximum number of poems waiting to be annotated. Requests
+                beyond are answered 503 at once. Default to 256.
+    """
+    from JaDe.jade.service import make_server, MicroBatcher
+
+    nlp = load_pipeline(model, classifier)
+    batcher = MicroBatcher(nlp, classifier, batch_size, parse_mode, max_batch, max_wait / 1e3, queue_size)
+    server = make_server(batcher, host, port)
+    batcher.start()
+    print('JaDe is serving on http://%s:%d (POST /annotate, GET /metrics)' % server.server_address[:2])
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2:], prog_name='run.py serve')
+    else:
+        run()
\ No newline at end of file